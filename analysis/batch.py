@@ -0,0 +1,324 @@
+""" Batch processing of Wasatch scan CSVs into NumPy hypercubes.
+
+    python -m analysis.batch OUTDIR scan1.csv scan2.csv ... [options]
+
+    Every input file is processed by a worker of a process pool, in chunks
+    of rows, so files larger than memory are fine. Dark and light rows
+    update the references as they appear in the file; scan rows are boxcar
+    smoothed, corrected, optionally SNV normalised and Savitzky-Golay
+    differentiated, and reduced to band features. Per file, OUTDIR/<name>/
+    receives
+
+        spectra.npy     float32 (rows, pixels)   processed spectra
+        positions.npy   float32 (rows, 4)        x, y, z, temperature
+        features.npy    float32 (rows, bands)    band features
+        wavelengths.npy float64 (pixels,)
+        layers.npy      int32 (rows,)            layer index k, only with
+                                                 a _plan.npz sidecar
+
+    and OUTDIR/ the same arrays concatenated over all files, positions
+    with the file number as a fifth column (layers.npy only if every file
+    has one), plus batch.json describing them. Band features are computed on the corrected spectra, before SNV
+    and derivatives.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+import numpy
+from numpy.lib.format import open_memmap
+from scipy.signal import savgol_filter
+from wasatch import utils
+from nir1.reference import ReferenceCorrector
+from nir1.bands import BandFeature, parse_band
+from scan.plan import ScanPlan
+
+REFERENCE_TYPES = ("dark", "light")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Process Wasatch scan CSVs into NumPy hypercubes")
+    parser.add_argument("outdir", help="output directory")
+    parser.add_argument("files", nargs="+", help="scan CSV files")
+    parser.add_argument("--correction", type=str, default="reflectance", choices=ReferenceCorrector.MODES, help="reference correction (default reflectance)")
+    parser.add_argument("--reference-average", type=int, default=1, help="dark/light readings averaged per reference (default 1)")
+    parser.add_argument("--boxcar-half-width", type=int, default=0, help="boxcar smoothing half width, as at acquisition (default 0)")
+    parser.add_argument("--snv", action="store_true", help="standard normal variate per spectrum")
+    parser.add_argument("--derivative", type=int, default=0, choices=[0, 1, 2], help="Savitzky-Golay derivative order (default 0)")
+    parser.add_argument("--window", type=int, default=11, help="Savitzky-Golay window in pixels (default 11)")
+    parser.add_argument("--polyorder", type=int, default=2, help="Savitzky-Golay polynomial order (default 2)")
+    parser.add_argument("--band", action="append", default=[], help="band feature 'start:stop', or 'start:stop/start:stop' for a ratio; repeatable")
+    parser.add_argument("--chunk-rows", type=int, default=4096, help="rows parsed per chunk (default 4096)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+    return parser.parse_args(argv)
+
+
+def parse_feature(text, wavelengths):
+    band, _, reference = text.partition("/")
+    return BandFeature(wavelengths, parse_band(band), parse_band(reference))
+
+
+def count_scan_rows(path):
+    """ Rows to allocate for; a cheap pass that only looks at the type field. """
+    count = 0
+    with open(path) as f:
+        f.readline()
+        for line in f:
+            kind = line.split(";", 1)[0]
+            if line.strip() and kind not in REFERENCE_TYPES:
+                count += 1
+    return count
+
+
+def read_chunks(path, chunk_rows):
+    """ Yields (types, numbers, spectra) per chunk, numbers being
+        x, y, z, temperature (NaN when empty). """
+    def number(text):
+        return float(text) if text else numpy.nan
+
+    with open(path) as f:
+        f.readline()
+        while True:
+            lines = []
+            for line in f:
+                if line.strip():
+                    lines.append(line.rstrip("\n").split(";"))
+                if len(lines) >= chunk_rows:
+                    break
+            if not lines:
+                return
+            types = [fields[0] for fields in lines]
+            numbers = numpy.array([[number(v) for v in fields[1:5]] for fields in lines], dtype=numpy.float64)
+            spectra = numpy.array([fields[5:] for fields in lines], dtype=numpy.float64)
+            yield types, numbers, spectra
+
+
+def read_integration_times(path):
+    """ Integration time per reading from the _meta.csv sidecar, whose rows
+        match the scan CSV's; None without a sidecar. """
+    meta_path = os.path.splitext(path)[0] + "_meta.csv"
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        fields = f.readline().rstrip("\n").split(";")
+        if "integration_time_ms" not in fields:
+            return None
+        column = fields.index("integration_time_ms")
+        times = []
+        for line in f:
+            values = line.rstrip("\n").split(";")
+            times.append(float(values[column]) if len(values) > column and values[column] else numpy.nan)
+    return numpy.array(times)
+
+
+def preprocess(spectra, args):
+    """ SNV and derivative on a chunk of corrected spectra. """
+    if args.snv:
+        mean = spectra.mean(axis=1, keepdims=True)
+        std = spectra.std(axis=1, keepdims=True)
+        spectra = (spectra - mean) / numpy.where(std > 0, std, numpy.nan)
+    if args.derivative:
+        # rows without references are NaN, which the filter's edge fit rejects
+        finite = numpy.isfinite(spectra).all(axis=1)
+        spectra = spectra.copy()
+        if finite.any():
+            spectra[finite] = savgol_filter(spectra[finite], args.window, args.polyorder, deriv=args.derivative, axis=1)
+    return spectra
+
+
+def read_plan(path):
+    """ The scan's plan from the _plan.npz sidecar, None without one. """
+    plan_path = os.path.splitext(path)[0] + "_plan.npz"
+    return ScanPlan.load_npz(plan_path) if os.path.isfile(plan_path) else None
+
+
+def is_scan_csv(path):
+    with open(path) as f:
+        return f.readline().startswith("type;x;y;z;temp;")
+
+
+def process_file(path, outdir, args):
+    """ Worker: processes one scan CSV; returns its summary. """
+    start = time.perf_counter()
+    with open(path) as f:
+        wavelengths = numpy.array(f.readline().rstrip("\n").split(";")[5:], dtype=numpy.float64)
+    features = [parse_feature(text, wavelengths) for text in args.band]
+    rows = count_scan_rows(path)
+    integration_times = read_integration_times(path)
+    plan = read_plan(path)
+
+    os.makedirs(outdir, exist_ok=True)
+    numpy.save(os.path.join(outdir, "wavelengths.npy"), wavelengths)
+    spectra_out = open_memmap(os.path.join(outdir, "spectra.npy"), "w+", numpy.float32, (rows, len(wavelengths)))
+    positions_out = open_memmap(os.path.join(outdir, "positions.npy"), "w+", numpy.float32, (rows, 4))
+    features_out = open_memmap(os.path.join(outdir, "features.npy"), "w+", numpy.float32, (rows, len(features)))
+    # a plan on a focus surface has a Z per point, so layers come from its grid
+    layers_out = None
+    if plan is not None:
+        layers_out = open_memmap(os.path.join(outdir, "layers.npy"), "w+", numpy.int32, (rows,))
+    elif os.path.isfile(os.path.join(outdir, "layers.npy")):
+        os.remove(os.path.join(outdir, "layers.npy"))
+
+    corrector = ReferenceCorrector(args.correction, args.reference_average)
+    row = 0
+    reading = 0
+    uncorrected = 0
+    for types, numbers, spectra in read_chunks(path, args.chunk_rows):
+        if args.boxcar_half_width > 0:
+            spectra = numpy.array([utils.apply_boxcar(s, args.boxcar_half_width) for s in spectra], dtype=numpy.float64)
+        times = integration_times[reading:reading + len(types)] if integration_times is not None else None
+        reading += len(types)
+
+        # references change the correction, so split the chunk at each one
+        n = 0
+        while n < len(types):
+            if types[n] in REFERENCE_TYPES:
+                time_ms = times[n] if times is not None and n < len(times) else None
+                if types[n] == "dark":
+                    corrector.add_dark(spectra[n], time_ms)
+                else:
+                    corrector.add_light(spectra[n], time_ms)
+                n += 1
+                continue
+            end = n
+            while end < len(types) and types[end] not in REFERENCE_TYPES:
+                end += 1
+            block = slice(n, end)
+            corrected = correct_block(corrector, spectra[block], times[block] if times is not None else None)
+            if corrected is None:
+                uncorrected += end - n
+                corrected = numpy.full((end - n, len(wavelengths)), numpy.nan)
+
+            count = end - n
+            spectra_out[row:row + count] = preprocess(corrected, args)
+            positions_out[row:row + count] = numbers[block]
+            if layers_out is not None:
+                layers_out[row:row + count] = plan.layer_of(numbers[block, :3])
+            for column, feature in enumerate(features):
+                features_out[row:row + count, column] = feature.value(corrected)
+            row += count
+            n = end
+
+    for array in (spectra_out, positions_out, features_out, layers_out):
+        if array is not None:
+            array.flush()
+    del spectra_out, positions_out, features_out, layers_out
+    return {
+        "file": path,
+        "outdir": outdir,
+        "rows": rows,
+        "pixels": len(wavelengths),
+        "uncorrected": uncorrected,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def correct_block(corrector, spectra, times):
+    """ Corrects consecutive scan rows, grouped by integration time. """
+    if corrector.mode == "off":
+        return spectra
+    if times is None or len(times) != len(spectra) or numpy.isnan(times).all():
+        corrected = corrector.correct(spectra)
+        return None if corrected is None else corrected.copy()
+    out = numpy.empty_like(spectra)
+    for time_ms in numpy.unique(times):
+        rows = times == time_ms
+        corrected = corrector.correct(spectra[rows], None if numpy.isnan(time_ms) else time_ms)
+        if corrected is None:
+            return None
+        out[rows] = corrected
+    return out
+
+
+def consolidate(outdir, results, features):
+    """ Concatenates the per-file arrays chunk by chunk into OUTDIR. """
+    total = sum(r["rows"] for r in results)
+    wavelengths = numpy.load(os.path.join(results[0]["outdir"], "wavelengths.npy"))
+    if any(not numpy.array_equal(numpy.load(os.path.join(r["outdir"], "wavelengths.npy")), wavelengths) for r in results):
+        print("Files have different wavelength axes, skipping the consolidated cube")
+        return None
+    numpy.save(os.path.join(outdir, "wavelengths.npy"), wavelengths)
+    spectra = open_memmap(os.path.join(outdir, "spectra.npy"), "w+", numpy.float32, (total, len(wavelengths)))
+    positions = open_memmap(os.path.join(outdir, "positions.npy"), "w+", numpy.float32, (total, 5))
+    feature_out = open_memmap(os.path.join(outdir, "features.npy"), "w+", numpy.float32, (total, features))
+    layers = None
+    if all(os.path.isfile(os.path.join(r["outdir"], "layers.npy")) for r in results):
+        layers = open_memmap(os.path.join(outdir, "layers.npy"), "w+", numpy.int32, (total,))
+    elif os.path.isfile(os.path.join(outdir, "layers.npy")):
+        os.remove(os.path.join(outdir, "layers.npy"))
+
+    row = 0
+    for number, result in enumerate(results):
+        part = numpy.load(os.path.join(result["outdir"], "spectra.npy"), mmap_mode="r")
+        for start in range(0, len(part), 65536):
+            block = part[start:start + 65536]
+            spectra[row + start:row + start + len(block)] = block
+        count = len(part)
+        positions[row:row + count, :4] = numpy.load(os.path.join(result["outdir"], "positions.npy"))
+        positions[row:row + count, 4] = number
+        if layers is not None:
+            layers[row:row + count] = numpy.load(os.path.join(result["outdir"], "layers.npy"))
+        feature_out[row:row + count] = numpy.load(os.path.join(result["outdir"], "features.npy"))
+        result["first_row"] = row
+        row += count
+    for array in (spectra, positions, feature_out, layers):
+        if array is not None:
+            array.flush()
+    return total
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.outdir, exist_ok=True)
+    names = {}
+    jobs = []
+    for path in args.files:
+        if not is_scan_csv(path):
+            # e.g. _meta.csv or _predictions.csv sidecars picked up by a glob
+            print("Skipping %s: not a scan CSV" % path)
+            continue
+        name = os.path.splitext(os.path.basename(path))[0]
+        # same file name from different folders
+        names[name] = names.get(name, 0) + 1
+        if names[name] > 1:
+            name = "%s_%d" % (name, names[name])
+        jobs.append((path, os.path.join(args.outdir, name)))
+
+    start = time.perf_counter()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(process_file, path, outdir, args): path for path, outdir in jobs}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print("[%d/%d] %s failed: %s" % (done, len(jobs), path, e))
+                continue
+            results[path] = result
+            print("[%d/%d] %s: %d spectra in %.1f s%s" % (
+                done, len(jobs), path, result["rows"], result["seconds"],
+                ", %d without references" % result["uncorrected"] if result["uncorrected"] else ""))
+
+    ordered = [results[path] for path, _ in jobs if path in results]
+    if not ordered:
+        return 1
+    total = consolidate(args.outdir, ordered, len(args.band))
+    with open(os.path.join(args.outdir, "batch.json"), "w") as f:
+        json.dump({
+            "files": ordered,
+            "rows": total,
+            "bands": args.band,
+            "correction": args.correction,
+            "snv": args.snv,
+            "derivative": args.derivative,
+        }, f, indent=1)
+    print("%d files, %d spectra in %.1f s" % (len(ordered), total or 0, time.perf_counter() - start))
+    return 0 if len(ordered) == len(jobs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
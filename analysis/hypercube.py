@@ -0,0 +1,179 @@
+""" Memory-mapped access to processed scans (analysis.batch output).
+
+    A cube directory holds spectra.npy (rows, pixels), positions.npy
+    (rows, >= 3), wavelengths.npy and, for scans with a plan sidecar,
+    layers.npy (rows,) with each row's layer index k. Without it the
+    layers are the distinct Z values. Spectra stay on disk: single rows
+    come through an LRU cache of row blocks, region means stream the
+    selected rows block by block, so scans larger than memory stay usable.
+"""
+
+import os
+import collections
+import numpy
+from scipy.spatial import cKDTree
+from analysis.pyramid import ImagePyramid
+
+
+def cube_dir_for(csv_path):
+    return os.path.splitext(csv_path)[0] + "_cube"
+
+
+def convert_csv(csv_path, outdir=None, correction="off"):
+    """ Writes the cube directory for a scan CSV with analysis.batch. """
+    from analysis import batch
+    outdir = outdir or cube_dir_for(csv_path)
+    args = batch.parse_args([outdir, csv_path, "--correction", correction, "--workers", "1"])
+    batch.process_file(csv_path, outdir, args)
+    return outdir
+
+
+class HypercubeReader:
+    def __init__(self, directory, block_rows=256, cache_blocks=64):
+        self.directory = directory
+        self.spectra = numpy.load(os.path.join(directory, "spectra.npy"), mmap_mode="r")
+        self.positions = numpy.load(os.path.join(directory, "positions.npy"))[:, :3].astype(numpy.float64)
+        self.wavelengths = numpy.load(os.path.join(directory, "wavelengths.npy"))
+        layers_path = os.path.join(directory, "layers.npy")
+        if os.path.isfile(layers_path):
+            self.layer = numpy.load(layers_path).astype(numpy.int64)
+        else:
+            self.layer = numpy.unique(self.positions[:, 2], return_inverse=True)[1].reshape(-1)
+        self.block_rows = block_rows
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._tree = None
+        self._layer_trees = {}
+        self._row_means = None
+
+    def __len__(self):
+        return len(self.spectra)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.positions)
+        return self._tree
+
+    def block(self, number):
+        """ Rows [number * block_rows, ...) as an in-memory array, cached. """
+        if number in self.cache:
+            self.cache.move_to_end(number)
+            self.hits += 1
+            return self.cache[number]
+        self.misses += 1
+        start = number * self.block_rows
+        data = numpy.array(self.spectra[start:start + self.block_rows], dtype=numpy.float32)
+        self.cache[number] = data
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return data
+
+    def spectrum(self, row):
+        return self.block(row // self.block_rows)[row % self.block_rows]
+
+    def nearest(self, point):
+        """ Row closest to point (x, y, z). """
+        return int(self.tree.query(point)[1])
+
+    def nearest_in_layer(self, x, y, layer):
+        """ Row of the layer closest to (x, y). """
+        if layer not in self._layer_trees:
+            rows = numpy.nonzero(self.layer == layer)[0]
+            self._layer_trees[layer] = (rows, cKDTree(self.positions[rows, :2]))
+        rows, tree = self._layer_trees[layer]
+        return int(rows[tree.query((x, y))[1]])
+
+    def region_rows(self, x1, x2, y1, y2, layer=None):
+        """ Rows with x1 <= x <= x2, y1 <= y <= y2 and, if given, on the layer. """
+        x, y = self.positions[:, 0], self.positions[:, 1]
+        inside = (x >= min(x1, x2)) & (x <= max(x1, x2)) & (y >= min(y1, y2)) & (y <= max(y1, y2))
+        if layer is not None:
+            inside &= self.layer == layer
+        return numpy.nonzero(inside)[0]
+
+    def mean(self, rows):
+        """ Mean spectrum of the rows (ignoring NaN rows), read per block:
+            cached blocks are reused, the rest streams from the file. """
+        rows = numpy.sort(numpy.asarray(rows, dtype=numpy.int64))
+        total = numpy.zeros(self.spectra.shape[1])
+        count = 0
+        blocks = rows // self.block_rows
+        for number in numpy.unique(blocks):
+            selected = rows[blocks == number] - number * self.block_rows
+            if number in self.cache:
+                data = self.block(number)[selected]
+            else:
+                # don't let one large region evict the clicked points
+                start = number * self.block_rows
+                data = numpy.asarray(self.spectra[start:start + self.block_rows])[selected]
+            valid = numpy.isfinite(data).all(axis=1)
+            total += data[valid].sum(axis=0, dtype=numpy.float64)
+            count += int(valid.sum())
+        return total / count if count else None, count
+
+    def row_means(self, chunk_rows=65536):
+        """ Mean value of every spectrum, computed once in chunks and kept in
+            the cube directory as a quick-look map. """
+        if self._row_means is None:
+            path = os.path.join(self.directory, "row_means.npy")
+            if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(os.path.join(self.directory, "spectra.npy")):
+                self._row_means = numpy.load(path)
+            else:
+                means = numpy.empty(len(self), dtype=numpy.float32)
+                for start in range(0, len(self), chunk_rows):
+                    means[start:start + chunk_rows] = numpy.nanmean(self.spectra[start:start + chunk_rows], axis=1)
+                numpy.save(path, means)
+                self._row_means = means
+        return self._row_means
+
+    def layers(self):
+        return numpy.unique(self.layer[self.layer >= 0])
+
+    def layer_z(self, layer):
+        """ Mean Z of the layer's rows, for labels. """
+        return float(numpy.nanmean(self.positions[self.layer == layer, 2]))
+
+    def mean_pyramid(self, layer):
+        """ Pyramid of the layer's quick-look map and its (xs, ys) axes,
+            built once and memory-mapped from the cube directory later. """
+        name = "means_layer%d" % layer
+        axes_path = os.path.join(self.directory, name + "_axes.npz")
+        spectra_time = os.path.getmtime(os.path.join(self.directory, "spectra.npy"))
+        if os.path.isfile(axes_path) and os.path.getmtime(axes_path) >= spectra_time:
+            pyramid = ImagePyramid.load(self.directory, name)
+            if pyramid is not None:
+                with numpy.load(axes_path) as axes:
+                    return pyramid, axes["xs"], axes["ys"]
+
+        xs, ys, ids = self.grid(layer)
+        image = numpy.where(ids >= 0, self.row_means()[numpy.maximum(ids, 0)], numpy.nan).astype(numpy.float32)
+        pyramid = ImagePyramid(image).build()
+        pyramid.save(self.directory, name)
+        numpy.savez(axes_path, xs=xs, ys=ys)
+        return pyramid, xs, ys
+
+    def grid(self, layer, max_cells=4096):
+        """ Rows of the layer placed on a regular XY grid: (xs, ys, ids) with
+            ids a (len(ys), len(xs)) array, -1 where nothing was measured.
+            The step is the smallest spacing found along each axis (so
+            refinement points get their own cells), coarsened if an axis
+            would exceed max_cells. """
+        rows = numpy.nonzero(self.layer == layer)[0]
+        # positions are written with 2 decimals
+        xy = numpy.round(self.positions[rows, :2], 2)
+        axes = []
+        cells = []
+        for values in xy.T:
+            unique = numpy.unique(values)
+            spacing = numpy.diff(unique)
+            span = unique[-1] - unique[0]
+            step = max(spacing[spacing > 0].min() if len(unique) > 1 else 1.0, span / (max_cells - 1))
+            cells.append(numpy.rint((values - unique[0]) / step).astype(numpy.int64))
+            axes.append(unique[0] + numpy.arange(cells[-1].max() + 1) * step)
+        ids = numpy.full((len(axes[1]), len(axes[0])), -1, dtype=numpy.int64)
+        # later rows (rescans) win
+        ids[cells[1], cells[0]] = rows
+        return axes[0], axes[1], ids
@@ -0,0 +1,73 @@
+""" 2x2 averaged pyramids of scan images (band maps, or cubes with the
+    spectra as trailing axis) for drawing at screen resolution.
+
+    Level 0 is the full-resolution (Y, X, ...) array, level n averages
+    2**n x 2**n cells; NaN (unmeasured) cells are left out of the average.
+    update() recomputes only the parents of a changed block, so a live map
+    keeps its pyramid current as rows complete.
+"""
+
+import os
+import math
+import numpy
+
+
+class ImagePyramid:
+    def __init__(self, base, min_size=16, levels=None):
+        self.levels = [base]
+        if levels is not None:
+            self.levels += levels
+            return
+        shape = base.shape
+        while max(shape[:2]) > min_size:
+            shape = (math.ceil(shape[0] / 2), math.ceil(shape[1] / 2)) + tuple(shape[2:])
+            self.levels.append(numpy.full(shape, numpy.nan, dtype=numpy.float32))
+
+    def build(self):
+        self.update(0, self.levels[0].shape[0], 0, self.levels[0].shape[1])
+        return self
+
+    def update(self, y0, y1, x0, x1):
+        """ Recomputes every level above the changed level-0 block
+            [y0:y1, x0:x1]; a block reaching past the edge is clipped. """
+        for level in range(1, len(self.levels)):
+            height, width = self.levels[level - 1].shape[:2]
+            y0, y1 = min(y0, height), min(y1, height)
+            x0, x1 = min(x0, width), min(x1, width)
+            y0, y1 = y0 // 2, (y1 + 1) // 2
+            x0, x1 = x0 // 2, (x1 + 1) // 2
+            child = numpy.asarray(self.levels[level - 1][2 * y0:2 * y1, 2 * x0:2 * x1], dtype=numpy.float64)
+            self.levels[level][y0:y1, x0:x1] = self.average(child, y1 - y0, x1 - x0)
+
+    @staticmethod
+    def average(child, height, width):
+        # pad odd edges with NaN so every parent has a full 2x2 block
+        pad = [(0, 2 * height - child.shape[0]), (0, 2 * width - child.shape[1])] + [(0, 0)] * (child.ndim - 2)
+        child = numpy.pad(child, pad, constant_values=numpy.nan)
+        blocks = child.reshape((height, 2, width, 2) + child.shape[2:])
+        finite = numpy.isfinite(blocks)
+        total = numpy.where(finite, blocks, 0).sum(axis=(1, 3))
+        count = finite.sum(axis=(1, 3))
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(count > 0, total / count, numpy.nan)
+
+    def level_for(self, visible_cells, pixels):
+        """ Coarsest level that still has about one cell per screen pixel
+            for visible_cells level-0 cells drawn over pixels pixels. """
+        if pixels <= 0 or visible_cells <= pixels:
+            return 0
+        return min(int(math.log2(visible_cells / pixels)), len(self.levels) - 1)
+
+    def save(self, directory, name):
+        for level, data in enumerate(self.levels):
+            numpy.save(os.path.join(directory, "%s_L%d.npy" % (name, level)), data)
+
+    @classmethod
+    def load(cls, directory, name):
+        """ Memory-maps a saved pyramid, or returns None if there is none. """
+        levels = []
+        while os.path.isfile(os.path.join(directory, "%s_L%d.npy" % (name, len(levels)))):
+            levels.append(numpy.load(os.path.join(directory, "%s_L%d.npy" % (name, len(levels))), mmap_mode="r"))
+        if not levels:
+            return None
+        return cls(levels[0], levels=levels[1:])
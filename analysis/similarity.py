@@ -0,0 +1,188 @@
+""" Similarity search over stored scans.
+
+    Every spectrum is reduced to a short feature vector: SNV normalised,
+    projected on principal components fitted once when the index is
+    created, and scaled to unit length. Vectors are kept on disk, one
+    float32 shard per added scan, and a query is a top-k cosine search
+    done as chunked matrix products over the memory-mapped shards.
+
+    python -m analysis.similarity build INDEX scan.csv|cube_dir ... [--components 20]
+    python -m analysis.similarity add INDEX scan.csv|cube_dir ...
+    python -m analysis.similarity query INDEX scan.csv|cube_dir (--row N | --xyz X Y Z) [--k 10]
+
+    Scan CSVs are first converted to cube directories (analysis.hypercube).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy
+from scipy import sparse
+from numpy.lib.format import open_memmap
+from analysis.hypercube import HypercubeReader, convert_csv, cube_dir_for
+from nir1.resample import SpectralTransform
+
+# spectra per chunk: 16384 x 1024 pixels is 128 MB as float64, a few times that with the SNV temporaries
+CHUNK_ROWS = 16384
+
+
+def snv(spectra):
+    spectra = numpy.asarray(spectra, dtype=numpy.float64)
+    std = spectra.std(axis=-1, keepdims=True)
+    return (spectra - spectra.mean(axis=-1, keepdims=True)) / numpy.where(std > 0, std, numpy.nan)
+
+
+def open_cube(path):
+    """ HypercubeReader for a cube directory or a scan CSV (converted once). """
+    if os.path.isdir(path):
+        return HypercubeReader(path)
+    if not os.path.isfile(os.path.join(cube_dir_for(path), "spectra.npy")):
+        convert_csv(path)
+    return HypercubeReader(cube_dir_for(path))
+
+
+def axis_matrix(source, target):
+    """ Sparse linear interpolation from the source to the target axis, or
+        None when they are the same. """
+    if len(source) == len(target) and numpy.allclose(source, target):
+        return None
+    order = numpy.argsort(source)
+    rows, cols, weights = SpectralTransform.interpolation(source[order], target)
+    return sparse.csr_matrix((weights, (rows, order[cols])), shape=(len(target), len(source)))
+
+
+class SimilarityIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        with numpy.load(os.path.join(directory, "model.npz")) as model:
+            self.wavelengths = model["wavelengths"]
+            self.mean = model["mean"]
+            self.components = model["components"]
+        with open(os.path.join(directory, "files.json")) as f:
+            self.files = json.load(f)
+
+    @classmethod
+    def create(cls, directory, paths, components=20, sample_rows=20000):
+        """ Fits the PCA on spectra sampled evenly across the scans and
+            indexes them. """
+        os.makedirs(directory, exist_ok=True)
+        cubes = [open_cube(path) for path in paths]
+        wavelengths = cubes[0].wavelengths
+        per_cube = max(1, sample_rows // len(cubes))
+        sample = []
+        for cube in cubes:
+            rows = numpy.linspace(0, len(cube) - 1, min(per_cube, len(cube))).astype(numpy.int64)
+            spectra = numpy.asarray(cube.spectra[rows], dtype=numpy.float64)
+            matrix = axis_matrix(cube.wavelengths, wavelengths)
+            if matrix is not None:
+                spectra = (matrix @ spectra.T).T
+            sample.append(snv(spectra))
+        sample = numpy.vstack(sample)
+        sample = sample[numpy.isfinite(sample).all(axis=1)]
+        if not len(sample):
+            raise ValueError("no finite spectra to fit the index on")
+
+        mean = sample.mean(axis=0)
+        _, _, vt = numpy.linalg.svd(sample - mean, full_matrices=False)
+        numpy.savez(os.path.join(directory, "model.npz"), wavelengths=wavelengths, mean=mean, components=vt[:components])
+        with open(os.path.join(directory, "files.json"), "w") as f:
+            json.dump([], f)
+
+        index = cls(directory)
+        for path, cube in zip(paths, cubes):
+            index.add(path, cube)
+        return index
+
+    def features(self, spectra, wavelengths=None):
+        """ Unit-length feature vectors (rows) for spectra (rows); spectra
+            that are not finite get zero vectors. """
+        spectra = numpy.atleast_2d(numpy.asarray(spectra, dtype=numpy.float64))
+        if wavelengths is not None:
+            matrix = axis_matrix(numpy.asarray(wavelengths, dtype=numpy.float64), self.wavelengths)
+            if matrix is not None:
+                spectra = (matrix @ spectra.T).T
+        vectors = (snv(spectra) - self.mean) @ self.components.T
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = numpy.where(numpy.isfinite(norms) & (norms > 0), vectors / norms, 0.0)
+        return vectors.astype(numpy.float32)
+
+    def add(self, path, cube=None):
+        cube = cube or open_cube(path)
+        shard = "vectors_%d.npy" % len(self.files)
+        vectors = open_memmap(os.path.join(self.directory, shard), "w+", numpy.float32, (len(cube), len(self.components)))
+        for start in range(0, len(cube), CHUNK_ROWS):
+            vectors[start:start + CHUNK_ROWS] = self.features(cube.spectra[start:start + CHUNK_ROWS], cube.wavelengths)
+        vectors.flush()
+        numpy.save(os.path.join(self.directory, "positions_%d.npy" % len(self.files)), cube.positions.astype(numpy.float32))
+        self.files.append({"path": os.path.abspath(path), "cube": os.path.abspath(cube.directory), "rows": len(cube), "vectors": shard})
+        with open(os.path.join(self.directory, "files.json"), "w") as f:
+            json.dump(self.files, f, indent=1)
+
+    def query(self, spectra, wavelengths=None, k=10):
+        """ Top-k matches for each query spectrum: a list, per query, of
+            (score, file number, row) sorted by decreasing cosine similarity. """
+        queries = self.features(spectra, wavelengths)
+        best_scores = numpy.full((len(queries), 0), -numpy.inf, dtype=numpy.float32)
+        best_ids = numpy.zeros((len(queries), 0, 2), dtype=numpy.int64)
+        for number, entry in enumerate(self.files):
+            vectors = numpy.load(os.path.join(self.directory, entry["vectors"]), mmap_mode="r")
+            for start in range(0, len(vectors), CHUNK_ROWS):
+                scores = queries @ numpy.asarray(vectors[start:start + CHUNK_ROWS]).T
+                take = min(k, scores.shape[1])
+                top = numpy.argpartition(-scores, take - 1, axis=1)[:, :take]
+                ids = numpy.stack([numpy.full(top.shape, number), top + start], axis=-1)
+                best_scores = numpy.concatenate([best_scores, numpy.take_along_axis(scores, top, axis=1)], axis=1)
+                best_ids = numpy.concatenate([best_ids, ids], axis=1)
+                if best_scores.shape[1] > k:
+                    keep = numpy.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = numpy.take_along_axis(best_scores, keep, axis=1)
+                    best_ids = numpy.take_along_axis(best_ids, keep[..., None], axis=1)
+
+        results = []
+        for scores, ids in zip(best_scores, best_ids):
+            order = numpy.argsort(-scores)
+            results.append([(float(scores[n]), int(ids[n, 0]), int(ids[n, 1])) for n in order])
+        return results
+
+    def position(self, number, row):
+        positions = numpy.load(os.path.join(self.directory, "positions_%d.npy" % number), mmap_mode="r")
+        return tuple(float(v) for v in positions[row])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Similarity search over stored scans")
+    parser.add_argument("command", choices=["build", "add", "query"])
+    parser.add_argument("index", help="index directory")
+    parser.add_argument("paths", nargs="+", help="scan CSVs or cube directories (query: the one holding the query spectrum)")
+    parser.add_argument("--components", type=int, default=20, help="PCA components (build, default 20)")
+    parser.add_argument("--row", type=int, default=None, help="query spectrum row")
+    parser.add_argument("--xyz", type=float, nargs=3, default=None, help="query spectrum nearest to this position")
+    parser.add_argument("--k", type=int, default=10, help="matches to report (default 10)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if args.command == "build":
+        index = SimilarityIndex.create(args.index, args.paths, args.components)
+        print("Indexed %d spectra from %d scans in %.1f s" % (sum(f["rows"] for f in index.files), len(index.files), time.perf_counter() - start))
+        return 0
+    index = SimilarityIndex(args.index)
+    if args.command == "add":
+        for path in args.paths:
+            index.add(path)
+        print("Index holds %d scans, %d spectra" % (len(index.files), sum(f["rows"] for f in index.files)))
+        return 0
+
+    cube = open_cube(args.paths[0])
+    row = args.row if args.row is not None else cube.nearest(args.xyz) if args.xyz else 0
+    matches = index.query(cube.spectrum(row), cube.wavelengths, args.k)[0]
+    print("Query %s row %d, %d matches in %.2f s" % (args.paths[0], row, len(matches), time.perf_counter() - start))
+    for score, number, match in matches:
+        x, y, z = index.position(number, match)[:3]
+        print("%.4f  %s  row %d  X:%g Y:%g Z:%g" % (score, index.files[number]["path"], match, x, y, z))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+""" Spatial index over the positions of a scan CSV.
+
+    The index maps every scan row's (x, y, z) to its byte offset in the
+    CSV, so a query reads only the rows it returns. It is stored as
+    <scan>_index.npz next to the data and extended from where it stopped
+    when the CSV has grown, e.g. while the scan is still running.
+
+    python -m analysis.spatial_index scan.csv [x y z]
+"""
+
+import os
+import sys
+import time
+import numpy
+from scipy.spatial import cKDTree
+
+REFERENCE_TYPES = (b"dark", b"light")
+
+
+def index_path(csv_path):
+    return os.path.splitext(csv_path)[0] + "_index.npz"
+
+
+def parse_row(line):
+    """ (type, x, y, z, temperature, spectrum) from one CSV line. """
+    fields = line.rstrip("\r\n").split(";")
+    numbers = [float(v) if v else None for v in fields[1:5]]
+    return (fields[0], *numbers, numpy.array(fields[5:], dtype=numpy.float64))
+
+
+class SpatialIndex:
+    """ KD-tree over the scan rows of a CSV with nearest(), within() and
+        box() queries returning row ids, and spectrum(id) reading a row. """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.positions = numpy.zeros((0, 3))
+        self.offsets = numpy.zeros(0, dtype=numpy.int64)
+        self.end = 0
+        self.tree = None
+        self.file = None
+        path = index_path(csv_path)
+        if os.path.isfile(path):
+            with numpy.load(path) as data:
+                self.positions = data["positions"]
+                self.offsets = data["offsets"]
+                self.end = int(data["end"])
+        self.wavelengths = self.read_wavelengths()
+        self.update()
+
+    def read_wavelengths(self):
+        with open(self.csv_path) as f:
+            return numpy.array(f.readline().rstrip("\n").split(";")[5:], dtype=numpy.float64)
+
+    def update(self):
+        """ Indexes rows appended since the last update; returns how many. """
+        size = os.path.getsize(self.csv_path)
+        if size < self.end:
+            # file was rewritten, start over
+            self.positions = numpy.zeros((0, 3))
+            self.offsets = numpy.zeros(0, dtype=numpy.int64)
+            self.end = 0
+        if size == self.end and self.tree is not None:
+            return 0
+
+        positions = []
+        offsets = []
+        with open(self.csv_path, "rb") as f:
+            if self.end == 0:
+                self.end = len(f.readline())
+            f.seek(self.end)
+            offset = self.end
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # row still being written
+                    break
+                fields = line.split(b";", 5)
+                if len(fields) > 4 and fields[0] not in REFERENCE_TYPES and all(fields[1:4]):
+                    positions.append((float(fields[1]), float(fields[2]), float(fields[3])))
+                    offsets.append(offset)
+                offset += len(line)
+        self.end = offset
+
+        if positions:
+            self.positions = numpy.vstack([self.positions, numpy.array(positions)])
+            self.offsets = numpy.concatenate([self.offsets, numpy.array(offsets, dtype=numpy.int64)])
+        self.tree = cKDTree(self.positions) if len(self.positions) else None
+        return len(positions)
+
+    def save(self):
+        numpy.savez(index_path(self.csv_path), positions=self.positions, offsets=self.offsets, end=self.end)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def nearest(self, point, k=1):
+        """ (distances, ids) of the k nearest rows. """
+        if self.tree is None:
+            return numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64)
+        distances, ids = self.tree.query(point, k=min(k, len(self)))
+        return numpy.atleast_1d(distances), numpy.atleast_1d(ids)
+
+    def within(self, point, radius):
+        """ Ids of the rows within radius of point. """
+        if self.tree is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.array(sorted(self.tree.query_ball_point(point, radius)), dtype=numpy.int64)
+
+    def box(self, low, high):
+        """ Ids of the rows inside the axis-aligned box low..high. """
+        if self.tree is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        low = numpy.asarray(low, dtype=numpy.float64)
+        high = numpy.asarray(high, dtype=numpy.float64)
+        # the box's circumscribing cube in the max norm, then the exact test
+        candidates = numpy.array(self.tree.query_ball_point((low + high) / 2, (high - low).max() / 2, p=numpy.inf), dtype=numpy.int64)
+        if not len(candidates):
+            return candidates
+        inside = numpy.all((self.positions[candidates] >= low) & (self.positions[candidates] <= high), axis=1)
+        return numpy.sort(candidates[inside])
+
+    def row(self, id):
+        if self.file is None:
+            self.file = open(self.csv_path, "rb")
+        self.file.seek(self.offsets[id])
+        return parse_row(self.file.readline().decode("utf-8"))
+
+    def spectrum(self, id):
+        return self.row(id)[5]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 5):
+        print("usage: python -m analysis.spatial_index scan.csv [x y z]")
+        sys.exit(1)
+    start = time.perf_counter()
+    index = SpatialIndex(sys.argv[1])
+    index.save()
+    print("%d rows indexed in %.2f s -> %s" % (len(index), time.perf_counter() - start, index_path(sys.argv[1])))
+    if len(sys.argv) == 5:
+        point = [float(v) for v in sys.argv[2:5]]
+        start = time.perf_counter()
+        distances, ids = index.nearest(point)
+        elapsed = time.perf_counter() - start
+        if len(ids):
+            kind, x, y, z, temperature, spectrum = index.row(ids[0])
+            print("nearest: %s at %s;%s;%s (%.3f away, %.3f ms), %d pixels" % (kind, x, y, z, distances[0], elapsed * 1000, len(spectrum)))
@@ -6,12 +6,16 @@ class CNCSerial:
     def __init__(self):
         self.serial_port = None
         self.connected = False
+        # remembered for reconnect()
+        self.port = None
+        self.last_error = None
 
     def connect_cnc(self, port):
         try:
             self.serial_port = serial.Serial(
                 port, baudrate=115200, timeout=1)
             self.connected = True
+            self.port = port
             return "Connected to {}".format(port)
         except Exception as e:
             return "Error: {}".format(e)
@@ -23,20 +27,135 @@ class CNCSerial:
             return "Disconnected from CNC"
         return "Not connected to CNC"
 
+    def link_lost(self, error):
+        # a dropped port raises on every access; mark it so callers can recover
+        self.last_error = error
+        self.connected = False
+        return "Error: {}".format(error)
+
+    def reconnect(self, settle_s=2.0):
+        """ Reopens the remembered port. GRBL resets when the port opens,
+            so wait for its banner before sending anything. """
+        if self.port is None:
+            return False
+        try:
+            if self.serial_port:
+                self.serial_port.close()
+        except Exception:
+            pass
+        self.connected = False
+        message = self.connect_cnc(self.port)
+        if not self.connected:
+            self.last_error = message
+            return False
+        time.sleep(settle_s)
+        try:
+            self.serial_port.reset_input_buffer()
+        except Exception as e:
+            self.link_lost(e)
+            return False
+        return True
+
     def send_gcode(self, command):
         if self.serial_port and self.connected:
-            self.serial_port.write((command + '\n').encode())
+            try:
+                self.serial_port.write((command + '\n').encode())
+            except (serial.SerialException, OSError) as e:
+                return self.link_lost(e)
             return f"Command sent: {command}"
         return "Not connected to CNC"
 
     def wait_for_ending_move(self):
         if self.serial_port and self.connected:
-            self.serial_port.write(('?\n').encode())
-            time.sleep(0.1)
-            response = self.serial_port.read_until().decode().strip()
+            try:
+                self.serial_port.write(('?\n').encode())
+                time.sleep(0.1)
+                response = self.serial_port.read_until().decode().strip()
+            except (serial.SerialException, OSError) as e:
+                self.link_lost(e)
+                return False
             if "Idle" in response:
                 return True
         return False
 
+    def read_lines_until(self, done, timeout=5):
+        lines = []
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                line = self.serial_port.read_until().decode(errors="ignore").strip()
+            except (serial.SerialException, OSError) as e:
+                self.link_lost(e)
+                break
+            if line:
+                lines.append(line)
+                if done(line):
+                    break
+        return lines
+
+    def query(self, command, done, timeout=5):
+        """ Sends a command and returns the lines read until done(line).
+            Unread replies to earlier commands (a stray 'ok', an old status
+            report) are dropped first so they are not taken as the answer. """
+        if not (self.serial_port and self.connected):
+            return []
+        try:
+            self.serial_port.reset_input_buffer()
+        except (serial.SerialException, OSError) as e:
+            self.link_lost(e)
+            return []
+        self.send_gcode(command)
+        if not self.connected:
+            return []
+        return self.read_lines_until(done, timeout)
+
+    @staticmethod
+    def parse_axes(text):
+        return [float(v) for v in text.split(',')[:3]]
+
+    def machine_position(self):
+        """ Machine coordinates (MPos) from a GRBL status report, or None. """
+        lines = self.query('?', lambda line: line.startswith('<'))
+        for line in lines:
+            if not line.startswith('<'):
+                continue
+            for field in line.strip('<>').split('|'):
+                if field.startswith('MPos:'):
+                    return self.parse_axes(field[5:])
+        return None
+
+    def work_offsets(self):
+        """ G54 and G92 offsets reported by GRBL '$#', or None. """
+        # the reply is [G54:...] ... [G92:...] [TLO:...] [PRB:...] then ok; an
+        # 'ok' only ends it once the offsets have arrived
+        seen = set()
+
+        def done(line):
+            seen.add(line[1:4])
+            return line.startswith('[PRB') or (line == 'ok' and {'G54', 'G92'} <= seen)
+
+        lines = self.query('$#', done)
+        offsets = {}
+        for line in lines:
+            for name in ('G54', 'G92'):
+                if line.startswith('[%s:' % name):
+                    offsets[name] = self.parse_axes(line[len(name) + 2:].rstrip(']'))
+        return offsets if 'G54' in offsets and 'G92' in offsets else None
+
+    def home(self):
+        return self.send_gcode('$H')
+
+    def restore_work_offsets(self, offsets):
+        """ After homing, re-applies the G92 offset saved by work_offsets() so
+            work coordinates match the ones the scan was planned in. """
+        mpos = self.machine_position()
+        if mpos is None or not offsets:
+            return False
+        g54 = offsets['G54']
+        g92 = offsets['G92']
+        wpos = [m - a - b for m, a, b in zip(mpos, g54, g92)]
+        self.send_gcode('G92 X{:.3f} Y{:.3f} Z{:.3f}'.format(*wpos))
+        return True
+
     def list_serial_ports(self):
         return [port.device for port in serial.tools.list_ports.comports()]
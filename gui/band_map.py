@@ -0,0 +1,127 @@
+import math
+import tkinter as tk
+import numpy as np
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+from analysis.pyramid import ImagePyramid
+
+
+class BandMapWindow:
+    """ Live map of a band feature (or any per-point value) over the scan
+        grid, one image per layer (grid index k).
+
+        Values go into a preallocated (layers, Y, X) array and only the
+        image of the updated layer is refreshed. With subdivide > 1 the map
+        is that much finer than the coarse grid, for adaptive refinement: a
+        coarse point paints its whole cell (block=subdivide) and refinement
+        points then paint single cells over it. Each layer keeps a 2x2
+        pyramid and the image shows the level matching its on-screen size. """
+
+    def __init__(self, root, title="Band map"):
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+        self.fig = Figure(figsize=(5, 4), dpi=100)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.window)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
+        self.window.withdraw()
+
+        self.feature = None
+        self.plan = None
+        self.values = None
+        self.images = []
+        self.pyramids = []
+        self.block = 1
+        # callable(x, y, z) for clicks on a layer's image
+        self.on_click = None
+        self.layer_of_axes = {}
+        self.canvas.mpl_connect("button_press_event", self.clicked)
+
+    def setup(self, plan, label, feature=None, subdivide=1):
+        """ Allocates the map for the plan's grid and clears the figure;
+            feature turns spectra passed to add() into values. """
+        self.feature = feature
+        self.block = subdivide
+        count_x, count_y, count_z = plan.shape if plan.shape else (1, 1, 1)
+        cells_x = (count_x - 1) * subdivide + 1
+        cells_y = (count_y - 1) * subdivide + 1
+        x1, step_x = plan.grid_axis(0)
+        y1, step_y = plan.grid_axis(1)
+        self.origin = np.array([x1, y1])
+        self.step = np.array([step_x, step_y]) / subdivide
+        # layers by grid index k: on a focus surface every point has its own Z
+        self.plan = plan
+        self.layer_z = plan.layer_means()
+        self.values = np.full((len(self.layer_z), cells_y, cells_x), np.nan, dtype=np.float32)
+        self.low = np.inf
+        self.high = -np.inf
+
+        self.fig.clear()
+        self.images = []
+        self.pyramids = [ImagePyramid(layer) for layer in self.values]
+        self.layer_of_axes = {}
+        columns = math.ceil(math.sqrt(len(self.layer_z)))
+        rows = math.ceil(len(self.layer_z) / columns)
+        step_x, step_y = self.step
+        extent = (
+            x1 - step_x / 2, x1 + (cells_x - 0.5) * step_x,
+            y1 - step_y / 2, y1 + (cells_y - 0.5) * step_y,
+        )
+        for k, z in enumerate(self.layer_z):
+            ax = self.fig.add_subplot(rows, columns, k + 1)
+            self.layer_of_axes[ax] = k
+            image = ax.imshow(self.display_level(k, ax), origin="lower", extent=extent, interpolation="nearest", cmap="viridis")
+            ax.set_title(f"Layer {k + 1}, Z {z:g}", fontsize=8)
+            self.images.append(image)
+        if self.images:
+            self.fig.colorbar(self.images[0], ax=self.fig.axes, label=label)
+        self.canvas.draw_idle()
+
+    def add(self, position, spectrum):
+        if self.values is not None:
+            self.add_value(position, float(self.feature.value(spectrum)))
+
+    def add_value(self, position, value):
+        if self.values is None or None in position or not np.isfinite(value):
+            return
+
+        x, y, z = position
+        k = int(self.plan.layer_of((x, y, z))[0])
+        i, j = np.rint((np.array([x, y]) - self.origin) / self.step).astype(int)
+        layer = self.values[k]
+        if not (0 <= i < layer.shape[1] and 0 <= j < layer.shape[0]):
+            return
+        # a coarse cell on the last row/column is cut off by the map edge
+        y1 = min(j + self.block, layer.shape[0])
+        x1 = min(i + self.block, layer.shape[1])
+        layer[j:y1, i:x1] = value
+        self.pyramids[k].update(j, y1, i, x1)
+
+        if value < self.low or value > self.high:
+            # rescale every layer to the common range
+            self.low = min(self.low, value)
+            self.high = max(self.high, value)
+            for image in self.images:
+                image.set_clim(self.low, self.high if self.high > self.low else self.low + 1)
+        self.images[k].set_data(self.display_level(k, self.images[k].axes))
+        self.canvas.draw_idle()
+
+    def display_level(self, k, ax):
+        """ Pyramid level of layer k with about one cell per pixel of ax. """
+        size = ax.get_window_extent()
+        pyramid = self.pyramids[k]
+        cells_y, cells_x = self.values[k].shape
+        level = min(pyramid.level_for(cells_x, size.width), pyramid.level_for(cells_y, size.height))
+        return pyramid.levels[level]
+
+    def clicked(self, event):
+        if self.on_click and event.inaxes in self.layer_of_axes and event.xdata is not None:
+            k = self.layer_of_axes[event.inaxes]
+            z = self.plan.layer_heights((event.xdata, event.ydata))[k, 0]
+            self.on_click(event.xdata, event.ydata, z)
+
+    def toggle(self):
+        if self.window.winfo_ismapped():
+            self.window.withdraw()
+        else:
+            self.window.deiconify()
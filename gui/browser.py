@@ -0,0 +1,166 @@
+import os
+import threading
+import tkinter as tk
+from tkinter import ttk, filedialog
+import numpy as np
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+from matplotlib.widgets import RectangleSelector
+from analysis.hypercube import HypercubeReader, convert_csv, cube_dir_for
+
+
+class ScanBrowserWindow:
+    """ Browses a stored scan: the map shows each point's mean value, a
+        click plots that point's spectrum and a drag plots the mean of the
+        dragged region. Spectra are read from the memory-mapped cube. """
+
+    def __init__(self, root, log=print):
+        self.root = root
+        self.log = log
+        self.cube = None
+        self.pyramid = None
+        self.layers = []
+        self.layer = None
+
+        self.window = tk.Toplevel(root)
+        self.window.title("Scan browser")
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+
+        toolbar = ttk.Frame(self.window)
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        self.open_button = ttk.Button(toolbar, text="Open scan", command=self.open)
+        self.open_button.pack(side=tk.LEFT, padx=5, pady=5)
+        self.layer_combobox = ttk.Combobox(toolbar, state="readonly", width=14)
+        self.layer_combobox.pack(side=tk.LEFT, padx=5, pady=5)
+        self.layer_combobox.bind("<<ComboboxSelected>>", lambda e: self.show_layer())
+        self.status_label = ttk.Label(toolbar, text="No scan")
+        self.status_label.pack(side=tk.LEFT, padx=5, pady=5)
+
+        self.fig = Figure(figsize=(9, 4), dpi=100)
+        self.map_ax = self.fig.add_subplot(121)
+        self.spectrum_ax = self.fig.add_subplot(122)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.window)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
+        self.image = None
+        # drags select a region; clicks (no drag) are handled on release
+        self.selector = RectangleSelector(self.map_ax, self.selected, useblit=True, button=[1], minspanx=3, minspany=3, spancoords="pixels")
+        self.press = None
+        self.canvas.mpl_connect("button_press_event", self.pressed)
+        self.canvas.mpl_connect("button_release_event", self.released)
+        self.window.withdraw()
+
+    def toggle(self):
+        if self.window.winfo_ismapped():
+            self.window.withdraw()
+        else:
+            self.window.deiconify()
+
+    def open(self):
+        path = filedialog.askopenfilename(filetypes=[("Scan", "*.csv *.npy"), ("All files", "*.*")])
+        if not path:
+            return
+        if path.endswith(".npy"):
+            self.load(os.path.dirname(path))
+        elif os.path.isfile(os.path.join(cube_dir_for(path), "spectra.npy")):
+            self.load(cube_dir_for(path))
+        else:
+            self.status_label.config(text="Converting...")
+
+            def convert():
+                try:
+                    directory = convert_csv(path)
+                except Exception as e:
+                    self.log(f"Cannot convert {path}: {e}")
+                    return
+                self.root.after(0, lambda: self.load(directory))
+
+            threading.Thread(target=convert, daemon=True).start()
+
+    def load(self, directory):
+        try:
+            self.cube = HypercubeReader(directory)
+        except Exception as e:
+            self.log(f"Cannot open {directory}: {e}")
+            return
+        self.layers = self.cube.layers()
+        labels = [f"{k + 1}: Z {self.cube.layer_z(k):g}" for k in self.layers]
+        self.layer_combobox.config(values=labels)
+        self.layer_combobox.set(labels[0] if labels else "")
+        self.status_label.config(text=f"{len(self.cube)} spectra")
+        self.show_layer()
+
+    def show_layer(self):
+        if self.cube is None or not self.layer_combobox.get():
+            return
+        self.layer = int(self.layers[self.layer_combobox.current()])
+        self.pyramid, xs, ys = self.cube.mean_pyramid(self.layer)
+        # cell (row, col) of level 0 is centred on (ys[row], xs[col])
+        self.origin = np.array([xs[0], ys[0]])
+        self.step = np.array([
+            (xs[-1] - xs[0]) / (len(xs) - 1) if len(xs) > 1 else 1.0,
+            (ys[-1] - ys[0]) / (len(ys) - 1) if len(ys) > 1 else 1.0,
+        ])
+
+        self.map_ax.clear()
+        full = (xs[0] - self.step[0] / 2, xs[-1] + self.step[0] / 2, ys[0] - self.step[1] / 2, ys[-1] + self.step[1] / 2)
+        top = self.pyramid.levels[-1]
+        self.image = self.map_ax.imshow(top, origin="lower", extent=full, interpolation="nearest", cmap="viridis", aspect="auto")
+        self.image.set_clim(np.nanmin(top), np.nanmax(top))
+        self.map_ax.set_xlim(full[0], full[1])
+        self.map_ax.set_ylim(full[2], full[3])
+        self.map_ax.set_autoscale_on(False)
+        self.map_ax.set_title(f"Mean counts, layer {self.layer_combobox.get()}", fontsize=9)
+        self.map_ax.callbacks.connect("xlim_changed", lambda ax: self.show_view())
+        self.map_ax.callbacks.connect("ylim_changed", lambda ax: self.show_view())
+        self.show_view()
+
+    def show_view(self):
+        """ Draws the visible part of the pyramid level matching the zoom. """
+        (x1, x2), (y1, y2) = sorted(self.map_ax.get_xlim()), sorted(self.map_ax.get_ylim())
+        size = self.map_ax.get_window_extent()
+        level = min(
+            self.pyramid.level_for((x2 - x1) / abs(self.step[0]), size.width),
+            self.pyramid.level_for(abs(y2 - y1) / abs(self.step[1]), size.height))
+        data = self.pyramid.levels[level]
+        cell = self.step * 2 ** level
+        # level cell n covers level-0 cells n * 2**level ... (n + 1) * 2**level - 1
+        low = self.origin - self.step / 2
+        columns = np.clip(np.floor((np.array([x1, x2]) - low[0]) / cell[0]).astype(int) + [0, 1], 0, data.shape[1])
+        rows = np.clip(np.floor((np.array([y1, y2]) - low[1]) / cell[1]).astype(int) + [0, 1], 0, data.shape[0])
+        if columns[0] >= columns[1] or rows[0] >= rows[1]:
+            return
+        self.image.set_data(np.asarray(data[rows[0]:rows[1], columns[0]:columns[1]]))
+        self.image.set_extent((
+            low[0] + columns[0] * cell[0], low[0] + columns[1] * cell[0],
+            low[1] + rows[0] * cell[1], low[1] + rows[1] * cell[1]))
+        self.canvas.draw_idle()
+
+    def pressed(self, event):
+        self.press = (event.x, event.y) if event.inaxes is self.map_ax else None
+
+    def released(self, event):
+        if self.cube is None or self.press is None or event.inaxes is not self.map_ax:
+            return
+        if abs(event.x - self.press[0]) > 3 or abs(event.y - self.press[1]) > 3:
+            return
+        row = self.cube.nearest_in_layer(event.xdata, event.ydata, self.layer)
+        x, y, z = self.cube.positions[row]
+        self.plot(self.cube.spectrum(row), f"X:{x:g} Y:{y:g} Z:{z:g}")
+
+    def selected(self, press, release):
+        if self.cube is None:
+            return
+        x1, y1, x2, y2 = press.xdata, press.ydata, release.xdata, release.ydata
+        if None in (x1, y1, x2, y2):
+            return
+        mean, count = self.cube.mean(self.cube.region_rows(x1, x2, y1, y2, self.layer))
+        if mean is None:
+            self.status_label.config(text="No spectra in region")
+            return
+        self.plot(mean, f"Mean of {count} spectra, X {min(x1, x2):.2f}..{max(x1, x2):.2f} Y {min(y1, y2):.2f}..{max(y1, y2):.2f}")
+
+    def plot(self, spectrum, title):
+        self.spectrum_ax.clear()
+        self.spectrum_ax.plot(self.cube.wavelengths, spectrum)
+        self.spectrum_ax.set_title(title, fontsize=9)
+        self.canvas.draw_idle()
@@ -0,0 +1,25 @@
+import tkinter as tk
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+
+
+class SpectrumWindow:
+    """ Window plotting a stored spectrum picked from a map. """
+
+    def __init__(self, root, title="Point spectrum"):
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+        self.fig = Figure(figsize=(5, 4), dpi=100)
+        self.ax = self.fig.add_subplot(111)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.window)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
+        self.window.withdraw()
+
+    def show(self, wavelengths, spectrum, title):
+        self.ax.clear()
+        self.ax.plot(wavelengths, spectrum)
+        self.ax.set_title(title, fontsize=9)
+        self.canvas.draw_idle()
+        if not self.window.winfo_ismapped():
+            self.window.deiconify()
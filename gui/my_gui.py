@@ -1,8 +1,24 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog
+import os
 import time
 import threading
 import numpy as np
+from scan.references import DriftMonitor, ReferenceScheduler
+from scan.journal import ScanJournal
+from scan.refine import AdaptiveRefiner
+from scan.region import PolygonRegion
+from scan.plan import ScanPlan, MOVE, SETTLE, ACQUIRE, REFERENCE
+from scan.estimate import ScanEstimator, ScanProgress, format_duration, format_bytes
+from scan.recovery import FaultRecovery
+from scan.jobs import ScanJob, JobQueue
+from scan.autofocus import FocusSurface, golden_section, peak_counts, band_snr
+from scan.plan import settle_time_ms
+from nir1.bands import BandFeature, parse_band
+from gui.band_map import BandMapWindow
+from gui.inspector import SpectrumWindow
+from gui.browser import ScanBrowserWindow
+from analysis.spatial_index import SpatialIndex
 
 class MyGUI:
     def __init__(self, root, serial_connection, wasatch):
@@ -38,6 +54,25 @@ class MyGUI:
             '5': None,
         }
         self.dark_taken = False
+        # Optional polygon outline (per Z layer) limiting the scanned area
+        self.scan_region = PolygonRegion()
+        # Dark (and optional light) reference positions for automatic references
+        self.reference_positions = {'dark': None, 'light': None}
+        # where queued jobs park the head for a sample change
+        self.park_position = None
+        self.drift_monitor = DriftMonitor(blocked_pixels=self.wasatch.blocked_pixels())
+        self.reference_scheduler = ReferenceScheduler(self.drift_monitor)
+        # Duration/size estimate; per-point overhead is learned from finished scans
+        self.estimator = ScanEstimator()
+        self.scan_progress = None
+        # Reconnects dropped spectrometer/CNC links instead of stopping the scan
+        self.recovery = FaultRecovery(wasatch.args.recovery_attempts, budget_s=wasatch.args.recovery_budget_s)
+        # G54/G92 offsets of the running scan, re-applied after a CNC reconnect
+        self.scan_offsets = None
+        # Scans run back-to-back by "Run queue"
+        self.job_queue = JobQueue()
+        # Best-focus Z per region, followed by the scan when enabled
+        self.focus_surface = FocusSurface()
 
 
         self.integration_time = 10
@@ -45,17 +80,29 @@ class MyGUI:
         self.boxcar_half_width = 0
         self.delay_ms = 1000
         self.max_spectra = 0
+        self.correction = wasatch.args.correction
+        self.reference_average = wasatch.args.reference_average
+        self.target_snr = wasatch.args.target_snr
+        self.max_point_ms = wasatch.args.max_point_ms
 
         self.samples_count_x = 1
         self.samples_count_y = 1
         self.samples_count_z = 1
 
         self.output_file = None
+        # Re-acquisitions allowed for a point flagged by the scan statistics
+        self.max_reacquire = 1
 
         self.setup_ui()
         self.running = False
         self.paused = False
         self.measure_thread = threading.Thread()
+        self.journal = None
+        self.band_feature = None
+        self.wasatch.reading_listeners.append(self.on_reading)
+        # Stop also ends a scan's wait for the detector temperature; manual
+        # readings (Run once, references) run on the GUI thread
+        self.wasatch.keep_going = lambda: self.running or threading.current_thread() is not self.measure_thread
 
     def setup_ui(self):
 
@@ -189,6 +236,94 @@ class MyGUI:
         self.log_text = scrolledtext.ScrolledText(self.log_frame, wrap=tk.WORD, height=8, width=50)
         self.log_text.pack(fill=tk.BOTH, expand=True)
 
+        # Scan region frame
+        self.region_frame = ttk.LabelFrame(self.left_frame, text="Scan region (polygon)")
+        self.region_frame.grid(row=6, column=0, padx=10, pady=5, sticky="ew")
+
+        self.add_vertex_button = ttk.Button(self.region_frame, text="Add vertex", command=self.add_region_vertex)
+        self.add_vertex_button.grid(row=0, column=0, padx=10, pady=5)
+
+        self.import_region_button = ttk.Button(self.region_frame, text="Import outline", command=self.import_region)
+        self.import_region_button.grid(row=0, column=1, padx=10, pady=5)
+
+        self.clear_region_button = ttk.Button(self.region_frame, text="Clear", command=self.clear_region)
+        self.clear_region_button.grid(row=0, column=2, padx=10, pady=5)
+
+        self.region_label = ttk.Label(self.region_frame, text="Whole box")
+        self.region_label.grid(row=1, column=0, columnspan=3, padx=10, pady=5)
+
+        # Live band map frame
+        self.band_map_frame = ttk.LabelFrame(self.left_frame, text="Live band map")
+        self.band_map_frame.grid(row=7, column=0, padx=10, pady=5, sticky="ew")
+
+        self.band_label = ttk.Label(self.band_map_frame, text="Band start:stop")
+        self.band_label.grid(row=0, column=0, padx=10, pady=5)
+        self.band_entry = ttk.Entry(self.band_map_frame)
+        self.band_entry.grid(row=0, column=1, padx=10, pady=5)
+
+        self.reference_band_label = ttk.Label(self.band_map_frame, text="Ratio to band (optional)")
+        self.reference_band_label.grid(row=1, column=0, padx=10, pady=5)
+        self.reference_band_entry = ttk.Entry(self.band_map_frame)
+        self.reference_band_entry.grid(row=1, column=1, padx=10, pady=5)
+
+        self.toggle_band_map_button = ttk.Button(self.band_map_frame, text="Show map", command=self.toggle_band_map)
+        self.toggle_band_map_button.grid(row=0, column=2, rowspan=2, padx=10, pady=5)
+        self.band_map = BandMapWindow(self.root)
+        self.band_map.on_click = self.inspect_point
+        self.spectrum_window = SpectrumWindow(self.root)
+        self.spatial_index = None
+
+        self.load_model_button = ttk.Button(self.band_map_frame, text="Load model", command=self.load_model)
+        self.load_model_button.grid(row=2, column=0, padx=10, pady=5)
+        self.model_label = ttk.Label(self.band_map_frame, text=os.path.basename(self.wasatch.args.model or "") or "No model")
+        self.model_label.grid(row=2, column=1, padx=10, pady=5)
+        self.toggle_prediction_map_button = ttk.Button(self.band_map_frame, text="Show predictions", command=self.toggle_prediction_map)
+        self.toggle_prediction_map_button.grid(row=2, column=2, padx=10, pady=5)
+        self.browse_button = ttk.Button(self.band_map_frame, text="Scan browser", command=self.toggle_browser)
+        self.browse_button.grid(row=3, column=0, padx=10, pady=5)
+        self.browser = ScanBrowserWindow(self.root, self.log)
+
+        # Autofocus: best Z per XY from a search over Z, one Z per XY in the scan
+        self.autofocus_frame = ttk.LabelFrame(self.left_frame, text="Autofocus")
+        self.autofocus_frame.grid(row=8, column=0, padx=10, pady=5, sticky="ew")
+
+        self.focus_range_label = ttk.Label(self.autofocus_frame, text="Z range min:max (empty = pos. 1/5)")
+        self.focus_range_label.grid(row=0, column=0, padx=10, pady=5)
+        self.focus_range_entry = ttk.Entry(self.autofocus_frame)
+        self.focus_range_entry.grid(row=0, column=1, padx=10, pady=5)
+
+        self.focus_count_label = ttk.Label(self.autofocus_frame, text="Focus points per axis")
+        self.focus_count_label.grid(row=1, column=0, padx=10, pady=5)
+        self.focus_count_entry = ttk.Entry(self.autofocus_frame)
+        self.focus_count_entry.grid(row=1, column=1, padx=10, pady=5)
+        self.focus_count_entry.insert(tk.END, '3')  # Default value
+
+        self.focus_tolerance_label = ttk.Label(self.autofocus_frame, text="Z tolerance")
+        self.focus_tolerance_label.grid(row=2, column=0, padx=10, pady=5)
+        self.focus_tolerance_entry = ttk.Entry(self.autofocus_frame)
+        self.focus_tolerance_entry.grid(row=2, column=1, padx=10, pady=5)
+        self.focus_tolerance_entry.insert(tk.END, '0.05')  # Default value
+
+        self.focus_metric_combobox = ttk.Combobox(self.autofocus_frame, state="readonly", values=["Peak counts", "Band SNR"])
+        self.focus_metric_combobox.grid(row=0, column=2, padx=10, pady=5)
+        self.focus_metric_combobox.set("Peak counts")
+
+        self.follow_surface = tk.BooleanVar(value=False)
+        self.follow_surface_check = ttk.Checkbutton(self.autofocus_frame, text="Scan follows surface", variable=self.follow_surface)
+        self.follow_surface_check.grid(row=1, column=2, padx=10, pady=5)
+
+        self.autofocus_button = ttk.Button(self.autofocus_frame, text="Run autofocus", command=self.start_autofocus)
+        self.autofocus_button.grid(row=3, column=0, padx=10, pady=5)
+        self.clear_focus_button = ttk.Button(self.autofocus_frame, text="Clear", command=self.clear_focus)
+        self.clear_focus_button.grid(row=3, column=1, padx=10, pady=5)
+        self.focus_label = ttk.Label(self.autofocus_frame, text="No focus points")
+        self.focus_label.grid(row=3, column=2, padx=10, pady=5)
+
+        self.prediction_map = BandMapWindow(self.root, "Prediction map")
+        self.prediction_map.on_click = self.inspect_point
+        if self.wasatch.inference:
+            self.wasatch.inference.listeners.append(self.on_prediction)
+
         # Spectrometer connection frame
         self.wasatch_connection_frame = ttk.LabelFrame(self.right_frame, text="Wasatch connection")
         self.wasatch_connection_frame.grid(row=0, column=1, padx=10, pady=5, sticky="nsew")
@@ -266,6 +401,76 @@ class MyGUI:
         self.set_max_spectra_button = ttk.Button(self.wasatch_parameters_frame, text="Set", command=self.set_max_spectra)
         self.set_max_spectra_button.grid(row=6, column=2, padx=10, pady=5)
 
+        # Dark/light correction control
+        self.correction_label = ttk.Label(self.wasatch_parameters_frame, text="Correction:")
+        self.correction_label.grid(row=7, column=0, padx=10, pady=5)
+        self.correction_combobox = ttk.Combobox(self.wasatch_parameters_frame, values=self.wasatch.corrector.MODES, state="readonly")
+        self.correction_combobox.grid(row=7, column=1, padx=10, pady=5)
+        self.correction_combobox.set(self.correction)
+
+        self.reference_average_label = ttk.Label(self.wasatch_parameters_frame, text="Readings per Reference:")
+        self.reference_average_label.grid(row=8, column=0, padx=10, pady=5)
+        self.reference_average_entry = ttk.Entry(self.wasatch_parameters_frame)
+        self.reference_average_entry.grid(row=8, column=1, padx=10, pady=5)
+        self.reference_average_entry.insert(tk.END, str(self.reference_average))  # Default value
+
+        self.set_correction_button = ttk.Button(self.wasatch_parameters_frame, text="Set", command=self.set_correction)
+        self.set_correction_button.grid(row=7, column=2, rowspan=2, padx=10, pady=5)
+
+        # SNR-driven averaging control
+        self.target_snr_label = ttk.Label(self.wasatch_parameters_frame, text="Target SNR (0 = off):")
+        self.target_snr_label.grid(row=9, column=0, padx=10, pady=5)
+        self.target_snr_entry = ttk.Entry(self.wasatch_parameters_frame)
+        self.target_snr_entry.grid(row=9, column=1, padx=10, pady=5)
+        self.target_snr_entry.insert(tk.END, str(self.target_snr))  # Default value
+
+        self.max_point_ms_label = ttk.Label(self.wasatch_parameters_frame, text="Max Time per Point (ms):")
+        self.max_point_ms_label.grid(row=10, column=0, padx=10, pady=5)
+        self.max_point_ms_entry = ttk.Entry(self.wasatch_parameters_frame)
+        self.max_point_ms_entry.grid(row=10, column=1, padx=10, pady=5)
+        self.max_point_ms_entry.insert(tk.END, str(self.max_point_ms))  # Default value
+
+        self.set_adaptive_averaging_button = ttk.Button(self.wasatch_parameters_frame, text="Set", command=self.set_adaptive_averaging)
+        self.set_adaptive_averaging_button.grid(row=9, column=2, rowspan=2, padx=10, pady=5)
+
+        # Auto-exposure control
+        self.auto_exposure = tk.BooleanVar(value=self.wasatch.args.auto_exposure)
+        self.auto_exposure_check = ttk.Checkbutton(self.wasatch_parameters_frame, text="Auto exposure, target (%):", variable=self.auto_exposure)
+        self.auto_exposure_check.grid(row=11, column=0, padx=10, pady=5)
+        self.exposure_target_entry = ttk.Entry(self.wasatch_parameters_frame)
+        self.exposure_target_entry.grid(row=11, column=1, padx=10, pady=5)
+        self.exposure_target_entry.insert(tk.END, str(int(self.wasatch.args.exposure_target * 100)))  # Default value
+
+        self.set_auto_exposure_button = ttk.Button(self.wasatch_parameters_frame, text="Set", command=self.set_auto_exposure)
+        self.set_auto_exposure_button.grid(row=11, column=2, padx=10, pady=5)
+
+        # Raw archive control
+        self.archive_label = ttk.Label(self.wasatch_parameters_frame, text="Raw archive (.nirz):")
+        self.archive_label.grid(row=12, column=0, padx=10, pady=5)
+        self.archive_combobox = ttk.Combobox(self.wasatch_parameters_frame, values=("off", "zlib", "lzma"), state="readonly")
+        self.archive_combobox.grid(row=12, column=1, padx=10, pady=5)
+        self.archive_combobox.set(self.wasatch.args.archive or "off")
+
+        self.set_archive_button = ttk.Button(self.wasatch_parameters_frame, text="Set", command=self.set_archive)
+        self.set_archive_button.grid(row=12, column=2, padx=10, pady=5)
+
+        # Acquisition-time crop/resample control
+        self.resample_label = ttk.Label(self.wasatch_parameters_frame, text="Resample start:stop:step:")
+        self.resample_label.grid(row=13, column=0, padx=10, pady=5)
+        self.resample_entry = ttk.Entry(self.wasatch_parameters_frame)
+        self.resample_entry.grid(row=13, column=1, padx=10, pady=5)
+        self.resample_entry.insert(tk.END, self.wasatch.args.resample or '')  # Default value (empty = off)
+
+        self.resample_mode_combobox = ttk.Combobox(self.wasatch_parameters_frame, values=("interpolate", "bin"), state="readonly")
+        self.resample_mode_combobox.grid(row=14, column=0, padx=10, pady=5)
+        self.resample_mode_combobox.set(self.wasatch.args.resample_mode)
+        self.resample_axis_combobox = ttk.Combobox(self.wasatch_parameters_frame, values=("nm", "wavenumber"), state="readonly")
+        self.resample_axis_combobox.grid(row=14, column=1, padx=10, pady=5)
+        self.resample_axis_combobox.set(self.wasatch.args.resample_axis)
+
+        self.set_resample_button = ttk.Button(self.wasatch_parameters_frame, text="Set", command=self.set_resample)
+        self.set_resample_button.grid(row=13, column=2, rowspan=2, padx=10, pady=5)
+
         # Measuring frame
         self.wasatch_measure_frame = ttk.LabelFrame(self.right_frame, text="Measuring")
         self.wasatch_measure_frame.grid(row=3, column=1, padx=10, pady=5, sticky="nsew")
@@ -288,6 +493,22 @@ class MyGUI:
         self.wasatch_samples_countZ_entry.grid(row=2, column=2, padx=10, pady=5)
         self.wasatch_samples_countZ_entry.insert(tk.END, '1')  # Default value
 
+        self.adaptive_scan = tk.BooleanVar(value=False)
+        self.adaptive_scan_check = ttk.Checkbutton(self.wasatch_measure_frame, text="Adaptive refinement", variable=self.adaptive_scan)
+        self.adaptive_scan_check.grid(row=0, column=3, padx=10, pady=5)
+
+        self.refine_threshold_label = ttk.Label(self.wasatch_measure_frame, text="Refine threshold")
+        self.refine_threshold_label.grid(row=1, column=3, padx=10, pady=5)
+        self.refine_threshold_entry = ttk.Entry(self.wasatch_measure_frame, width=8)
+        self.refine_threshold_entry.grid(row=1, column=4, padx=10, pady=5)
+        self.refine_threshold_entry.insert(tk.END, '0.05')  # Default value
+
+        self.refine_depth_label = ttk.Label(self.wasatch_measure_frame, text="Refine levels")
+        self.refine_depth_label.grid(row=2, column=3, padx=10, pady=5)
+        self.refine_depth_entry = ttk.Entry(self.wasatch_measure_frame, width=8)
+        self.refine_depth_entry.grid(row=2, column=4, padx=10, pady=5)
+        self.refine_depth_entry.insert(tk.END, '2')  # Default value
+
         self.wasatch_dark_button = ttk.Button(self.wasatch_measure_frame, text = "Dark", command=self.run_dark)
         self.wasatch_dark_button.grid(row=3, column=0, columnspan=2, padx=5, pady=5)
 
@@ -323,6 +544,9 @@ class MyGUI:
         self.wasatch_stop_button = ttk.Button(self.wasatch_measure_frame, text = "Stop", command=self.stop_measurement)
         self.wasatch_stop_button.grid(row=6, column=2, columnspan=2, padx=5, pady=5)
 
+        self.resume_button = ttk.Button(self.wasatch_measure_frame, text = "Resume scan", command=self.resume_measurement)
+        self.resume_button.grid(row=6, column=4, columnspan=2, padx=5, pady=5)
+
         self.pause_button = ttk.Button(
             self.wasatch_measure_frame,
             text="Pause for reference",
@@ -337,6 +561,102 @@ class MyGUI:
         )
         self.continue_button.grid(row=7, column=2, columnspan=2, padx=5, pady=5)
 
+        self.estimate_button = ttk.Button(self.wasatch_measure_frame, text="Estimate", command=self.estimate_scan)
+        self.estimate_button.grid(row=8, column=0, columnspan=2, padx=5, pady=5)
+        self.estimate_label = ttk.Label(self.wasatch_measure_frame, text="")
+        self.estimate_label.grid(row=8, column=2, columnspan=3, padx=10, pady=5)
+
+        # Automatic drift-triggered references
+        self.auto_reference_frame = ttk.LabelFrame(self.right_frame, text="Automatic references")
+        self.auto_reference_frame.grid(row=4, column=1, padx=10, pady=5, sticky="ew")
+
+        self.auto_reference = tk.BooleanVar(value=False)
+        self.auto_reference_check = ttk.Checkbutton(self.auto_reference_frame, text="Enabled", variable=self.auto_reference)
+        self.auto_reference_check.grid(row=0, column=0, padx=10, pady=5)
+
+        self.set_dark_reference_button = ttk.Button(self.auto_reference_frame, text="Set dark ref", command=lambda: self.set_reference_position('dark'))
+        self.set_dark_reference_button.grid(row=0, column=1, padx=5, pady=5)
+
+        self.set_light_reference_button = ttk.Button(self.auto_reference_frame, text="Set light ref", command=lambda: self.set_reference_position('light'))
+        self.set_light_reference_button.grid(row=0, column=2, padx=5, pady=5)
+
+        self.reference_at_start = tk.BooleanVar(value=False)
+        self.reference_at_start_check = ttk.Checkbutton(self.auto_reference_frame, text="Before each job", variable=self.reference_at_start)
+        self.reference_at_start_check.grid(row=0, column=3, padx=10, pady=5)
+
+        self.max_temperature_drift_label = ttk.Label(self.auto_reference_frame, text="Max temp. drift (degC):")
+        self.max_temperature_drift_label.grid(row=1, column=0, padx=10, pady=5)
+        self.max_temperature_drift_entry = ttk.Entry(self.auto_reference_frame)
+        self.max_temperature_drift_entry.grid(row=1, column=1, padx=10, pady=5)
+        self.max_temperature_drift_entry.insert(tk.END, str(self.drift_monitor.max_temperature_drift_degC))  # Default value
+
+        self.max_interval_label = ttk.Label(self.auto_reference_frame, text="Max interval (min):")
+        self.max_interval_label.grid(row=2, column=0, padx=10, pady=5)
+        self.max_interval_entry = ttk.Entry(self.auto_reference_frame)
+        self.max_interval_entry.grid(row=2, column=1, padx=10, pady=5)
+        self.max_interval_entry.insert(tk.END, str(self.drift_monitor.max_interval_s / 60))  # Default value
+
+        self.max_dark_drift_label = ttk.Label(self.auto_reference_frame, text="Max dark drift (%):")
+        self.max_dark_drift_label.grid(row=3, column=0, padx=10, pady=5)
+        self.max_dark_drift_entry = ttk.Entry(self.auto_reference_frame)
+        self.max_dark_drift_entry.grid(row=3, column=1, padx=10, pady=5)
+        self.max_dark_drift_entry.insert(tk.END, str(self.drift_monitor.max_dark_drift * 100))  # Default value
+
+        # Unattended job queue
+        self.job_queue_frame = ttk.LabelFrame(self.right_frame, text="Job queue")
+        self.job_queue_frame.grid(row=5, column=1, padx=10, pady=5, sticky="ew")
+
+        self.job_name_label = ttk.Label(self.job_queue_frame, text="Job name:")
+        self.job_name_label.grid(row=0, column=0, padx=10, pady=5)
+        self.job_name_entry = ttk.Entry(self.job_queue_frame)
+        self.job_name_entry.grid(row=0, column=1, padx=10, pady=5)
+
+        self.sample_change = tk.BooleanVar(value=True)
+        self.sample_change_check = ttk.Checkbutton(self.job_queue_frame, text="Sample change before", variable=self.sample_change)
+        self.sample_change_check.grid(row=0, column=2, padx=10, pady=5)
+
+        self.add_job_button = ttk.Button(self.job_queue_frame, text="Add current scan", command=self.enqueue_job)
+        self.add_job_button.grid(row=1, column=0, padx=5, pady=5)
+        self.load_jobs_button = ttk.Button(self.job_queue_frame, text="Load jobs", command=self.load_jobs)
+        self.load_jobs_button.grid(row=1, column=1, padx=5, pady=5)
+        self.run_queue_button = ttk.Button(self.job_queue_frame, text="Run queue", command=self.run_queue)
+        self.run_queue_button.grid(row=1, column=2, padx=5, pady=5)
+        self.clear_queue_button = ttk.Button(self.job_queue_frame, text="Clear", command=self.clear_queue)
+        self.clear_queue_button.grid(row=1, column=3, padx=5, pady=5)
+        self.set_park_button = ttk.Button(self.job_queue_frame, text="Set park", command=self.set_park_position)
+        self.set_park_button.grid(row=0, column=3, padx=5, pady=5)
+
+        self.queue_label = ttk.Label(self.job_queue_frame, text="")
+        self.queue_label.grid(row=2, column=0, columnspan=4, padx=10, pady=5)
+        self.update_queue_label()
+
+        # Time series at the current head position
+        self.series_frame = ttk.LabelFrame(self.right_frame, text="Time series")
+        self.series_frame.grid(row=6, column=1, padx=10, pady=5, sticky="ew")
+
+        self.series_period_label = ttk.Label(self.series_frame, text="Period (ms, 0 = max rate):")
+        self.series_period_label.grid(row=0, column=0, padx=10, pady=5)
+        self.series_period_entry = ttk.Entry(self.series_frame, width=10)
+        self.series_period_entry.grid(row=0, column=1, padx=10, pady=5)
+        self.series_period_entry.insert(tk.END, '1000')  # Default value
+
+        self.series_count_label = ttk.Label(self.series_frame, text="Spectra (0 = no limit):")
+        self.series_count_label.grid(row=1, column=0, padx=10, pady=5)
+        self.series_count_entry = ttk.Entry(self.series_frame, width=10)
+        self.series_count_entry.grid(row=1, column=1, padx=10, pady=5)
+        self.series_count_entry.insert(tk.END, '100')  # Default value
+
+        self.series_duration_label = ttk.Label(self.series_frame, text="Duration (s, 0 = no limit):")
+        self.series_duration_label.grid(row=2, column=0, padx=10, pady=5)
+        self.series_duration_entry = ttk.Entry(self.series_frame, width=10)
+        self.series_duration_entry.grid(row=2, column=1, padx=10, pady=5)
+        self.series_duration_entry.insert(tk.END, '0')  # Default value
+
+        self.series_button = ttk.Button(self.series_frame, text="Start series", command=self.start_series)
+        self.series_button.grid(row=0, column=2, padx=5, pady=5)
+        self.series_label = ttk.Label(self.series_frame, text="")
+        self.series_label.grid(row=3, column=0, columnspan=3, padx=10, pady=5)
+
         # list of widgets disabled during a long scan
         self.disable_on_run = [
             self.connect_button,
@@ -356,6 +676,26 @@ class MyGUI:
             self.goto_button_5,
             self.test_button,
             self.init_button,
+            self.resume_button,
+            self.adaptive_scan_check,
+            self.add_vertex_button,
+            self.import_region_button,
+            self.clear_region_button,
+            self.set_dark_reference_button,
+            self.set_light_reference_button,
+            self.add_job_button,
+            self.load_jobs_button,
+            self.run_queue_button,
+            self.clear_queue_button,
+            self.set_park_button,
+            self.reference_at_start_check,
+            self.series_button,
+            self.autofocus_button,
+            self.clear_focus_button,
+            self.resample_entry,
+            self.resample_mode_combobox,
+            self.resample_axis_combobox,
+            self.set_resample_button,
         ]
 
 
@@ -390,7 +730,7 @@ class MyGUI:
 
     def enable_controls(self):
         for w in self.disable_on_run:
-            w.config(state=tk.NORMAL)
+            w.config(state="readonly" if isinstance(w, ttk.Combobox) else tk.NORMAL)
         for frame in [self.control_frame, self.step_speed_frame]:
             for child in frame.winfo_children():
                 child.config(state=tk.NORMAL)
@@ -416,6 +756,103 @@ class MyGUI:
             self.toggle_points_button.config(text="Show points")
         self.wasatch.toggle_points_window()
 
+    def toggle_band_map(self):
+        if self.toggle_band_map_button["text"] == "Show map":
+            self.toggle_band_map_button.config(text="Hide map")
+        else:
+            self.toggle_band_map_button.config(text="Show map")
+        self.band_map.toggle()
+
+    def toggle_prediction_map(self):
+        if self.toggle_prediction_map_button["text"] == "Show predictions":
+            self.toggle_prediction_map_button.config(text="Hide predictions")
+        else:
+            self.toggle_prediction_map_button.config(text="Show predictions")
+        self.prediction_map.toggle()
+
+    def toggle_browser(self):
+        self.browser.toggle()
+
+    def load_model(self):
+        if self.running:
+            self.log("Stop the running scan first")
+            return
+        path = filedialog.askopenfilename(filetypes=[("Model", "*.joblib *.pkl *.pickle"), ("All files", "*.*")])
+        if not path:
+            return
+        if self.wasatch.set_model(path):
+            if self.on_prediction not in self.wasatch.inference.listeners:
+                self.wasatch.inference.listeners.append(self.on_prediction)
+            self.model_label.config(text=os.path.basename(path))
+            self.log(f"Model loaded: {path}")
+        else:
+            self.model_label.config(text="No model")
+            self.log(f"Cannot load model {path}")
+
+    def setup_band_map(self, plan, subdivide=1):
+        """ Picks the band feature and resets both maps for the plan; called
+            on the measurement thread, so the figures are rebuilt on the
+            GUI thread, ahead of the values posted by on_reading. """
+        self.band_feature = None
+        model = os.path.basename(self.wasatch.args.model) if self.wasatch.inference else None
+        feature = None
+        if self.wasatch.device is not None:
+            try:
+                band = parse_band(self.band_entry.get())
+                if band is not None:
+                    feature = BandFeature(self.wasatch.output_axis(), band, parse_band(self.reference_band_entry.get()))
+            except ValueError as e:
+                self.log(f"Band map disabled: {e}")
+        self.root.after(0, self.setup_maps, plan, subdivide, model, feature)
+        self.band_feature = feature
+
+    def setup_maps(self, plan, subdivide, model, feature):
+        self.band_map.values = None
+        self.prediction_map.values = None
+        if model:
+            self.prediction_map.setup(plan, model, subdivide=subdivide)
+        if feature is not None:
+            self.band_map.setup(plan, feature.name(), feature, subdivide)
+
+    def update_spatial_index(self):
+        """ Index of the current output file, extended with the rows
+            written since the last call. """
+        path = self.wasatch.args.outfile
+        if not path or not os.path.isfile(path):
+            return None
+        if self.spatial_index is None or self.spatial_index.csv_path != path:
+            if self.spatial_index:
+                self.spatial_index.close()
+            self.spatial_index = SpatialIndex(path)
+        else:
+            self.spatial_index.update()
+        return self.spatial_index
+
+    def inspect_point(self, x, y, z):
+        if self.wasatch.outfile and not self.wasatch.outfile.closed:
+            self.wasatch.outfile.flush()
+        index = self.update_spatial_index()
+        if index is None or not len(index):
+            self.log("No stored spectra to inspect")
+            return
+        distances, ids = index.nearest((x, y, z))
+        kind, px, py, pz, temperature, spectrum = index.row(ids[0])
+        self.spectrum_window.show(index.wavelengths, spectrum, f"{kind} at X:{px} Y:{py} Z:{pz}")
+
+    def on_reading(self, type, position, spectrum):
+        # called on the measurement thread: only the value is computed here
+        feature = self.band_feature
+        if type in ("scan", "rescan") and feature is not None:
+            self.root.after(0, self.band_map.add_value, position, float(feature.value(spectrum)))
+
+    def set_map_block(self, block):
+        self.band_map.block = block
+        self.prediction_map.block = block
+
+    def on_prediction(self, position, value):
+        # called on the inference thread; tkinter and matplotlib need the GUI thread
+        self.root.after(0, self.prediction_map.add_value, position, value)
+
     def show_help(self):
         from tkinter import messagebox
         msg = (
@@ -433,6 +870,26 @@ class MyGUI:
         self.progress_label['text'] = str(progress) + ' %'
         self.root.update_idletasks()
 
+    def estimate_scan(self):
+        if not all(self.user_positions[p] for p in ('1', '2', '4')):
+            self.log('Set positions 1,2,4 and 5 first')
+            return
+        try:
+            plan = self.build_scan_plan()
+        except ValueError as e:
+            self.log(f"Cannot estimate scan: {e}")
+            return
+        pixels = self.wasatch.output_pixels()
+        estimate = self.estimator.estimate(plan, self.wasatch.settings_snapshot(), pixels or 0, self.wasatch.output_files())
+        size = format_bytes(estimate["bytes"]) if pixels else "? (connect spectrometer)"
+        text = f"{estimate['points']} points, ~{format_duration(estimate['seconds'])}, {size}"
+        self.estimate_label.config(text=text)
+        self.log(f"Estimate: {text}")
+
+    def update_eta(self):
+        remaining = self.scan_progress.remaining_s()
+        self.estimate_label.config(text=f"ETA {format_duration(remaining)} (done ~{time.strftime('%H:%M', time.localtime(time.time() + remaining))})")
+
     def set_integration_time(self):
         integration_time = int(self.integration_time_entry.get())
         self.wasatch.set_integration_time(integration_time)
@@ -453,6 +910,32 @@ class MyGUI:
         max_spectra = int(self.max_spectra_entry.get())
         self.wasatch.set_max_spectra(max_spectra)
 
+    def set_resample(self):
+        resample = self.resample_entry.get().strip()
+        if resample and len(resample.split(":")) != 3:
+            self.log("Resample must be start:stop:step")
+            return
+        self.wasatch.set_resample(resample, self.resample_mode_combobox.get(), self.resample_axis_combobox.get())
+
+    def set_archive(self):
+        compressor = self.archive_combobox.get()
+        self.wasatch.set_archive(None if compressor == "off" else compressor)
+
+    def set_auto_exposure(self):
+        target_fraction = float(self.exposure_target_entry.get()) / 100
+        self.wasatch.set_auto_exposure(self.auto_exposure.get(), target_fraction)
+
+    def set_adaptive_averaging(self):
+        target_snr = float(self.target_snr_entry.get())
+        max_point_ms = int(self.max_point_ms_entry.get())
+        self.wasatch.set_adaptive_averaging(target_snr, max_point_ms)
+
+    def set_correction(self):
+        correction = self.correction_combobox.get()
+        reference_average = int(self.reference_average_entry.get())
+        self.wasatch.set_correction(correction, reference_average)
+        self.log(f"Correction: {correction}, {reference_average} reading(s) per reference")
+
     def browse_file_path(self):
         file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
         if file_path:
@@ -477,19 +960,7 @@ class MyGUI:
 
     def calculate_predicted_points(self):
         try:
-            count_x = int(self.wasatch_samples_countX_entry.get())
-            count_y = int(self.wasatch_samples_countY_entry.get())
-            count_z = int(self.wasatch_samples_countZ_entry.get())
-            self.wasatch.set_scan_bounds(
-                self.user_positions['1']['X'], self.user_positions['2']['X'],
-                self.user_positions['1']['Y'], self.user_positions['4']['Y'],
-                self.user_positions['1']['Z'],
-                self.user_positions['5']['Z'] if self.user_positions['5'] else self.user_positions['1']['Z'],
-                self.user_positions,
-                count_x,
-                count_y,
-                count_z,
-            )
+            self.wasatch.set_scan_plan(self.build_scan_plan(), self.user_positions)
             self.log("Points ready")
         except Exception as e:
             self.log(f"Failed to compute points: {e}")
@@ -643,6 +1114,75 @@ class MyGUI:
             self.current_position['Z']
         )
 
+    def set_reference_position(self, kind):
+        self.reference_positions[kind] = self.current_position.copy()
+        self.log(
+            f"{kind.capitalize()} reference position set to X:{self.current_position['X']}, Y:{self.current_position['Y']}, Z:{self.current_position['Z']}."
+        )
+
+    def reference_policy(self):
+        """ Automatic reference settings of the GUI, as stored with a job. """
+        return {
+            "auto": bool(self.auto_reference.get()),
+            "at_start": bool(self.reference_at_start.get()),
+            "dark": self.reference_positions['dark'],
+            "light": self.reference_positions['light'],
+            "max_temperature_drift_degC": float(self.max_temperature_drift_entry.get()),
+            "max_interval_min": float(self.max_interval_entry.get()),
+            "max_dark_drift_pct": float(self.max_dark_drift_entry.get()),
+        }
+
+    def setup_auto_reference(self, policy=None):
+        # a job without a reference policy ({}) takes no references
+        if policy is None:
+            policy = self.reference_policy()
+        if 'dark' in policy:
+            self.reference_positions = {'dark': policy.get('dark'), 'light': policy.get('light')}
+        if not policy.get("auto"):
+            self.reference_scheduler.reference_positions = []
+            return
+        if self.reference_positions['dark'] is None:
+            self.log("Automatic references disabled: set dark reference position first")
+            self.reference_scheduler.reference_positions = []
+            return
+
+        self.drift_monitor.max_temperature_drift_degC = policy.get("max_temperature_drift_degC", self.drift_monitor.max_temperature_drift_degC)
+        self.drift_monitor.max_interval_s = policy.get("max_interval_min", self.drift_monitor.max_interval_s / 60) * 60
+        self.drift_monitor.max_dark_drift = policy.get("max_dark_drift_pct", self.drift_monitor.max_dark_drift * 100) / 100
+        if self.drift_monitor.blocked_pixels is None:
+            self.log("Dark drift trigger off: no blocked detector pixels set (--blocked-pixels)")
+        self.reference_scheduler.reference_positions = [
+            (pos['X'], pos['Y'], pos['Z'])
+            for pos in (self.reference_positions['dark'], self.reference_positions['light'])
+            if pos is not None
+        ]
+        self.reference_scheduler.reference_taken()
+
+    def acquire_auto_reference(self):
+        self.log(f"Automatic reference ({self.drift_monitor.reason()} drift)")
+        for kind in ('dark', 'light'):
+            pos = self.reference_positions[kind]
+            if pos is None:
+                continue
+            if not self.move_absolute(pos['X'], pos['Y'], pos['Z']):
+                return False
+            if not self.wasatch.run_reference(kind, pos['X'], pos['Y'], pos['Z']):
+                return False
+
+        reading = self.wasatch.last_reading
+        self.reference_scheduler.reference_taken(reading.detector_temperature_degC if reading else None)
+        return True
+
+    def move_absolute(self, x, y, z):
+        self.serial.send_gcode('G90')
+        self.serial.send_gcode(f'G1 X{ -x } Y{ -y } Z{ z } F{self.get_speed()}')
+        self.log(f"Moving to position X: {x}, Y: {y}, Z: {z}")
+        if not self.waitForCNC():
+            return False
+        self.current_position = {'X': x, 'Y': y, 'Z': z}
+        self.update_map_position(x, y, z)
+        return True
+
     def goto_position(self, position_number):
         pos = self.user_positions.get(str(position_number))
         if not pos:
@@ -758,114 +1298,631 @@ class MyGUI:
         self.enable_controls()
         return
 
+    def focus_metric(self):
+        """ Function spectrum -> value that autofocus maximises. """
+        if self.focus_metric_combobox.get() != "Band SNR":
+            return peak_counts
+        band = parse_band(self.band_entry.get())
+        if band is None:
+            raise ValueError("set a band in the band map panel for Band SNR")
+        mask = BandFeature(self.wasatch.output_axis(), band).mask
+        return lambda spectrum: band_snr(spectrum, mask)
+
+    def start_autofocus(self):
+        if self.running:
+            self.log("Stop the running scan first")
+            return
+        required = ['1','2','4']
+        if any(self.user_positions.get(k) is None for k in required):
+            self.log('Set positions 1,2 and 4 first')
+            return
+        if not self.serial.connected:
+            self.log('CNC not connected')
+            return
+        if self.wasatch.device is None:
+            self.log('Spectrometer not connected')
+            return
+        try:
+            z_range = parse_band(self.focus_range_entry.get())
+            if z_range is None:
+                first = self.user_positions['1']['Z']
+                last = self.user_positions['5']['Z'] if self.user_positions['5'] else first
+                z_range = (min(first, last), max(first, last))
+            if z_range[1] - z_range[0] <= 0:
+                raise ValueError("empty Z range")
+            count = max(1, int(self.focus_count_entry.get()))
+            tolerance = float(self.focus_tolerance_entry.get())
+            metric = self.focus_metric()
+        except ValueError as e:
+            self.log(f"Cannot run autofocus: {e}")
+            return
+        self.running = True
+        self.disable_controls()
+        self.measure_thread = threading.Thread(target=self.autofocus, args=(z_range, count, tolerance, metric))
+        self.measure_thread.start()
+
+    def autofocus(self, z_range, count, tolerance, metric):
+        """ Golden-section search for the best Z on a count x count grid over
+            the scan area; regions that already have a focus point are
+            skipped. """
+        p = self.user_positions
+        xs = np.linspace(p['1']['X'], p['2']['X'], count)
+        ys = np.linspace(p['1']['Y'], p['4']['Y'], count)
+        if not len(self.focus_surface):
+            # about one focus point per grid cell
+            self.focus_surface.cell_size = max(abs(xs[-1] - xs[0]), abs(ys[-1] - ys[0]), 1.0) / count
+        previous = [self.current_position['Z']]
+
+        for x in xs:
+            for y in ys:
+                if not self.running:
+                    break
+                if self.focus_surface.cached(x, y):
+                    continue
+
+                def measure(z):
+                    if not self.running or not self.move_absolute(float(x), float(y), float(z)):
+                        return None
+                    time.sleep(settle_time_ms(abs(z - previous[0])) / 1000)
+                    previous[0] = z
+                    spectrum = self.wasatch.acquire_spectrum()
+                    return None if spectrum is None else metric(spectrum)
+
+                result = golden_section(measure, z_range[0], z_range[1], tolerance)
+                if result is None:
+                    self.log(f"Autofocus stopped at X: {x:g}, Y: {y:g}")
+                    self.running = False
+                    break
+                z, value, evaluations = result
+                self.focus_surface.add(x, y, z, value)
+                self.log(f"Focus X: {x:g}, Y: {y:g} -> Z: {z:.3f} ({len(evaluations)} measurements, metric {value:.4g})")
+
+        self.running = False
+        self.root.after(0, self.update_focus_label)
+        self.root.after(0, self.enable_controls)
+
+    def update_focus_label(self):
+        if not len(self.focus_surface):
+            self.focus_label.config(text="No focus points")
+            return
+        zs = [point[2] for point in self.focus_surface.points.values()]
+        self.focus_label.config(text=f"{len(zs)} focus points, Z {min(zs):.3f}..{max(zs):.3f}")
+
+    def clear_focus(self):
+        self.focus_surface.clear()
+        self.update_focus_label()
+
+    def start_series(self):
+        if self.running:
+            self.log("Stop the running scan first")
+            return
+        try:
+            period_ms = float(self.series_period_entry.get())
+            count = int(self.series_count_entry.get())
+            duration_s = float(self.series_duration_entry.get())
+        except ValueError as e:
+            self.log(f"Invalid time series settings: {e}")
+            return
+        self.ensure_file_path()
+        if self.wasatch.outfile is None or self.wasatch.outfile.closed:
+            self.wasatch.init_file()
+        self.wasatch.position = (
+            self.current_position['X'],
+            self.current_position['Y'],
+            self.current_position['Z'],
+        )
+        self.running = True
+        self.disable_controls()
+        self.log(f"Time series: {'max rate' if period_ms <= 0 else f'every {period_ms:g} ms'}")
+        self.measure_thread = threading.Thread(target=self.run_series, args=(period_ms, count, duration_s))
+        self.measure_thread.start()
+
+    def run_series(self, period_ms, count, duration_s):
+        scheduler = self.wasatch.run_series("series", period_ms, count, duration_s, lambda: self.running)
+        if self.wasatch.outfile:
+            self.wasatch.outfile.flush()
+        summary = scheduler.summary()
+        self.log(f"Time series done: {summary}")
+        self.running = False
+        self.root.after(0, lambda: self.series_label.config(text=summary))
+        self.root.after(0, self.enable_controls)
+
+    def resume_measurement(self):
+        if self.running:
+            self.log("Stop the running scan first")
+            return
+        journal_path = filedialog.askopenfilename(filetypes=[("Scan journals", "*_journal.jsonl"), ("All files", "*.*")])
+        if not journal_path:
+            return
+        try:
+            state = ScanJournal.load(journal_path)
+        except Exception as e:
+            self.log(f"Cannot read journal: {e}")
+            return
+        if state["finished"]:
+            self.log("That scan already finished")
+            return
+        if not self.serial.connected:
+            self.log('CNC not connected')
+            return
+
+        start = state["start"]
+        plan = start["plan"]
+        self.user_positions = plan["positions"]
+        for entry, count in zip(
+                (self.wasatch_samples_countX_entry, self.wasatch_samples_countY_entry, self.wasatch_samples_countZ_entry),
+                plan["counts"]):
+            entry.delete(0, tk.END)
+            entry.insert(0, str(count))
+        self.speed_entry.delete(0, tk.END)
+        self.speed_entry.insert(0, str(plan["speed"]))
+        self.file_path_entry.delete(0, tk.END)
+        self.file_path_entry.insert(0, start["outfile"])
+
+        self.wasatch.restore_settings(start["settings"])
+        self.wasatch.resume_output_file(start["outfile"])
+        self.wasatch.restore_references(state["references"])
+        self.log(f"Resuming scan from {journal_path}: {len(state['completed'])} point(s) already done")
+
+        self.running = True
+        self.disable_controls()
+        self.measure_thread = threading.Thread(target=self.measure_and_move, args=(journal_path, state))
+        self.measure_thread.start()
+
     def stop_measurement(self):
         self.running = False
         self.enable_controls()
 
-    def measure_and_move(self):
-        self.update_progress(0)
+    def add_region_vertex(self):
+        pos = self.current_position
+        self.scan_region.add_vertex(pos['X'], pos['Y'], pos['Z'])
+        self.log(f"Region vertex added at X:{pos['X']}, Y:{pos['Y']} (layer Z:{pos['Z']})")
+        self.update_region_label()
+
+    def import_region(self):
+        path = filedialog.askopenfilename(filetypes=[("Outlines", "*.json *.csv *.txt"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            self.scan_region = PolygonRegion.load(path)
+        except Exception as e:
+            self.log(f"Cannot import outline: {e}")
+            return
+        self.log(f"Region imported from {path}")
+        self.update_region_label()
 
+    def clear_region(self):
+        self.scan_region.clear()
+        self.update_region_label()
+
+    def update_region_label(self):
+        if not self.scan_region.layers:
+            text = "Whole box"
+        else:
+            text = ", ".join(f"Z {z}: {len(polygon)} vertices" for z, polygon in self.scan_region.layers)
+        self.region_label.config(text=text)
+
+    def current_job(self, name="scan", sample_change=False):
+        """ The scan set up in the GUI as a job. """
         self.samples_count_x = int(self.wasatch_samples_countX_entry.get())
         self.samples_count_y = int(self.wasatch_samples_countY_entry.get())
         self.samples_count_z = int(self.wasatch_samples_countZ_entry.get())
+        return ScanJob(
+            name,
+            {key: dict(pos) if pos else None for key, pos in self.user_positions.items()},
+            [self.samples_count_x, self.samples_count_y, self.samples_count_z],
+            self.get_speed(),
+            self.wasatch.settings_snapshot(),
+            self.file_path_entry.get() or None,
+            [(z, list(polygon)) for z, polygon in self.scan_region.layers],
+            self.reference_policy(),
+            sample_change,
+            dict(self.park_position) if sample_change and self.park_position else None,
+            self.focus_surface.to_dict() if self.follow_surface.get() and len(self.focus_surface) else None,
+        )
 
-        step_x = (self.user_positions['2']['X'] - self.user_positions['1']['X']) / (self.samples_count_x - 1)
-        step_y = (self.user_positions['4']['Y'] - self.user_positions['1']['Y']) / (self.samples_count_y - 1)
-        step_z = 0
-        if self.samples_count_z > 1 and self.user_positions['5'] is not None:
-            step_z = (self.user_positions['5']['Z'] - self.user_positions['1']['Z']) / (self.samples_count_z - 1)
+    def build_scan_plan(self):
+        return self.current_job().plan(self.log)
 
-        # Turn cnc into start point (0,0)
-        self.serial.send_gcode('G90')
-        move_command = (
-            f'G1 X{ -self.user_positions["1"]["X"] } '
-            f'Y{ -self.user_positions["1"]["Y"] } '
-            f'Z{ self.user_positions["1"]["Z"] } F{self.get_speed()}'
-        )
+    def update_queue_label(self):
+        pending = len(self.job_queue.pending())
+        self.queue_label.config(text=f"{pending} job(s) pending, {len(self.job_queue) - pending} finished")
 
-        self.serial.send_gcode(move_command)
-        self.log(
-            f"Moving to start position X: {self.user_positions['1']['X']}, "
-            f"Y: {self.user_positions['1']['Y']}, Z: {self.user_positions['1']['Z']}"
-        )
-        self.waitForCNC()
+    def enqueue_job(self):
+        required = ['1','2','4','5']
+        if any(self.user_positions.get(k) is None for k in required):
+            self.log('Set positions 1,2,4 and 5 first')
+            return
+        name = self.job_name_entry.get() or f"job {len(self.job_queue) + 1}"
+        try:
+            job = self.current_job(name, bool(self.sample_change.get()))
+        except ValueError as e:
+            self.log(f"Cannot add job: {e}")
+            return
+        if job.sample_change and job.park is None:
+            self.log("No park position set: the head stays at the end of the previous scan for the sample change")
+        self.job_queue.add(job)
+        self.log(f"Queued {name}: {len(job.plan())} points")
+        self.update_queue_label()
+
+    def load_jobs(self):
+        path = filedialog.askopenfilename(filetypes=[("Scan jobs", "*.json"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            jobs = self.job_queue.load_jobs(path)
+        except Exception as e:
+            self.log(f"Cannot load jobs: {e}")
+            return
+        self.log(f"Queued {len(jobs)} job(s) from {path}")
+        self.update_queue_label()
 
-        self.wasatch.set_scan_bounds(
-            self.user_positions['1']['X'], self.user_positions['2']['X'],
-            self.user_positions['1']['Y'], self.user_positions['4']['Y'],
-            self.user_positions['1']['Z'],
-            self.user_positions['5']['Z'] if self.user_positions['5'] else self.user_positions['1']['Z'],
-            self.user_positions,
-            self.samples_count_x,
-            self.samples_count_y,
-            self.samples_count_z
+    def clear_queue(self):
+        self.job_queue.clear()
+        self.update_queue_label()
 
-        )
+    def run_queue(self):
+        if self.running:
+            self.log("Stop the running scan first")
+            return
+        if not self.job_queue.pending():
+            self.log("No pending jobs")
+            return
+        if not self.serial.connected:
+            self.log('CNC not connected')
+            return
+        self.running = True
+        self.disable_controls()
+        self.measure_thread = threading.Thread(target=self.process_queue)
+        self.measure_thread.start()
+
+    def set_park_position(self):
+        self.park_position = self.current_position.copy()
+        self.log(f"Park position for sample changes set to X:{self.park_position['X']}, Y:{self.park_position['Y']}, Z:{self.park_position['Z']}")
+
+    def save_scan_setup(self):
+        """ The GUI scan setup that apply_job overwrites. """
+        return {
+            "user_positions": {key: dict(pos) if pos else None for key, pos in self.user_positions.items()},
+            "reference_positions": dict(self.reference_positions),
+            "counts": (self.samples_count_x, self.samples_count_y, self.samples_count_z),
+            "scan_region": self.scan_region,
+            "settings": self.wasatch.settings_snapshot(),
+        }
 
-        current_measure = 0
-        measure_count = self.samples_count_x * self.samples_count_y * self.samples_count_z
+    def restore_scan_setup(self, setup):
+        self.user_positions = setup["user_positions"]
+        self.reference_positions = setup["reference_positions"]
+        self.samples_count_x, self.samples_count_y, self.samples_count_z = setup["counts"]
+        self.scan_region = setup["scan_region"]
+        self.wasatch.restore_settings(setup["settings"])
+
+    def apply_job(self, job):
+        self.user_positions = job.positions
+        self.samples_count_x, self.samples_count_y, self.samples_count_z = job.counts
+        self.scan_region = PolygonRegion([(z, list(polygon)) for z, polygon in job.region])
+        self.wasatch.restore_settings(job.settings)
+        outfile = job.outfile or os.path.join(os.getcwd(), "NIRv2_Witek", f"{job.name}.csv")
+        os.makedirs(os.path.dirname(outfile) or ".", exist_ok=True)
+        self.wasatch.set_output_file_path(outfile)
+        # the output path may have been made unique
+        job.outfile = self.wasatch.args.outfile
+
+    def process_queue(self):
+        """ Runs pending jobs back-to-back. The head goes straight from the
+            end of one scan to the start of the next; it only stops for jobs
+            that need a sample change. The GUI's own scan setup is restored
+            afterwards. """
+        setup = self.save_scan_setup()
+        try:
+            self.run_jobs()
+        finally:
+            self.restore_scan_setup(setup)
 
-        self.wasatch.init_file()
+        stopped = self.job_queue.pending()
+        self.running = False
+        self.paused = False
+        self.log("Queue finished" if not stopped else f"Queue stopped, {len(stopped)} job(s) left")
+        for line in self.job_queue.report():
+            self.log(line)
+        self.root.after(0, self.enable_controls)
+        self.root.after(0, self.update_queue_label)
 
+    def run_jobs(self):
         while self.running:
-            for k in range(self.samples_count_z):
-                new_z = self.user_positions['1']['Z'] + k * step_z
-                for i in range(self.samples_count_x):
-                    new_x = self.user_positions['1']['X'] + i * step_x
-                    isChangedX = True
-                    for j in range(self.samples_count_y):
-                        if not self.running:
-                            break
-                        while self.paused and self.running:
-                            time.sleep(0.1)
-                        new_y = self.user_positions['1']['Y'] + j * step_y
-                        move_command = f'G1 X{ -new_x } Y{ -new_y } Z{ new_z } F{self.get_speed()}'
-
-                        self.serial.send_gcode(move_command)
-                        self.log(f"Moving to position X: {new_x}, Y: {new_y}, Z: {new_z}")
-                        self.waitForCNC()
-                        max_step = max(step_x, step_y, step_z)
-                        self.measureDelayFromSteps(max_step)
-                        if isChangedX:
-                            self.measureDelayFromSteps(step_x * self.samples_count_x)
-                            isChangedX = False
-                        current_measure += 1
-                        self.update_map_position(new_x, new_y, new_z)
-
-                        self.log(f"Measure {current_measure} out of {measure_count}.")
-                        finished = self.wasatch.run_with_position("scan", new_x, new_y, new_z)
-                        progress = int((current_measure / measure_count) * 100)
-
-                        self.update_progress(progress)
-                        if not finished:
-                            self.running = False
-                            self.log("Stopped. Measure from wasatch.py returned False.")
-                            break
-
-                    if not self.running:
-                        self.log("Stopped.")
-                        break
-
+            job = self.job_queue.next_job()
+            if job is None:
+                break
+
+            waiting_s = 0.0
+            if job.sample_change:
+                if job.park and not self.move_absolute(job.park['X'], job.park['Y'], job.park['Z']):
+                    self.log("Stopped. CNC link lost.")
+                    break
+                waiting = time.monotonic()
+                self.paused = True
+                # a sample change needs no dark reference to continue
+                self.dark_taken = True
+                self.root.after(0, lambda: self.continue_button.config(state=tk.NORMAL))
+                self.log(f"Load the sample for {job.name}, then press Continue")
+                while self.paused and self.running:
+                    time.sleep(0.1)
+                waiting_s = time.monotonic() - waiting
                 if not self.running:
                     break
 
-            self.running = False
+            self.apply_job(job)
+            try:
+                plan = job.plan(self.log)
+            except (KeyError, TypeError, ValueError) as e:
+                self.log(f"Job {job.name} skipped: {e}")
+                self.job_queue.finished(job, False, 0, waiting_s)
+                continue
+            self.log(f"Job {job.name}: {len(plan)} points")
+            self.job_queue.started(job, float(self.estimator.point_times(plan, self.wasatch.settings_snapshot()).sum()))
+            self.recovery.reset()
+            ok = self.measure_and_move(job=job, plan=plan)
+            if self.wasatch.outfile:
+                self.wasatch.close_file()
+            self.job_queue.finished(job, ok, len(self.wasatch.points), waiting_s, self.recovery.faults)
+            self.log(JobQueue.report_line(job))
+            self.root.after(0, self.update_queue_label)
+
+    def measure_and_move(self, journal_path=None, resume_state=None, job=None, plan=None):
+        """ Runs a scan: the GUI's, a resumed one or a queued job. Returns
+            True if it finished; a queued job leaves self.running set for
+            the next one. """
+        self.update_progress(0)
 
-    def waitForCNC(self):
-        while not self.serial.wait_for_ending_move():
-            pass
+        if resume_state:
+            plan = ScanPlan.load_npz(resume_state["start"]["plan"]["plan_file"])
+
+            # power or link loss may have reset the controller: home and restore the work offsets
+            self.log("Homing before resume")
+            self.serial.home()
+            self.waitForCNC()
+            self.scan_offsets = resume_state["start"]["offsets"]
+            if not self.serial.restore_work_offsets(self.scan_offsets):
+                self.log("Could not restore work offsets, check that the origin is unchanged")
+        else:
+            scan = job or self.current_job()
+            if plan is None:
+                plan = scan.plan(self.log)
+            self.scan_offsets = self.serial.work_offsets()
+            if self.scan_offsets is None:
+                self.log("Could not read the CNC work offsets; a lost CNC link will not be recovered during this scan")
+        if job is None:
+            self.recovery.reset()
+        if not len(plan):
+            self.log("No scan points inside the scan region")
+            if job is None:
+                self.running = False
+            return False
+        surface = None
+        if resume_state:
+            # the saved plan already follows the surface; refinement points need it too
+            focus_file = self.wasatch.sidecar_path("focus", ".json")
+            if os.path.isfile(focus_file):
+                surface = FocusSurface.load(focus_file)
+        else:
+            # the job's plan already follows the surface stored with it
+            surface = scan.surface()
+            if surface is not None:
+                self.log(f"Scan follows the focus surface ({len(surface)} focus points)")
+
+        # Turn cnc into start point; between queued jobs this is one rapid straight move
+        self.serial.send_gcode('G90')
+        self.serial.send_gcode(plan.gcode_line(0).replace('G1', 'G0', 1) if job else plan.gcode_line(0))
+        start_x, start_y, start_z = (round(float(v), 3) for v in plan.points[0])
+        self.log(f"Moving to start position X: {start_x}, Y: {start_y}, Z: {start_z}")
+        self.waitForCNC()
 
-    def measureDelayFromSteps(self, step):
-        wait_time_ms = self.interpolate_time(step) + 100
-        time.sleep(wait_time_ms/1000)
+        self.wasatch.set_scan_plan(plan, self.user_positions)
+        self.setup_auto_reference(job.references if job else None)
+        self.wasatch.reset_statistics()
 
-    def interpolate_time(self, step):
-        steps = np.array([1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 100, 120, 150])
-        times = np.array([500, 1150, 1560, 2000, 2700, 3300, 3800, 4400, 4900, 5500, 6600, 7800, 9700])
-        if step <= steps[0]:
-            return times[0]
+        self.wasatch.init_file()
+
+        completed = set()
+        if resume_state:
+            completed = resume_state["completed"]
+            self.journal = ScanJournal(journal_path)
+            self.journal.resumed()
         else:
-            return np.interp(step, steps, times)
+            plan_file = self.wasatch.sidecar_path("plan", ".npz")
+            plan.save_npz(plan_file)
+            if surface is not None:
+                surface.save(self.wasatch.sidecar_path("focus", ".json"))
+            self.journal = ScanJournal(self.wasatch.sidecar_path("journal", ".jsonl"))
+            self.journal.start(
+                {
+                    "positions": self.user_positions,
+                    "counts": [self.samples_count_x, self.samples_count_y, self.samples_count_z],
+                    "speed": plan.speed,
+                    "plan_file": plan_file,
+                },
+                self.wasatch.settings_snapshot(),
+                self.wasatch.args.outfile,
+                self.scan_offsets,
+            )
+        self.wasatch.journal = self.journal
+
+        refiner = None
+        if self.adaptive_scan.get():
+            try:
+                refiner = AdaptiveRefiner(plan, float(self.refine_threshold_entry.get()), int(self.refine_depth_entry.get()), surface)
+            except ValueError as e:
+                self.log(f"Adaptive refinement disabled: {e}")
+
+        self.setup_band_map(plan, refiner.scale if refiner else 1)
+
+        def record_coarse(index):
+            refiner.record(refiner.coarse_keys[index], self.wasatch.last_spectrum)
+
+        finished = False
+        if job and job.references.get("at_start") and self.reference_scheduler.reference_positions:
+            if not self.recovery.run(self.acquire_auto_reference, self.recover_links, self.log, lambda: self.running):
+                self.running = False
+                self.log("Stopped. Reference before the job failed.")
+        if self.running and self.execute_plan(plan, completed, on_point=record_coarse if refiner else None):
+            if refiner is None or self.refine_scan(refiner, plan):
+                self.journal.finished()
+                finished = True
+        if job is None:
+            self.running = False
+
+        self.wasatch.journal = None
+        self.journal.close()
+        self.wasatch.save_statistics()
+        if self.recovery.faults:
+            self.log(f"{self.recovery.faults} fault(s) during the scan, {self.recovery.recovered} recovered")
+
+        if self.wasatch.outfile:
+            self.wasatch.outfile.flush()
+        if self.update_spatial_index():
+            self.spatial_index.save()
+        return finished
+
+    def refine_scan(self, refiner, plan):
+        # refinement points are journaled after the coarse plan's indices
+        index_offset = len(plan)
+        start = plan.points[-1]
+        # refinement points only paint their own map cell
+        self.root.after(0, self.set_map_block, 1)
+        while self.running:
+            batch, keys = refiner.next_batch(start)
+            if batch is not None and self.scan_region:
+                inside = self.scan_region.contains(batch.points)
+                keys = [key for key, keep in zip(keys, inside) if keep]
+                batch = batch.subset(inside).retime(start) if inside.any() else None
+            if batch is None:
+                return True
+            self.log(f"Refinement: {len(batch)} more point(s)")
+            self.wasatch.extend_scan_plan(batch)
+
+            def record(index):
+                refiner.record(keys[index], self.wasatch.last_spectrum)
+
+            if not self.execute_plan(batch, index_offset=index_offset, on_point=record):
+                return False
+            index_offset += len(batch)
+            start = batch.points[-1]
+        return False
+
+    def execute_plan(self, plan, completed=(), index_offset=0, on_point=None):
+        """ Runs the plan point by point; returns False if the scan was
+            stopped or a measurement failed. """
+        measure_count = len(plan)
+        self.scan_progress = ScanProgress(
+            self.estimator.point_times(plan, self.wasatch.settings_snapshot()), self.estimator.overhead_ms)
+        for index in completed:
+            if index_offset <= index < index_offset + measure_count:
+                self.scan_progress.skip(index - index_offset)
+
+        for index in range(measure_count):
+            if self.paused:
+                while self.paused and self.running:
+                    time.sleep(0.1)
+                self.scan_progress.restart()
+            if not self.running:
+                self.log("Stopped.")
+                return False
+            if index + index_offset in completed:
+                continue
+
+            x, y, z = (round(float(v), 3) for v in plan.points[index])
+            actions = plan.actions[index]
+            if actions & MOVE:
+                self.log(f"Moving to position X: {x}, Y: {y}, Z: {z}")
+                if not self.recovery.run(
+                        lambda: self.move_to(plan.gcode_line(index)),
+                        lambda: self.recover_links(plan.gcode_line(index)),
+                        self.log, lambda: self.running):
+                    self.running = False
+                    self.log("Stopped. CNC link lost.")
+                    return False
+            if actions & SETTLE:
+                time.sleep(plan.settle_ms[index] / 1000)
+            self.update_map_position(x, y, z)
+
+            if actions & ACQUIRE:
+                self.log(f"Measure {index + 1} out of {measure_count}.")
+                if not self.recovery.run(
+                        lambda: self.measure_point(x, y, z),
+                        lambda: self.recover_links(plan.gcode_line(index)),
+                        self.log, lambda: self.running):
+                    self.running = False
+                    self.log("Stopped. Measure from wasatch.py returned False.")
+                    return False
+                if on_point:
+                    on_point(index)
+            self.update_progress(int(((index + 1) / measure_count) * 100))
+            self.journal.point_done(index + index_offset, x, y, z)
+            self.scan_progress.point_done(index)
+            self.update_eta()
+
+            if actions & REFERENCE or self.auto_reference_due(plan, index):
+                if not self.recovery.run(self.acquire_auto_reference, self.recover_links, self.log, lambda: self.running):
+                    self.running = False
+                    self.log("Stopped. Automatic reference failed.")
+                    return False
+                self.scan_progress.restart()
+        self.estimator.record(self.scan_progress)
+        return True
+
+    def measure_point(self, x, y, z):
+        finished = self.wasatch.run_with_position("scan", x, y, z)
+        reacquired = 0
+        while finished and self.wasatch.last_reading_flagged() and reacquired < self.max_reacquire:
+            # head is still on the point, so re-measuring now costs no travel
+            reacquired += 1
+            self.log(f"Point X: {x}, Y: {y}, Z: {z} flagged, re-acquiring")
+            finished = self.wasatch.run_with_position("rescan", x, y, z)
+        return finished
+
+    def auto_reference_due(self, plan, index):
+        if not self.reference_scheduler.enabled():
+            return False
+        reading = self.wasatch.last_reading
+        # raw pixels: the blocked ones may lie outside a resampled ROI
+        self.drift_monitor.update(
+            reading.detector_temperature_degC if reading else None,
+            reading.spectrum if reading else None
+        )
+        return self.reference_scheduler.reference_due(plan.points, index)
+
+    def waitForCNC(self):
+        """ Waits for the move to finish; False if the CNC link dropped. """
+        while not self.serial.wait_for_ending_move():
+            if not self.serial.connected:
+                return False
+        return True
+
+    def move_to(self, gcode):
+        self.serial.send_gcode(gcode)
+        return self.serial.connected and self.waitForCNC()
+
+    def recover_links(self, gcode=None):
+        """ Reopens whichever link failed and, for the CNC, returns the head
+            to the point (gcode) it was on. """
+        if not self.serial.connected:
+            return self.recover_cnc(gcode)
+        self.log(f"Spectrometer fault ({self.wasatch.last_error}), reconnecting")
+        return self.wasatch.reconnect()
+
+    def recover_cnc(self, gcode=None):
+        self.log(f"CNC link lost ({self.serial.last_error}), reconnecting")
+        if not self.serial.reconnect():
+            return False
+        # GRBL resets when the port opens: home and re-apply the scan's G92 offset
+        self.serial.home()
+        if not self.waitForCNC():
+            return False
+        if not self.serial.restore_work_offsets(self.scan_offsets):
+            self.log("Could not restore work offsets")
+            return False
+        self.serial.send_gcode('G90')
+        return gcode is None or self.move_to(gcode)
 
     def run_dark(self):
         self.ensure_file_path()
@@ -877,13 +1934,15 @@ class MyGUI:
             self.current_position['Y'],
             self.current_position['Z'],
         )
-        finished = self.wasatch.run_with_position("dark", *pos)
+        finished = self.wasatch.run_reference("dark", *pos)
         if finished is False:
 
             self.running = False
             self.log("Stopped. Measure from wasatch.py return False.")
             return
         self.dark_taken = True
+        reading = self.wasatch.last_reading
+        self.reference_scheduler.reference_taken(reading.detector_temperature_degC if reading else None)
         self.continue_button.config(state=tk.NORMAL)
 
     def run_light(self):
@@ -896,7 +1955,7 @@ class MyGUI:
             self.current_position['Y'],
             self.current_position['Z'],
         )
-        finished = self.wasatch.run_with_position("light", *pos)
+        finished = self.wasatch.run_reference("light", *pos)
         if finished is False:
 
             self.running = False
@@ -0,0 +1,252 @@
+""" Compact archive format for spectra (.nirz).
+
+    Each spectrum is quantized to integers (counts times a per-record scale),
+    delta coded along the pixel axis, stored as int16 when the deltas fit and
+    int32 otherwise, and compressed with zlib or lzma. Records carry their
+    own length, so a file whose index was never written (crash) can still be
+    read; the index written on close makes every record seekable.
+
+    python -m nir1.archive scan.csv [scan.nirz]   converts a Wasatch scan CSV
+"""
+
+import os
+import sys
+import lzma
+import time
+import zlib
+import struct
+import numpy
+
+MAGIC = b"NIRZ"
+INDEX_MAGIC = b"NIRX"
+VERSION = 1
+CODECS = {"zlib": 0, "lzma": 1}
+
+HEADER = struct.Struct("<4sHBI")
+RECORD = struct.Struct("<I4ffB")      # length, x, y, z, temperature, scale, dtype code
+FOOTER = struct.Struct("<Q4s")        # index offset, INDEX_MAGIC
+DTYPES = {1: numpy.int16, 2: numpy.int32}
+
+
+def compress(data, codec, level):
+    if codec == CODECS["lzma"]:
+        return lzma.compress(data, preset=level)
+    return zlib.compress(data, level)
+
+
+def decompress(data, codec):
+    if codec == CODECS["lzma"]:
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_spectrum(spectrum, scale=1.0):
+    counts = numpy.rint(numpy.asarray(spectrum, dtype=numpy.float64) * scale).astype(numpy.int64)
+    deltas = numpy.diff(counts, prepend=0)
+    if deltas.size and numpy.abs(deltas).max() < 2 ** 15:
+        return 1, deltas.astype(numpy.int16).tobytes()
+    return 2, deltas.astype(numpy.int32).tobytes()
+
+
+def decode_spectrum(code, data, scale=1.0):
+    counts = numpy.cumsum(numpy.frombuffer(data, dtype=DTYPES[code]), dtype=numpy.int64)
+    return counts / scale if scale != 1 else counts.astype(numpy.float64)
+
+
+def read_header(f):
+    magic, version, codec, pixels = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("not a .nirz archive")
+    if version != VERSION:
+        raise ValueError("unsupported .nirz version %d" % version)
+    wavelengths = numpy.frombuffer(f.read(8 * pixels), dtype=numpy.float64)
+    return codec, wavelengths
+
+
+def read_offsets(f, data_start):
+    """ Record offsets from the index, or by walking the records when the
+        index is missing; also returns where the record data ends. """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size >= data_start + FOOTER.size:
+        f.seek(size - FOOTER.size)
+        index_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic == INDEX_MAGIC and data_start <= index_offset < size:
+            f.seek(index_offset)
+            count = (size - FOOTER.size - index_offset) // 8
+            return numpy.frombuffer(f.read(8 * count), dtype=numpy.uint64).astype(numpy.int64).tolist(), index_offset
+
+    offsets = []
+    position = data_start
+    f.seek(position)
+    while True:
+        head = f.read(RECORD.size)
+        if len(head) < RECORD.size:
+            break
+        length = RECORD.unpack(head)[0]
+        if position + length > size:
+            # torn last record
+            break
+        offsets.append(position)
+        position += length
+        f.seek(position)
+    return offsets, position
+
+
+class ArchiveWriter:
+    """ Streams spectra into a .nirz file. An existing archive is reopened
+        and appended to. """
+
+    def __init__(self, path, wavelengths, compressor="zlib", level=6):
+        self.path = path
+        self.level = level
+        self.offsets = []
+        self.written = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.encode_seconds = 0.0
+
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            self.file = open(path, "r+b")
+            self.codec, wavelengths = read_header(self.file)
+            self.offsets, end = read_offsets(self.file, self.file.tell())
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.codec = CODECS[compressor]
+            wavelengths = numpy.asarray(wavelengths, dtype=numpy.float64)
+            self.file = open(path, "wb")
+            self.file.write(HEADER.pack(MAGIC, VERSION, self.codec, len(wavelengths)))
+            self.file.write(wavelengths.tobytes())
+        self.pixels = len(wavelengths)
+
+    def write(self, spectrum, label="scan", position=(None, None, None), temperature=None, scale=1.0):
+        start = time.perf_counter()
+        code, deltas = encode_spectrum(spectrum, scale)
+        payload = compress(deltas, self.codec, self.level)
+        name = label.encode("utf-8")[:255]
+        x, y, z = (numpy.nan if v is None else v for v in position)
+        length = RECORD.size + 1 + len(name) + len(payload)
+
+        self.offsets.append(self.file.tell())
+        self.file.write(RECORD.pack(length, x, y, z, numpy.nan if temperature is None else temperature, scale, code))
+        self.file.write(bytes([len(name)]) + name)
+        self.file.write(payload)
+        self.file.flush()
+
+        self.encode_seconds += time.perf_counter() - start
+        self.written += 1
+        self.raw_bytes += 8 * len(spectrum)
+        self.stored_bytes += length
+
+    def stats(self):
+        """ Compression ratio against float64 spectra and encode throughput
+            for the spectra written by this writer. """
+        return {
+            "count": self.written,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "ratio": self.raw_bytes / self.stored_bytes if self.stored_bytes else 0.0,
+            "encode_mb_s": self.raw_bytes / 1e6 / self.encode_seconds if self.encode_seconds else 0.0,
+        }
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(numpy.asarray(self.offsets, dtype=numpy.uint64).tobytes())
+        self.file.write(FOOTER.pack(index_offset, INDEX_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader:
+    """ Random access (reader[i]) and streaming (iteration) over a .nirz
+        file. Records are dicts with label, position, temperature, scale and
+        spectrum. """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.codec, self.wavelengths = read_header(self.file)
+        self.offsets, _ = read_offsets(self.file, self.file.tell())
+        self.decode_seconds = 0.0
+        self.decoded_bytes = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        self.file.seek(self.offsets[index])
+        head = self.file.read(RECORD.size)
+        length, x, y, z, temperature, scale, code = RECORD.unpack(head)
+        body = self.file.read(length - RECORD.size)
+        name_length = body[0]
+        label = body[1:1 + name_length].decode("utf-8")
+        spectrum = decode_spectrum(code, decompress(body[1 + name_length:], self.codec), scale)
+
+        self.decode_seconds += time.perf_counter() - start
+        self.decoded_bytes += spectrum.nbytes
+        return {
+            "label": label,
+            "position": tuple(None if numpy.isnan(v) else v for v in (x, y, z)),
+            "temperature": None if numpy.isnan(temperature) else temperature,
+            "scale": scale,
+            "spectrum": spectrum,
+        }
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self[index]
+
+    def decode_mb_s(self):
+        return self.decoded_bytes / 1e6 / self.decode_seconds if self.decode_seconds else 0.0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert_csv(csv_path, archive_path, compressor="zlib"):
+    """ Converts a 'type;x;y;z;temp;...' scan CSV; its two-decimal values
+        are stored exactly with a scale of 100. """
+    def value(text):
+        return float(text) if text else None
+
+    with open(csv_path) as f:
+        header = f.readline().rstrip("\n").split(";")
+        wavelengths = [float(w) for w in header[5:]]
+        with ArchiveWriter(archive_path, wavelengths, compressor) as writer:
+            for line in f:
+                fields = line.rstrip("\n").split(";")
+                if len(fields) < 6:
+                    continue
+                writer.write(
+                    numpy.array(fields[5:], dtype=numpy.float64),
+                    fields[0],
+                    (value(fields[1]), value(fields[2]), value(fields[3])),
+                    value(fields[4]),
+                    100)
+            return writer.stats()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m nir1.archive scan.csv [scan.nirz]")
+        sys.exit(1)
+    csv_path = sys.argv[1]
+    archive_path = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(csv_path)[0] + ".nirz"
+    stats = convert_csv(csv_path, archive_path)
+    print("%d spectra, %.1fx smaller than float64, %.1f MB/s encode" % (stats["count"], stats["ratio"], stats["encode_mb_s"]))
+    print("CSV %d bytes -> %s %d bytes" % (os.path.getsize(csv_path), archive_path, os.path.getsize(archive_path)))
@@ -0,0 +1,53 @@
+import numpy
+
+
+def parse_band(text):
+    """ 'start:stop' on the spectral axis, or None for an empty string. """
+    text = (text or "").strip()
+    if not text:
+        return None
+    start, stop = (float(v) for v in text.split(":"))
+    return (min(start, stop), max(start, stop))
+
+
+class BandFeature:
+    """ Integral of a spectral band, or its ratio to a reference band.
+
+        The band masks and trapezoid weights are computed once for the
+        spectral axis, so a value is one dot product per band; value()
+        also takes stacked spectra (..., pixels). """
+
+    def __init__(self, axis, band, reference_band=None):
+        self.axis = numpy.asarray(axis, dtype=numpy.float64)
+        self.band = band
+        self.reference_band = reference_band
+        self.mask, self.weights = self.band_weights(band)
+        if reference_band is not None:
+            self.reference_mask, self.reference_weights = self.band_weights(reference_band)
+
+    def band_weights(self, band):
+        start, stop = band
+        mask = (self.axis >= start) & (self.axis <= stop)
+        if mask.sum() < 2:
+            raise ValueError("band %g:%g covers fewer than 2 pixels" % (start, stop))
+        x = self.axis[mask]
+        # trapezoid rule as weights; abs() so a descending axis integrates positive
+        steps = numpy.abs(numpy.diff(x))
+        weights = numpy.zeros(len(x))
+        weights[:-1] += steps / 2
+        weights[1:] += steps / 2
+        return mask, weights
+
+    def name(self):
+        text = "%g-%g" % self.band
+        if self.reference_band is not None:
+            text += " / %g-%g" % self.reference_band
+        return text
+
+    def value(self, spectrum):
+        spectrum = numpy.asarray(spectrum, dtype=numpy.float64)
+        integral = spectrum[..., self.mask] @ self.weights
+        if self.reference_band is None:
+            return integral
+        reference = spectrum[..., self.reference_mask] @ self.reference_weights
+        return integral / numpy.where(reference == 0, numpy.nan, reference)
@@ -0,0 +1,77 @@
+import numpy
+
+# reading types stored as a code in PointBuffer.meta["kind"]
+KINDS = ("other", "scan", "rescan", "dark", "light")
+FLAGGED = 1
+
+# 28 bytes of metadata per point
+POINT_DTYPE = numpy.dtype([
+    ("x", numpy.float32),
+    ("y", numpy.float32),
+    ("z", numpy.float32),
+    ("reading", numpy.uint32),
+    ("temperature", numpy.float32),
+    ("integration_time_ms", numpy.float32),
+    ("scans", numpy.uint16),
+    ("kind", numpy.uint8),
+    ("flags", numpy.uint8),
+])
+
+
+class PointBuffer:
+    """ Preallocated per-point metadata and, if pixels is given, float32
+        spectra, filled through an append cursor. reserve() sizes it from
+        the scan plan; it doubles if a scan writes more points (rescans,
+        refinement). Views into the filled part are used for plotting. """
+
+    def __init__(self, capacity=0, pixels=None):
+        self.pixels = pixels
+        self.count = 0
+        self.meta = numpy.zeros(capacity, dtype=POINT_DTYPE)
+        self.spectra = numpy.empty((capacity, pixels), dtype=numpy.float32) if pixels else None
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity):
+        if capacity <= len(self.meta):
+            return
+        meta = numpy.zeros(capacity, dtype=POINT_DTYPE)
+        meta[:self.count] = self.meta[:self.count]
+        self.meta = meta
+        if self.spectra is not None:
+            spectra = numpy.empty((capacity, self.pixels), dtype=numpy.float32)
+            spectra[:self.count] = self.spectra[:self.count]
+            self.spectra = spectra
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, position, reading=0, temperature=numpy.nan, integration_time_ms=numpy.nan, scans=1, kind="scan", flagged=False, spectrum=None):
+        if self.count == len(self.meta):
+            self.reserve(max(1024, 2 * len(self.meta)))
+        index = self.count
+        x, y, z = position
+        self.meta[index] = (
+            x, y, z, reading,
+            numpy.nan if temperature is None else temperature,
+            numpy.nan if integration_time_ms is None else integration_time_ms,
+            scans,
+            KINDS.index(kind) if kind in KINDS else 0,
+            FLAGGED if flagged else 0,
+        )
+        if self.spectra is not None and spectrum is not None and len(spectrum) == self.pixels:
+            self.spectra[index] = spectrum
+        self.count += 1
+        return index
+
+    def columns(self):
+        """ x, y, z views of the filled points. """
+        meta = self.meta[:self.count]
+        return meta["x"], meta["y"], meta["z"]
+
+    def filled(self):
+        return self.meta[:self.count]
+
+    def nbytes(self):
+        return self.meta.nbytes + (self.spectra.nbytes if self.spectra is not None else 0)
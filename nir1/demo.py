@@ -36,6 +36,8 @@ from wasatch.WasatchDevice        import WasatchDevice
 from wasatch.WasatchDeviceWrapper import WasatchDeviceWrapper
 from wasatch.RealUSBDevice        import RealUSBDevice
 
+from nir1.timing import DeadlineScheduler
+
 
 log = logging.getLogger(__name__)
 
@@ -168,27 +170,27 @@ class WasatchDemo:
                 log.error("Error initializing %s", self.args.outfile)
                 self.outfile = None
 
-        # read spectra until user presses Control-Break
+        # read spectra until user presses Control-Break, starting one every
+        # delay_ms on a monotonic schedule so the rate doesn't drift
+        scheduler = DeadlineScheduler(self.args.delay_ms)
         while not self.exiting:
-            start_time = datetime.datetime.now()
+            missed = scheduler.missed
+            try:
+                scheduler.wait()
+            except:
+                # log.critical("WasatchDemo.run sleep() caught an exception", exc_info=1)
+                self.exiting = True
+                break
+            if scheduler.missed > missed:
+                log.debug("missed %d deadline(s), %d so far", scheduler.missed - missed, scheduler.missed)
+
             self.attempt_reading()
-            end_time = datetime.datetime.now()
 
             if self.args.max > 0 and self.reading_count >= self.args.max:
                 log.debug("max spectra reached, exiting")
                 self.exiting = True
-            else:
-                # compute how much longer we should wait before the next reading
-                reading_time_ms = int((end_time - start_time).microseconds / 1000)
-                sleep_ms = self.args.delay_ms - reading_time_ms
-                if sleep_ms > 0:
-                    log.debug("sleeping %d ms (%d ms already passed)", sleep_ms, reading_time_ms)
-                    try:
-                        time.sleep(float(sleep_ms) / 1000)
-                    except:
-                        # log.critical("WasatchDemo.run sleep() caught an exception", exc_info=1)
-                        self.exiting = True
 
+        log.info("WasatchDemo.run: %s", scheduler.summary())
         log.debug("WasatchDemo.run exiting")
 
     def attempt_reading(self):
@@ -0,0 +1,47 @@
+import collections
+import numpy
+
+
+class AutoExposure:
+    """ Predicts the integration time that puts the spectrum peak at
+        target_fraction of full scale, assuming counts above the dark offset
+        grow linearly with integration time. """
+
+    def __init__(self, full_scale=65535, target_fraction=0.7, min_ms=1, max_ms=10000, min_change=0.15, history=3):
+        self.full_scale = full_scale
+        self.target_fraction = target_fraction
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.min_change = min_change
+        self.peaks = collections.deque(maxlen=history)
+
+    def reset(self):
+        self.peaks.clear()
+
+    def predict(self, peak, integration_time_ms, offset=0.0):
+        if peak >= 0.98 * self.full_scale:
+            # clipped peak says nothing about the true signal, back off hard
+            proposed = integration_time_ms / 2
+        else:
+            signal = max(peak - offset, 1.0)
+            proposed = integration_time_ms * (self.target_fraction * self.full_scale - offset) / signal
+        return int(numpy.clip(round(proposed), self.min_ms, self.max_ms))
+
+    def update(self, spectrum, integration_time_ms, offset=0.0):
+        """ Returns the new integration time, or None when the change is too
+            small to be worth a device update. """
+        peak = float(numpy.max(spectrum))
+        saturated = peak >= 0.98 * self.full_scale
+        if saturated:
+            self.peaks.clear()
+        else:
+            # peaks seen at other integration times are rescaled to the current one
+            self.peaks.append((peak - offset) / integration_time_ms)
+            peak = offset + max(self.peaks) * integration_time_ms
+
+        proposed = self.predict(peak, integration_time_ms, offset)
+        if not saturated and abs(proposed - integration_time_ms) < self.min_change * integration_time_ms:
+            return None
+        if proposed == integration_time_ms:
+            return None
+        return proposed
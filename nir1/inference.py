@@ -0,0 +1,147 @@
+import os
+import queue
+import pickle
+import threading
+import numpy
+
+
+def load_model(path):
+    """ Loads a fitted scikit-learn estimator or pipeline saved with joblib
+        (.joblib/.pkl via joblib.dump) or plain pickle. """
+    try:
+        import joblib
+    except ImportError:
+        joblib = None
+    if joblib is not None:
+        return joblib.load(path)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+class InferenceWorker:
+    """ Runs a model on spectra as they arrive, on a background thread.
+
+        submit() only copies the spectrum into a queue, so acquisition never
+        waits for the model. The worker collects up to batch_size spectra,
+        or whatever arrived within max_wait_s, predicts them with one call
+        and appends 'reading;type;x;y;z;<predictions>' rows to the output
+        file. Listeners get (position, value) for every prediction, value
+        being the class index for classifiers with non-numeric labels. They
+        run on the worker thread, so GUI listeners have to hand the update
+        over to the GUI thread. """
+
+    def __init__(self, model_path, batch_size=32, max_wait_s=0.5):
+        self.model = load_model(model_path)
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_wait_s = max_wait_s
+        self.features = getattr(self.model, "n_features_in_", None)
+        self.classes = getattr(self.model, "classes_", None)
+        self.listeners = []
+        self.outfile = None
+        self.output_path = None
+        self.predicted = 0
+        self.failed = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, name="inference", daemon=True)
+        self.thread.start()
+
+    def submit(self, reading, type, position, spectrum):
+        self.queue.put(("spectrum", (reading, type, position), numpy.array(spectrum, dtype=numpy.float64)))
+
+    def set_output(self, path):
+        """ Switches the predictions file; queued spectra still go to the
+            previous one. None closes it. """
+        self.queue.put(("output", path, None))
+
+    def stop(self):
+        self.queue.put(("stop", None, None))
+        self.thread.join()
+
+    def loop(self):
+        while True:
+            kind, value, spectrum = self.queue.get()
+            batch = []
+            while kind == "spectrum":
+                batch.append((value, spectrum))
+                if len(batch) >= self.batch_size:
+                    kind = None
+                    break
+                try:
+                    kind, value, spectrum = self.queue.get(timeout=self.max_wait_s if len(batch) == 1 else 0.01)
+                except queue.Empty:
+                    kind = None
+            if batch:
+                self.predict(batch)
+
+            if kind == "output":
+                self.open_output(value)
+            elif kind == "stop":
+                self.open_output(None)
+                return
+
+    def predict(self, batch):
+        spectra = numpy.stack([spectrum for _, spectrum in batch])
+        if self.features is not None and spectra.shape[1] != self.features:
+            self.failed += len(batch)
+            print(f"Inference skipped: model expects {self.features} values, spectra have {spectra.shape[1]}")
+            return
+        try:
+            predictions = numpy.asarray(self.model.predict(spectra))
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Inference failed: {e}")
+            return
+        self.predicted += len(batch)
+        predictions = predictions.reshape(len(batch), -1)
+
+        self.write_rows(batch, predictions)
+
+        values = self.numeric(predictions[:, 0])
+        for listener in self.listeners:
+            # a failing listener must not stop the worker thread
+            try:
+                for (meta, _), value in zip(batch, values):
+                    listener(meta[2], value)
+            except Exception as e:
+                print(f"Inference listener failed: {e}")
+
+    def numeric(self, predictions):
+        if predictions.dtype.kind in "iufb":
+            return predictions.astype(numpy.float64)
+        if self.classes is not None:
+            # map labels to class indices
+            lookup = {label: n for n, label in enumerate(self.classes)}
+            return numpy.array([lookup.get(p, numpy.nan) for p in predictions], dtype=numpy.float64)
+        return numpy.full(len(predictions), numpy.nan)
+
+    def write_rows(self, batch, predictions):
+        if self.outfile is None and self.output_path:
+            self.outfile = self.open_output_file(self.output_path, predictions.shape[1])
+            self.output_path = None
+        if self.outfile is None:
+            return
+        for ((reading, type, position), _), row in zip(batch, predictions):
+            x, y, z = ("" if v is None else format(v, ".2f") for v in position)
+            self.outfile.write("%s;%s;%s;%s;%s;%s\n" % (reading, type, x, y, z, ";".join(str(v) for v in row)))
+        self.outfile.flush()
+
+    @staticmethod
+    def open_output_file(path, outputs):
+        # the header needs the model's output count, so the file is opened on the first batch
+        columns = ["prediction"] if outputs == 1 else ["prediction_%d" % n for n in range(outputs)]
+        try:
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                return open(path, "a")
+            outfile = open(path, "w")
+            outfile.write(";".join(["reading", "type", "x", "y", "z"] + columns) + "\n")
+            return outfile
+        except Exception as e:
+            print(f"Error initializing {path}: {e}")
+            return None
+
+    def open_output(self, path):
+        if self.outfile:
+            self.outfile.close()
+            self.outfile = None
+        self.output_path = path
@@ -0,0 +1,139 @@
+import collections
+import numpy
+
+
+def time_key(integration_time_ms):
+    """ Integration time as a dict key; None (or NaN) when unknown. """
+    if integration_time_ms is None or integration_time_ms != integration_time_ms:
+        return None
+    return float(integration_time_ms)
+
+
+class ReferenceCorrector:
+    """ Caches the latest dark/light references and corrects scan spectra.
+
+        Darks are kept per integration time. A spectrum taken at a time
+        without its own dark gets one interpolated per pixel from the darks
+        at the two nearest times (offset plus dark current per ms); with a
+        single dark time that dark is used as is. """
+
+    MODES = ("off", "dark", "reflectance", "absorbance")
+
+    def __init__(self, mode="reflectance", average_count=1):
+        self.mode = mode
+        self.average_count = max(1, int(average_count))
+        # integration time -> recent darks at that time
+        self.darks = {}
+        self.lights = collections.deque(maxlen=self.average_count)
+        self.dark_by_time = {}
+        self.dark_cache = {}
+        self.dark_integration_ms = None
+        self.dark = None
+        self.light = None
+        self.light_integration_ms = None
+        self.inv_range = None
+        self.out = None
+
+    def set_mode(self, mode):
+        if mode not in self.MODES:
+            raise ValueError("unknown correction mode: %s" % mode)
+        self.mode = mode
+
+    def set_average_count(self, average_count):
+        self.average_count = max(1, int(average_count))
+        self.darks = {t: collections.deque(d, maxlen=self.average_count) for t, d in self.darks.items()}
+        self.lights = collections.deque(self.lights, maxlen=self.average_count)
+        self.update_references()
+
+    def reset(self):
+        self.darks.clear()
+        self.lights.clear()
+        self.update_references()
+
+    def add_dark(self, spectrum, integration_time_ms=None):
+        integration_time_ms = time_key(integration_time_ms)
+        if integration_time_ms not in self.darks:
+            self.darks[integration_time_ms] = collections.deque(maxlen=self.average_count)
+        self.darks[integration_time_ms].append(numpy.array(spectrum, dtype=numpy.float64))
+        self.dark_integration_ms = integration_time_ms
+        self.update_references()
+
+    def add_light(self, spectrum, integration_time_ms=None):
+        integration_time_ms = time_key(integration_time_ms)
+        if integration_time_ms != self.light_integration_ms:
+            # lights taken at another integration time can't be averaged together
+            self.lights.clear()
+            self.light_integration_ms = integration_time_ms
+        self.lights.append(numpy.array(spectrum, dtype=numpy.float64))
+        self.update_references()
+
+    def update_references(self):
+        self.dark_by_time = {t: numpy.mean(d, axis=0) for t, d in self.darks.items() if d}
+        self.dark_cache = {}
+        self.light = numpy.mean(self.lights, axis=0) if self.lights else None
+        # the dark the light reference is corrected with
+        self.dark = self.dark_at(self.light_integration_ms if self.light is not None else self.dark_integration_ms)
+        self.inv_range = None
+        if self.dark is not None and self.light is not None and self.dark.shape == self.light.shape:
+            # precompute 1 / (light - dark) once so each spectrum costs one subtract and one multiply
+            span = self.light - self.dark
+            with numpy.errstate(divide="ignore"):
+                self.inv_range = numpy.where(span > 0, 1.0 / span, numpy.nan)
+
+    def dark_at(self, integration_time_ms):
+        """ Dark for an integration time (see the class docstring), or
+            None without darks. """
+        integration_time_ms = time_key(integration_time_ms)
+        if integration_time_ms in self.dark_by_time:
+            return self.dark_by_time[integration_time_ms]
+        if integration_time_ms in self.dark_cache:
+            return self.dark_cache[integration_time_ms]
+        times = sorted(t for t in self.dark_by_time if t is not None)
+        if integration_time_ms is None or len(times) < 2:
+            return self.dark_by_time.get(self.dark_integration_ms)
+        t1, t2 = sorted(sorted(times, key=lambda t: abs(t - integration_time_ms))[:2])
+        d1, d2 = self.dark_by_time[t1], self.dark_by_time[t2]
+        if d1.shape != d2.shape:
+            return d1 if abs(t1 - integration_time_ms) <= abs(t2 - integration_time_ms) else d2
+        dark = d1 + (d2 - d1) * ((integration_time_ms - t1) / (t2 - t1))
+        self.dark_cache[integration_time_ms] = dark
+        return dark
+
+    def ready(self):
+        if self.mode == "off" or self.dark is None:
+            return False
+        if self.mode == "dark":
+            return True
+        return self.inv_range is not None
+
+    def correct(self, spectrum, integration_time_ms=None):
+        """ Returns the corrected spectrum (or stacked spectra, one per row)
+            in a reused buffer, or None when the references required by the
+            current mode are missing.
+
+            The dark for the spectrum's integration time is subtracted. If the
+            spectrum was taken at a different integration time than the light
+            reference, reflectance is scaled per ms. """
+        if not self.ready():
+            return None
+        integration_time_ms = time_key(integration_time_ms)
+        dark = self.dark_at(integration_time_ms)
+        spectrum = numpy.asarray(spectrum, dtype=numpy.float64)
+        if spectrum.shape[-1:] != dark.shape:
+            return None
+        if self.out is None or self.out.shape != spectrum.shape:
+            self.out = numpy.empty_like(spectrum)
+        out = self.out
+
+        numpy.subtract(spectrum, dark, out=out)
+        if self.mode == "dark":
+            return out
+
+        numpy.multiply(out, self.inv_range, out=out)
+        if integration_time_ms and self.light_integration_ms and integration_time_ms != self.light_integration_ms:
+            numpy.multiply(out, self.light_integration_ms / integration_time_ms, out=out)
+        if self.mode == "absorbance":
+            numpy.clip(out, 1e-6, None, out=out)
+            numpy.log10(out, out=out)
+            numpy.negative(out, out=out)
+        return out
@@ -0,0 +1,77 @@
+import numpy
+from scipy import sparse
+
+# transforms are built once per calibration and parameter set
+_cache = {}
+
+
+def to_axis(wavelengths_nm, axis, excitation_nm=None):
+    wavelengths_nm = numpy.asarray(wavelengths_nm, dtype=numpy.float64)
+    if axis == "nm":
+        return wavelengths_nm
+    if axis == "wavenumber":
+        # absolute wavenumbers, or Raman shift when the excitation is known
+        wavenumbers = 1e7 / wavelengths_nm
+        return 1e7 / excitation_nm - wavenumbers if excitation_nm else wavenumbers
+    raise ValueError("unknown axis: %s" % axis)
+
+
+class SpectralTransform:
+    """ Crops the detector's pixels to a spectral ROI and resamples them onto
+        a uniform grid (start, start + step, ..., stop) in nm or cm^-1, as one
+        sparse matrix applied with a single product per spectrum.
+
+        mode "interpolate" is linear interpolation between neighbouring
+        pixels; mode "bin" averages all pixels falling in each grid step.
+        Grid points outside the detector's range come out as 0. """
+
+    def __init__(self, wavelengths, start, stop, step, mode="interpolate", axis="nm", excitation_nm=None):
+        source = to_axis(wavelengths, axis, excitation_nm)
+        self.axis = axis
+        self.values = numpy.arange(start, stop + step / 2, step)
+        self.pixels = len(source)
+
+        order = numpy.argsort(source)
+        sorted_source = source[order]
+        if mode == "interpolate":
+            rows, cols, weights = self.interpolation(sorted_source, self.values)
+        elif mode == "bin":
+            rows, cols, weights = self.binning(sorted_source, self.values, step)
+        else:
+            raise ValueError("unknown resample mode: %s" % mode)
+
+        # columns refer to sorted pixels, map them back to detector order
+        self.matrix = sparse.csr_matrix((weights, (rows, order[cols])), shape=(len(self.values), self.pixels))
+
+    @staticmethod
+    def interpolation(source, targets):
+        inside = (targets >= source[0]) & (targets <= source[-1])
+        rows = numpy.nonzero(inside)[0]
+        right = numpy.clip(numpy.searchsorted(source, targets[inside]), 1, len(source) - 1)
+        left = right - 1
+        fraction = (targets[inside] - source[left]) / (source[right] - source[left])
+        return (
+            numpy.concatenate([rows, rows]),
+            numpy.concatenate([left, right]),
+            numpy.concatenate([1 - fraction, fraction]))
+
+    @staticmethod
+    def binning(source, targets, step):
+        edges = numpy.append(targets - step / 2, targets[-1] + step / 2)
+        bins = numpy.searchsorted(edges, source, side="right") - 1
+        inside = (bins >= 0) & (bins < len(targets))
+        cols = numpy.nonzero(inside)[0]
+        rows = bins[inside]
+        counts = numpy.bincount(rows, minlength=len(targets))
+        return rows, cols, 1.0 / counts[rows]
+
+    def apply(self, spectrum):
+        return self.matrix @ numpy.asarray(spectrum, dtype=numpy.float64)
+
+
+def transform_for(wavelengths, start, stop, step, mode="interpolate", axis="nm", excitation_nm=None):
+    wavelengths = numpy.asarray(wavelengths, dtype=numpy.float64)
+    key = (wavelengths.tobytes(), start, stop, step, mode, axis, excitation_nm)
+    if key not in _cache:
+        _cache[key] = SpectralTransform(wavelengths, start, stop, step, mode, axis, excitation_nm)
+    return _cache[key]
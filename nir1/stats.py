@@ -0,0 +1,140 @@
+import math
+import numpy
+
+
+class ScanStatistics:
+    """ Running per-pixel statistics over all scan spectra (Welford mean
+        and variance, min/max, saturation counts) plus a robust per-spectrum
+        outlier score used to flag points for re-acquisition.
+
+        The score compares a spectrum with a separate rolling baseline: the
+        mean and variance of about the last `window` spectra, flagged ones
+        included. A sample made of several materials is therefore only
+        flagged where the material changes, until the baseline has caught
+        up. Both accumulators are rows of the same arrays and are updated
+        by the same array operations, one pass over the pixels per step. """
+
+    def __init__(self, saturation_counts=65535, outlier_threshold=4.0, max_saturated_pixels=0, warmup=10, window=16):
+        self.saturation_counts = saturation_counts
+        self.outlier_threshold = outlier_threshold
+        self.max_saturated_pixels = max_saturated_pixels
+        self.warmup = warmup
+        self.window = max(warmup, window)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = None
+        self.min = None
+        self.max = None
+        self.saturated = None
+        self.flagged = []
+
+    def allocate(self, pixels):
+        # row 0: Welford mean and M2 of all scan spectra; row 1: the rolling
+        # baseline mean and variance the outlier score is taken against
+        self.means = numpy.zeros((2, pixels))
+        self.spreads = numpy.zeros((2, pixels))
+        self.mean, self.baseline = self.means
+        self.m2, self.baseline_variance = self.spreads
+        self.min = numpy.full(pixels, numpy.inf)
+        self.max = numpy.full(pixels, -numpy.inf)
+        self.saturated = numpy.zeros(pixels, dtype=numpy.int64)
+        self.delta = numpy.empty((2, pixels))
+        self.squares = numpy.empty((2, pixels))
+        self.work = numpy.empty(pixels)
+        self.step = numpy.empty((2, 1))
+        self.decay = numpy.ones((2, 1))
+        self.gain = numpy.empty((2, 1))
+
+    def variance(self):
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    def update(self, spectrum, position=None):
+        """ Folds one spectrum into the running statistics and returns a
+            summary dict (min, max, mean, std, saturated, score, outlier,
+            flagged). """
+        spectrum = numpy.asarray(spectrum, dtype=numpy.float64)
+        if self.mean is None or self.mean.shape != spectrum.shape:
+            self.reset()
+            self.allocate(len(spectrum))
+
+        delta, squares, work = self.delta, self.squares, self.work
+        numpy.subtract(spectrum, self.means, out=delta)
+        numpy.multiply(delta, delta, out=squares)
+
+        # robust outlier score: median |z| against the baseline, so a single
+        # hot pixel does not flag a point but a shifted spectrum does. It is
+        # taken as the root of the median z**2, which saves an abs and a sqrt
+        # over the pixels.
+        score = 0.0
+        if self.count >= self.warmup:
+            numpy.maximum(self.baseline_variance, 1e-18, out=work)
+            numpy.divide(squares[1], work, out=work)
+            score = math.sqrt(float(numpy.median(work)))
+
+        # mean += step * delta and spread = decay * spread + gain * delta**2:
+        # Welford (M2 += (n - 1) / n * delta**2) for the whole scan, and for
+        # the baseline an exponential window that is the plain running
+        # mean/variance until `window` spectra have been seen
+        n = self.count + 1
+        weight = 1.0 / min(n, self.window)
+        self.step[:, 0] = (1.0 / n, weight)
+        self.decay[1, 0] = 1 - weight
+        self.gain[:, 0] = ((n - 1.0) / n, weight * (1 - weight))
+        delta *= self.step
+        self.means += delta
+        squares *= self.gain
+        self.spreads *= self.decay
+        self.spreads += squares
+
+        self.count = n
+        numpy.minimum(self.min, spectrum, out=self.min)
+        numpy.maximum(self.max, spectrum, out=self.max)
+
+        # the per-spectrum summary comes from one sum and one dot product;
+        # saturation is only counted when the peak reaches it
+        peak = float(spectrum.max())
+        saturated_count = 0
+        if peak >= self.saturation_counts:
+            saturated = spectrum >= self.saturation_counts
+            saturated_count = int(numpy.count_nonzero(saturated))
+            self.saturated += saturated
+        total = float(spectrum.sum())
+        spectrum_mean = total / len(spectrum)
+        variance = float(numpy.dot(spectrum, spectrum)) / len(spectrum) - spectrum_mean * spectrum_mean
+
+        outlier = score > self.outlier_threshold
+        flagged = outlier or saturated_count > self.max_saturated_pixels
+        if flagged:
+            self.flagged.append((self.count - 1, position, score, saturated_count))
+
+        return {
+            "min": float(spectrum.min()),
+            "max": peak,
+            "mean": spectrum_mean,
+            "std": math.sqrt(max(variance, 0.0)),
+            "saturated": saturated_count,
+            "score": score,
+            "outlier": outlier,
+            "flagged": flagged,
+        }
+
+    def save(self, path):
+        if self.mean is None:
+            return
+        variance = self.variance()
+        flagged = numpy.array(
+            [(i, *(p if p is not None else (numpy.nan,) * 3), score, sat) for i, p, score, sat in self.flagged],
+            dtype=numpy.float64).reshape(-1, 6)
+        numpy.savez(
+            path,
+            count=self.count,
+            mean=self.mean,
+            variance=variance if variance is not None else numpy.full_like(self.mean, numpy.nan),
+            min=self.min,
+            max=self.max,
+            saturated=self.saturated,
+            flagged=flagged)
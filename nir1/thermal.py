@@ -0,0 +1,128 @@
+import time
+import threading
+import collections
+
+READY = "ready"
+NOT_READY = "timeout"
+UNAVAILABLE = "unavailable"
+
+
+class ThermalMonitor:
+    """ Samples the detector temperature on a background thread and tells
+        the acquisition when the detector is within tolerance_degC of the
+        TEC setpoint and has stayed within stability_degC for window_s.
+
+        read_temperature() returns degC or None (e.g. the device is busy);
+        temperatures of finished readings can be fed in with observe(), so
+        devices that cannot be polled still get a history. Without a
+        setpoint only stability is checked. """
+
+    def __init__(self, read_temperature, setpoint_degC=None, tolerance_degC=1.0, stability_degC=0.2, window_s=5.0,
+                 interval_s=1.0, clock=time.monotonic):
+        self.read_temperature = read_temperature
+        self.setpoint_degC = setpoint_degC
+        self.tolerance_degC = tolerance_degC
+        self.stability_degC = stability_degC
+        self.window_s = window_s
+        self.interval_s = interval_s
+        self.clock = clock
+        self.samples = collections.deque()
+        # set once read_temperature() returned a value
+        self.polled = False
+        self.started = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.started = self.clock()
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+
+    def loop(self):
+        failing = False
+        while self.running:
+            try:
+                temperature = self.read_temperature()
+            except Exception as exc:
+                # report a failing read once, not every interval
+                if not failing:
+                    print("thermal monitor: cannot read temperature: %s" % exc)
+                failing = True
+                temperature = None
+            else:
+                if failing:
+                    print("thermal monitor: temperature readable again")
+                failing = False
+            if temperature is not None:
+                self.polled = True
+                self.observe(temperature)
+            with self.condition:
+                self.condition.wait(self.interval_s)
+
+    def observe(self, temperature_degC):
+        if temperature_degC is None:
+            return
+        now = self.clock()
+        with self.condition:
+            self.samples.append((now, float(temperature_degC)))
+            # keep two windows: enough to tell whether a full window is covered
+            while self.samples and self.samples[0][0] < now - 2 * self.window_s:
+                self.samples.popleft()
+            self.condition.notify_all()
+
+    def temperature(self):
+        return self.samples[-1][1] if self.samples else None
+
+    def error(self):
+        if self.setpoint_degC is None or not self.samples:
+            return None
+        return self.samples[-1][1] - self.setpoint_degC
+
+    def stable(self):
+        if not self.samples:
+            return False
+        newest = self.samples[-1][0]
+        # the history has to reach back a whole window
+        if self.samples[0][0] > newest - self.window_s:
+            return False
+        values = [t for when, t in self.samples if when >= newest - self.window_s]
+        return max(values) - min(values) <= self.stability_degC
+
+    def ready(self):
+        error = self.error()
+        if error is not None and abs(error) > self.tolerance_degC:
+            return False
+        return self.stable()
+
+    def wait_ready(self, timeout_s, keep_going=lambda: True):
+        """ Blocks until ready(), timeout_s passes or keep_going() turns
+            False. Returns (state, waited ms). If polling never worked there
+            is nothing to wait for: after a few poll intervals the state of
+            the observed readings is returned straight away. """
+        start = self.clock()
+        if self.started is None:
+            # not monitoring (no device connected)
+            return READY if self.ready() else NOT_READY if self.samples else UNAVAILABLE, 0
+        with self.condition:
+            while True:
+                if self.ready():
+                    state = READY
+                    break
+                now = self.clock()
+                if not self.polled and now - (self.started or start) > 3 * self.interval_s:
+                    state = NOT_READY if self.samples else UNAVAILABLE
+                    break
+                if now - start >= timeout_s or not keep_going():
+                    state = NOT_READY
+                    break
+                self.condition.wait(min(self.interval_s, timeout_s - (now - start)))
+        return state, int((self.clock() - start) * 1000)
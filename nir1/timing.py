@@ -0,0 +1,68 @@
+import time
+
+# wall clock at a known monotonic instant: timestamps derived from the
+# monotonic clock keep their spacing even if the system clock is adjusted
+_WALL_ORIGIN_NS = time.time_ns()
+_MONOTONIC_ORIGIN_NS = time.monotonic_ns()
+
+
+def wall_ns(monotonic_ns):
+    """ Unix time (ns) of a time.monotonic_ns() value. """
+    return _WALL_ORIGIN_NS + monotonic_ns - _MONOTONIC_ORIGIN_NS
+
+
+class DeadlineScheduler:
+    """ Paces a loop on time.monotonic_ns deadlines.
+
+        With period_ms > 0 cycle n is due at start + n * period, however
+        long the earlier cycles took, so the sampling rate does not drift.
+        A cycle that overruns the following deadline(s) makes them missed:
+        they are counted and skipped rather than run back-to-back to catch
+        up. period_ms = 0 runs as fast as possible. """
+
+    def __init__(self, period_ms=0, clock=time.monotonic_ns, sleep=time.sleep):
+        self.period_ns = max(0, int(round(period_ms * 1e6)))
+        self.clock = clock
+        self.sleep = sleep
+        self.start_ns = None
+        self.next_ns = None
+        self.cycles = 0
+        self.missed = 0
+        self.max_late_ns = 0
+
+    def wait(self):
+        """ Sleeps until the next deadline. Returns (start ns of the cycle,
+            ns it started late). """
+        now = self.clock()
+        if self.start_ns is None:
+            self.start_ns = now
+            self.next_ns = now
+        if self.period_ns == 0:
+            self.cycles += 1
+            return now, 0
+
+        if now < self.next_ns:
+            self.sleep((self.next_ns - now) / 1e9)
+            now = self.clock()
+        late = now - self.next_ns
+        if late >= self.period_ns:
+            skipped = late // self.period_ns
+            self.missed += skipped
+            self.next_ns += skipped * self.period_ns
+            late -= skipped * self.period_ns
+        deadline = self.next_ns
+        self.next_ns += self.period_ns
+        self.cycles += 1
+        self.max_late_ns = max(self.max_late_ns, late)
+        return deadline + late, late
+
+    def elapsed_s(self):
+        return 0.0 if self.start_ns is None else (self.clock() - self.start_ns) / 1e9
+
+    def rate_hz(self):
+        elapsed = self.elapsed_s()
+        return self.cycles / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return "%d cycles in %.3f s (%.3f Hz), %d missed deadline(s), max lateness %.1f ms" % (
+            self.cycles, self.elapsed_s(), self.rate_hz(), self.missed, self.max_late_ns / 1e6)
@@ -6,8 +6,8 @@ import numpy
 import signal
 import psutil
 import logging
-import datetime
 import argparse
+import threading
 import tkinter as tk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
@@ -19,19 +19,53 @@ from wasatch.OceanDevice          import OceanDevice
 from wasatch.WasatchDevice        import WasatchDevice
 from wasatch.WasatchDeviceWrapper import WasatchDeviceWrapper
 from wasatch.RealUSBDevice        import RealUSBDevice
+from nir1.reference import ReferenceCorrector
+from nir1.stats import ScanStatistics
+from nir1.exposure import AutoExposure
+from nir1.archive import ArchiveWriter
+from nir1.resample import transform_for
+from nir1.inference import InferenceWorker
+from nir1.buffers import PointBuffer
+from nir1.thermal import ThermalMonitor, NOT_READY
+from nir1.timing import DeadlineScheduler, wall_ns
 import logging
 
 log = logging.getLogger(__name__)
 
 class Wasatch:
+    # columns of the per-reading metadata file written next to the spectra
+    META_FIELDS = ["reading", "type", "x", "y", "z", "integration_time_ms", "scans", "snr", "detector_degC", "thermal", "thermal_wait_ms", "unix_ms", "acq_ms", "late_ms"]
+
     def __init__(self, root, argv=None):
         self.bus     = None
         self.device  = None
         self.logger  = None
         self.outfile = None
+        self.corrected_outfile = None
+        self.metafile = None
+        self.archive = None
+        self.journal = None
+        self.reading_meta = {}
         self.type = "default"
-        self.light_spectrum = None
         self.args = self.parse_args(argv)
+        self.corrector = ReferenceCorrector(self.args.correction, self.args.reference_average)
+        self.stats = ScanStatistics(self.args.saturation_counts, self.args.outlier_threshold)
+        self.exposure = AutoExposure(self.args.saturation_counts, self.args.exposure_target)
+        self.applied_settings = {}
+        self.last_error = None
+        # time.monotonic_ns() when the current acquisition started
+        self.acquisition_start_ns = None
+        # serializes device access between acquisition and the thermal monitor
+        self.device_lock = threading.RLock()
+        self.thermal = ThermalMonitor(
+            self.read_detector_temperature,
+            self.args.tec_setpoint,
+            self.args.thermal_tolerance,
+            self.args.thermal_stability,
+            self.args.thermal_window_s)
+        self.inference = None
+        if self.args.model:
+            self.set_model(self.args.model)
         self.logger = applog.MainLogger(self.args.log_level)
         print("Wasatch.PY version %s", wasatch.__version__)
         self.root = root
@@ -59,34 +93,45 @@ class Wasatch:
         self.points_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
         self.points_window.withdraw()
 
-        self.points = []
+        self.points = PointBuffer()
+        self.measured_scatter = None
+        self.plan = None
         self.scan_points = None
         self.predicted_points = None
 
         self.position = (None, None, None)
         self.bounds = None
 
+        # crop/resample matrix latched for the output file it was opened
+        # with, so every row matches the axis written in the file's header
+        self.transform = None
+        self.transform_path = None
+
+        self.last_reading = None
+        self.last_spectrum = None
+        self.last_summary = None
+        # callables(type, position, spectrum) run after every processed reading
+        self.reading_listeners = []
+        # stop predicate: False makes a pending thermal wait give up (e.g. the GUI's Stop)
+        self.keep_going = lambda: True
+
     def set_logger_handler(self, logger_handler):
         self.logger.addHandler(logger_handler)
 
-    def set_scan_bounds(self, x1, x2, y1, y2, z1, z2, points=None, count_x=1, count_y=1, count_z=1):
-        self.bounds = (x1, x2, y1, y2, z1, z2)
+    def set_scan_plan(self, plan, points=None):
+        self.plan = plan
+        self.bounds = plan.bounds
         self.scan_points = points
-        self.predicted_points = []
-        try:
-            step_x = (x2 - x1) / (count_x - 1) if count_x > 1 else 0
-            step_y = (y2 - y1) / (count_y - 1) if count_y > 1 else 0
-            step_z = (z2 - z1) / (count_z - 1) if count_z > 1 else 0
-            for k in range(count_z):
-                z = z1 + k * step_z
-                for i in range(count_x):
-                    x = x1 + i * step_x
-                    for j in range(count_y):
-                        y = y1 + j * step_y
-                        self.predicted_points.append((x, y, z))
-        except Exception:
-            pass
+        self.predicted_points = plan.points
+
+        pixels = self.output_pixels() if self.args.keep_spectra else None
+        # a little headroom for rescans and reference pauses before it has to grow
+        self.points = PointBuffer(len(plan) + len(plan) // 8 + 16, pixels)
+        self.update_points_plot()
 
+    def extend_scan_plan(self, plan):
+        self.predicted_points = numpy.vstack([self.predicted_points, plan.points])
+        self.points.reserve(len(self.points) + len(plan) + len(plan) // 8 + 16)
         self.update_points_plot()
 
     def parse_args(self, argv):
@@ -100,6 +145,33 @@ class Wasatch:
         parser.add_argument("--max",                 type=int, default=0,      help="max spectra to acquire (default 0, unlimited)")
         parser.add_argument("--non-blocking",        action="store_true",      help="non-blocking USB interface (WasatchDeviceWrapper instead of WasatchDevice)")
         parser.add_argument("--ascii-art",           action="store_true",      help="graph spectra in ASCII")
+        parser.add_argument("--correction",          type=str, default="reflectance", choices=ReferenceCorrector.MODES, help="corrected output written next to raw (default reflectance)")
+        parser.add_argument("--reference-average",   type=int, default=1,      help="dark/light readings averaged into each reference (default 1)")
+        parser.add_argument("--saturation-counts",   type=int, default=65535,  help="detector counts treated as saturated (default 65535)")
+        parser.add_argument("--outlier-threshold",   type=float, default=4.0,  help="robust outlier score that flags a scan point (default 4.0)")
+        parser.add_argument("--target-snr",          type=float, default=0,    help="average single scans per point until this SNR is reached (default 0, fixed averaging)")
+        parser.add_argument("--max-point-ms",        type=int, default=2000,   help="time budget per point for SNR-driven averaging (ms, default 2000)")
+        parser.add_argument("--max-adaptive-scans",  type=int, default=100,    help="max scans per point for SNR-driven averaging (default 100)")
+        parser.add_argument("--auto-exposure",       action="store_true",      help="adjust integration time from the peak counts of previous readings")
+        parser.add_argument("--exposure-target",     type=float, default=0.7,  help="auto-exposure target peak as fraction of full scale (default 0.7)")
+        parser.add_argument("--model",               type=str, default=None, help="fitted scikit-learn pipeline (joblib/pickle) run on every scan spectrum")
+        parser.add_argument("--model-input",         type=str, default="spectrum", choices=["spectrum", "corrected"], help="feed the model processed counts or reference-corrected spectra (default spectrum)")
+        parser.add_argument("--inference-batch",     type=int, default=32, help="max spectra per model call (default 32)")
+        parser.add_argument("--archive",             type=str, default=None, choices=["zlib", "lzma"], help="also store raw counts in a compressed .nirz archive")
+        parser.add_argument("--resample",            type=str, default=None,   help="crop and resample spectra at acquisition time, 'start:stop:step' on the resample axis")
+        parser.add_argument("--resample-mode",       type=str, default="interpolate", choices=["interpolate", "bin"], help="linear interpolation or pixel binning (default interpolate)")
+        parser.add_argument("--resample-axis",       type=str, default="nm",   choices=["nm", "wavenumber"], help="axis of the resampled grid (default nm)")
+        parser.add_argument("--excitation-nm",       type=float, default=None, help="excitation wavelength, makes the wavenumber axis a Raman shift")
+        parser.add_argument("--blocked-pixels",      type=str, default=None,   help="'start:stop' detector pixels that never see light; their level triggers automatic references on dark drift")
+        parser.add_argument("--tec-setpoint",        type=float, default=None, help="detector TEC setpoint in degC (default from the EEPROM)")
+        parser.add_argument("--thermal-tolerance",   type=float, default=1.0,  help="max distance from the TEC setpoint before acquiring, degC (default 1.0)")
+        parser.add_argument("--thermal-stability",   type=float, default=0.2,  help="max detector temperature swing within the stability window, degC (default 0.2)")
+        parser.add_argument("--thermal-window-s",    type=float, default=5.0,  help="stability window in seconds (default 5)")
+        parser.add_argument("--thermal-timeout-s",   type=float, default=120,  help="max wait for a thermally ready detector before acquiring anyway, 0 = don't wait (default 120)")
+        parser.add_argument("--recovery-attempts",   type=int, default=5,      help="reconnect attempts per failed point before a scan stops (default 5)")
+        parser.add_argument("--recovery-budget-s",   type=float, default=1800, help="total time a scan may spend recovering from faults (default 1800)")
+        parser.add_argument("--reading-timeout-s",   type=float, default=10.0, help="seconds on top of the acquisition time before a reading counts as failed (default 10)")
+        parser.add_argument("--keep-spectra",        action="store_true",      help="keep the spectra of the current scan in memory (4 bytes per pixel per point)")
         parser.add_argument("--version",             action="store_true",      help="display Wasatch.PY version and exit")
 
         # parse argv into dict
@@ -158,35 +230,177 @@ class Wasatch:
 
         self.device = device
         self.reading_count = 0
+        self.applied_settings = {}
+
+        # the TEC is switched on once per connection; acquisitions wait on the thermal monitor
+        self.apply_setting("detector_tec_enable", True)
+        if self.args.tec_setpoint is not None:
+            self.apply_setting("detector_tec_setpoint_degC", self.args.tec_setpoint)
+        self.thermal.setpoint_degC = self.tec_setpoint()
+        self.thermal.start()
 
         return device
 
-    def run(self, type):
+    def tec_setpoint(self):
+        if self.args.tec_setpoint is not None:
+            return self.args.tec_setpoint
+        eeprom = getattr(getattr(self.device, "settings", None), "eeprom", None)
+        if eeprom is not None and getattr(eeprom, "has_cooling", False):
+            return getattr(eeprom, "startup_temp_degC", None)
+        return None
+
+    def read_detector_temperature(self):
+        """ Polled by the thermal monitor; None when the device is busy
+            acquiring or cannot be queried (non-blocking wrapper). """
+        hardware = getattr(self.device, "hardware", None)
+        if hardware is None or not self.device_lock.acquire(blocking=False):
+            return None
+        try:
+            response = hardware.get_detector_temperature_degC()
+        finally:
+            self.device_lock.release()
+        value = getattr(response, "data", response)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return float(value)
+
+    def run(self, type, paced=True, late_ms=None, keep_going=None):
+        """ Takes one reading. paced makes the call last at least delay_ms
+            (point scans); run_series() paces time series itself and passes
+            how late the reading started. keep_going defaults to
+            self.keep_going; once it turns False the reading is not taken. """
+        keep_going = keep_going or self.keep_going
         self.type = type
-        self.position = (None, None, None)
+        self.reading_meta = {}
         if self.device is None:
             print("Not connected to spectrometer")
             return False
 
-        # apply initial settings
-        self.device.change_setting("integration_time_ms", self.args.integration_time_ms)
-        self.device.change_setting("scans_to_average", self.args.scans_to_average)
-        self.device.change_setting("detector_tec_enable", True)
-
-        start_time = datetime.datetime.now()
-        self.attempt_reading()
-        end_time = datetime.datetime.now()
-
-      
-        # compute how much longer we should wait before the next reading
-        reading_time_ms = int((end_time - start_time).microseconds / 1000)
-        sleep_ms = self.args.delay_ms - reading_time_ms
-        if sleep_ms > 0:
-            print("sleeping %d ms (%d ms already passed)", sleep_ms, reading_time_ms)
+        # apply initial settings; SNR-driven averaging is done here from single scans
+        adaptive = self.args.target_snr > 0
+        try:
+            self.apply_setting("integration_time_ms", self.args.integration_time_ms)
+            self.apply_setting("scans_to_average", 1 if adaptive else self.args.scans_to_average)
+        except Exception as exc:
+            print("run: cannot apply settings: %s" % exc)
+            self.last_error = exc
+            return False
+        self.reading_meta["integration_time_ms"] = self.args.integration_time_ms
+
+        # wait only as long as the detector is off setpoint or drifting
+        thermal, waited_ms = self.thermal.wait_ready(self.args.thermal_timeout_s, keep_going)
+        if not keep_going():
+            print("run: stopped while waiting for the detector")
+            return False
+        if thermal == NOT_READY and self.args.thermal_timeout_s > 0:
+            print("run: detector not thermally stable after %d ms, acquiring anyway" % waited_ms)
+        temperature = self.thermal.temperature()
+        self.reading_meta["detector_degC"] = "%.2f" % temperature if temperature is not None else ""
+        self.reading_meta["thermal"] = thermal
+        self.reading_meta["thermal_wait_ms"] = waited_ms
+
+        self.reading_meta["late_ms"] = "%.3f" % late_ms if late_ms is not None else ""
+        start_ns = time.monotonic_ns()
+        self.acquisition_start_ns = start_ns
+        self.reading_meta["unix_ms"] = "%.3f" % (wall_ns(start_ns) / 1e6)
+        if adaptive:
+            reading = self.acquire_adaptive()
+            ok = reading is not None
+            if ok:
+                self.process_reading(reading)
+        else:
+            self.reading_meta["scans"] = self.args.scans_to_average
+            ok = self.attempt_reading()
+        if not ok:
+            return False
+
+        if paced:
+            # compute how much longer we should wait before the next reading
+            reading_time_ms = (time.monotonic_ns() - start_ns) / 1e6
+            sleep_ms = self.args.delay_ms - reading_time_ms
+            if sleep_ms > 0:
+                print("sleeping %d ms (%d ms already passed)" % (sleep_ms, reading_time_ms))
+                time.sleep(sleep_ms / 1000)
+        return True
+
+    def acquire_spectrum(self):
+        """ One spectrum with the current settings, boxcar and resampling,
+            that is not recorded anywhere (e.g. autofocus probes). None on
+            failure. """
+        if self.device is None:
+            return None
+        try:
+            self.apply_setting("integration_time_ms", self.args.integration_time_ms)
+            self.apply_setting("scans_to_average", self.args.scans_to_average)
+        except Exception as exc:
+            print("acquire_spectrum: cannot apply settings: %s" % exc)
+            self.last_error = exc
+            return None
+        reading = self.read_spectrum()
+        if reading is None:
+            return None
+        spectrum = reading.spectrum
+        if self.args.boxcar_half_width > 0:
+            spectrum = utils.apply_boxcar(spectrum, self.args.boxcar_half_width)
+        transform = self.spectral_transform()
+        if transform is not None:
+            spectrum = transform.apply(spectrum)
+        return numpy.asarray(spectrum, dtype=numpy.float64)
+
+    def run_series(self, type, period_ms=0, count=0, duration_s=0, keep_going=lambda: True):
+        """ Time series at the current position: one reading every
+            period_ms on a drift-free schedule, or back-to-back with
+            period_ms 0, until count readings or duration_s (0 = no limit)
+            or keep_going() turns False. Returns the scheduler, which holds
+            the achieved rate and the missed deadlines. """
+        scheduler = DeadlineScheduler(period_ms)
+        while keep_going():
+            if count and scheduler.cycles >= count:
+                break
+            if duration_s and scheduler.elapsed_s() >= duration_s:
+                break
+            missed = scheduler.missed
+            _, late_ns = scheduler.wait()
+            if scheduler.missed > missed:
+                print("run_series: missed %d deadline(s)" % (scheduler.missed - missed))
+            if not self.run(type, paced=False, late_ms=late_ns / 1e6, keep_going=keep_going):
+                break
+        print("run_series: %s" % scheduler.summary())
+        return scheduler
+
+    def apply_setting(self, setting, value):
+        # only talk to the device when the value actually changes
+        if self.applied_settings.get(setting) == value:
+            return
+        with self.device_lock:
+            self.device.change_setting(setting, value)
+        self.applied_settings[setting] = value
+
+    def reconnect(self):
+        """ Drops the device, rediscovers the bus and reapplies the settings
+            that were in use. Returns True when a device is connected again. """
+        settings = dict(self.applied_settings)
+        reading_count = self.reading_count
+        if self.device is not None:
             try:
-                time.sleep(float(sleep_ms) / 1000)
-            except:
-                pass
+                self.device.disconnect()
+            except Exception as exc:
+                print("reconnect: disconnect failed: %s" % exc)
+        self.device = None
+        self.bus = None
+        try:
+            if self.connect() is None:
+                return False
+            # keep numbering the readings of the current output file
+            self.reading_count = reading_count
+            for setting, value in settings.items():
+                self.apply_setting(setting, value)
+        except Exception as exc:
+            print("reconnect failed: %s" % exc)
+            self.last_error = exc
+            self.device = None
+            return False
+        print("reconnect: restored %d setting(s)" % len(settings))
         return True
 
     def run_with_position(self, label, x, y, z):
@@ -194,88 +408,256 @@ class Wasatch:
         return self.run(label)
 
     def attempt_reading(self):
+        reading = self.read_spectrum()
+        if reading is None:
+            return False
+        self.process_reading(reading)
+        return True
+
+    def read_spectrum(self):
+        """ One reading from the device, or None on failure (last_error
+            says why). """
         try:
             reading_response = self.acquire_reading()
         except Exception as exc:
-            print("attempt_reading caught exception", exc_info=1)
-            return
+            print("read_spectrum caught exception: %s" % exc)
+            self.last_error = exc
+            return None
 
         if isinstance(reading_response.data, bool):
             if reading_response.data:
                 print("received poison-pill, exiting")
-                return
+                self.last_error = "device closed"
+                return None
             else:
                 print("no reading available")
-                return
+                self.last_error = "no reading available"
+                return None
 
         if reading_response.data.failure:
-            return
-
-        self.process_reading(reading_response.data)
+            self.last_error = "reading failed"
+            return None
+
+        return reading_response.data
+
+    def acquire_adaptive(self):
+        """ Averages single scans until the running mean reaches the target
+            SNR, the per-point time budget is spent or max scans is hit. """
+        start = time.monotonic()
+        count = 0
+        mean = None
+        m2 = None
+        snr = 0.0
+        while True:
+            reading = self.read_spectrum()
+            if reading is None:
+                return None
+
+            # Welford update of the per-pixel mean and variance
+            spectrum = numpy.asarray(reading.spectrum, dtype=numpy.float64)
+            count += 1
+            if mean is None:
+                mean = spectrum.copy()
+                m2 = numpy.zeros_like(spectrum)
+            else:
+                delta = spectrum - mean
+                mean += delta / count
+                m2 += delta * (spectrum - mean)
+
+            if count >= 2:
+                # signal above the dark over the standard error of the mean, averaged across pixels
+                noise = numpy.sqrt(m2.mean() / (count - 1) / count)
+                signal = max(float(mean.mean()) - self.dark_offset(mean), 0.0)
+                snr = signal / noise if noise > 0 else float("inf")
+                if snr >= self.args.target_snr:
+                    break
+
+            elapsed_ms = (time.monotonic() - start) * 1000
+            if count >= self.args.max_adaptive_scans or elapsed_ms >= self.args.max_point_ms:
+                break
+
+        reading.spectrum = mean
+        reading.averaged = True
+        self.reading_meta["scans"] = count
+        self.reading_meta["snr"] = "%.1f" % snr
+        return reading
 
     def acquire_reading(self):
+        # a device that stops answering is treated as a failed link
+        timeout_s = self.args.reading_timeout_s + self.args.integration_time_ms * self.args.scans_to_average / 1000.0
+        deadline = time.monotonic() + timeout_s
         while True:
-            reading = self.device.acquire_data()
+            with self.device_lock:
+                reading = self.device.acquire_data()
             if reading is None:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("no reading within %.1f s" % timeout_s)
                 print("waiting on next reading")
             else:
                 return reading
 
     def process_reading(self, reading):
-        if self.args.scans_to_average > 1 and not reading.averaged:
+        if self.args.scans_to_average > 1 and self.args.target_snr <= 0 and not reading.averaged:
             return
 
         self.reading_count += 1
+        if self.acquisition_start_ns is not None:
+            self.reading_meta["acq_ms"] = "%.3f" % ((time.monotonic_ns() - self.acquisition_start_ns) / 1e6)
 
         if self.args.boxcar_half_width > 0:
             spectrum = utils.apply_boxcar(reading.spectrum, self.args.boxcar_half_width)
         else:
             spectrum = reading.spectrum
 
-        if self.args.ascii_art:
-            print("\n".join(wasatch.utils.ascii_spectrum(spectrum, rows=20, cols=80, x_axis=self.device.settings.wavelengths, x_unit="nm")))
+        transform = self.spectral_transform()
+        if transform is not None:
+            spectrum = transform.apply(spectrum)
+
+        # only scan spectra feed the scan statistics; references are expected to differ
+        if self.type in ("dark", "light"):
+            summary = None
         else:
-            spectrum_min = numpy.amin(spectrum)
-            spectrum_max = numpy.amax(spectrum)
-            spectrum_avg = numpy.mean(spectrum)
-            spectrum_std = numpy.std (spectrum)
+            summary = self.stats.update(spectrum, self.position if None not in self.position else None)
+        self.last_summary = summary
+
+        if self.args.ascii_art:
+            print("\n".join(wasatch.utils.ascii_spectrum(spectrum, rows=20, cols=80, x_axis=self.output_axis(), x_unit=self.args.resample_axis if self.args.resample else "nm")))
+        elif summary is not None:
             size_in_bytes = psutil.Process(os.getpid()).memory_info().rss
 
-            print("Reading: %10d  Detector: %5.2f degC  Min: %8.2f  Max: %8.2f  Avg: %8.2f  StdDev: %8.2f  Memory: %11d" % (
+            print("Reading: %10d  Detector: %5.2f degC  Min: %8.2f  Max: %8.2f  Avg: %8.2f  StdDev: %8.2f  Saturated: %4d  Score: %5.2f%s  Memory: %11d" % (
                 self.reading_count,
                 reading.detector_temperature_degC,
-                spectrum_min,
-                spectrum_max,
-                spectrum_avg,
-                spectrum_std,
+                summary["min"],
+                summary["max"],
+                summary["mean"],
+                summary["std"],
+                summary["saturated"],
+                summary["score"],
+                "  FLAGGED" if summary["flagged"] else "",
                 size_in_bytes))
             print("%s", str(reading))
 
-        # if self.type == "light":
-        #     self.light_spectrum = spectrum
-        # elif self.type != "dark" and self.light_spectrum is not None:
-        #     # spectrum -= self.light_spectrum
-        #     spectrum = numpy.subtract( spectrum,self.light_spectrum)
-
-        # print(spectrum)
+        self.last_reading = reading
+        self.last_spectrum = spectrum
+        self.thermal.observe(reading.detector_temperature_degC)
+
+        corrected = None
+        if self.type == "dark":
+            self.corrector.add_dark(spectrum, self.reading_meta.get("integration_time_ms"))
+        elif self.type == "light":
+            self.corrector.add_light(spectrum, self.reading_meta.get("integration_time_ms"))
+        if self.type in ("dark", "light"):
+            if self.journal:
+                self.journal.reference(self.type, self.position, spectrum, self.reading_meta.get("integration_time_ms"))
+        else:
+            corrected = self.corrector.correct(spectrum, self.reading_meta.get("integration_time_ms"))
+            if self.args.auto_exposure:
+                self.update_exposure(reading.spectrum)
 
         if self.outfile:
-            x, y, z = self.position
-            self.outfile.write("%s;%s;%s;%s;%.2f;%s\n" % (
+            self.write_row(self.outfile, reading, spectrum, ".2f")
+
+        if self.corrected_outfile and corrected is not None:
+            self.write_row(self.corrected_outfile, reading, corrected, ".2f" if self.corrector.mode == "dark" else ".5f")
+
+        if self.metafile:
+            self.write_meta()
+
+        if self.archive:
+            # averaged spectra are stored as sums so the quantized counts stay exact
+            self.archive.write(
+                reading.spectrum,
                 self.type,
-                format(x, ".2f") if x is not None else "",
-                format(y, ".2f") if y is not None else "",
-                format(z, ".2f") if z is not None else "",
+                self.position,
                 reading.detector_temperature_degC,
-                ";".join(format(x, ".2f") for x in spectrum)))
+                self.reading_meta.get("scans", 1))
+
+        if self.inference and self.type not in ("dark", "light"):
+            model_input = corrected if self.args.model_input == "corrected" else spectrum
+            if model_input is not None:
+                self.inference.submit(self.reading_count, self.type, self.position, model_input)
+
+        for listener in self.reading_listeners:
+            listener(self.type, self.position, spectrum)
 
         if None not in self.position:
-            self.points.append(self.position)
-            self.update_points_plot()
+            self.points.append(
+                self.position,
+                reading=self.reading_count,
+                temperature=reading.detector_temperature_degC,
+                integration_time_ms=self.reading_meta.get("integration_time_ms"),
+                scans=self.reading_meta.get("scans", 1),
+                kind=self.type,
+                flagged=summary is not None and summary["flagged"],
+                spectrum=spectrum)
+            self.update_measured_points()
 
         self.draw_graph(spectrum)
         return
 
+    def write_row(self, outfile, reading, spectrum, value_format):
+        x, y, z = self.position
+        outfile.write("%s;%s;%s;%s;%.2f;%s\n" % (
+            self.type,
+            format(x, ".2f") if x is not None else "",
+            format(y, ".2f") if y is not None else "",
+            format(z, ".2f") if z is not None else "",
+            reading.detector_temperature_degC,
+            ";".join(format(v, value_format) for v in spectrum)))
+
+    def update_exposure(self, spectrum):
+        integration_time_ms = self.exposure.update(spectrum, self.args.integration_time_ms, self.dark_offset(spectrum))
+        if integration_time_ms is not None:
+            print(f"Auto-exposure: integration time {self.args.integration_time_ms} -> {integration_time_ms} ms")
+            self.args.integration_time_ms = integration_time_ms
+
+    def dark_offset(self, spectrum=None):
+        """ Mean counts without light at the current integration time: from
+            the dark reference, else from the blocked pixels of the raw
+            spectrum, else 0. """
+        dark = self.corrector.dark_at(self.args.integration_time_ms)
+        if dark is not None:
+            return float(dark.mean())
+        blocked = self.blocked_pixels()
+        if blocked is not None and spectrum is not None:
+            values = numpy.asarray(spectrum)[blocked]
+            if values.size:
+                return float(values.mean())
+        return 0.0
+
+    def spectral_transform(self):
+        """ Crop/resample matrix applied to readings: the one latched with
+            the output file, otherwise the configured one. """
+        if self.transform_path is not None and self.transform_path == self.args.outfile:
+            return self.transform
+        return self.configured_transform()
+
+    def configured_transform(self):
+        """ Cached crop/resample matrix for the connected device's calibration,
+            or None when spectra are stored per pixel. """
+        if not self.args.resample or self.device is None:
+            return None
+        start, stop, step = (float(v) for v in self.args.resample.split(":"))
+        return transform_for(
+            self.device.settings.wavelengths, start, stop, step,
+            self.args.resample_mode, self.args.resample_axis, self.args.excitation_nm)
+
+    def output_axis(self):
+        transform = self.spectral_transform()
+        return transform.values if transform is not None else self.device.settings.wavelengths
+
+    def write_meta(self):
+        x, y, z = self.position
+        self.reading_meta.update({
+            "reading": self.reading_count,
+            "type": self.type,
+            "x": format(x, ".2f") if x is not None else "",
+            "y": format(y, ".2f") if y is not None else "",
+            "z": format(z, ".2f") if z is not None else "",
+        })
+        self.metafile.write(";".join(str(self.reading_meta.get(f, "")) for f in self.META_FIELDS) + "\n")
+
     ################################################################################
     # my_function
     ################################################################################
@@ -283,7 +665,7 @@ class Wasatch:
     def draw_graph(self, spectrum):
         # Clear previous plot
         self.ax.clear()
-        self.ax.plot(self.device.settings.wavelengths, spectrum)
+        self.ax.plot(self.output_axis(), spectrum)
         self.canvas.draw()
 
     def set_output_file_path(self, outfile_path):
@@ -301,6 +683,7 @@ class Wasatch:
             except Exception as e:
                 print("Error closing previous outfile: %s", str(e))
 
+        self.latch_transform()
         try:
             file_exists = os.path.isfile(self.args.outfile)
             file_has_data = file_exists and os.path.getsize(self.args.outfile) > 0
@@ -309,7 +692,7 @@ class Wasatch:
                 self.outfile = open(self.args.outfile, "a")
             else:
                 self.outfile = open(self.args.outfile, "w")
-                self.outfile.write("type;x;y;z;temp;%s\n" % ";".join(format(x, ".2f") for x in self.device.settings.wavelengths))
+                self.outfile.write("type;x;y;z;temp;%s\n" % ";".join(format(x, ".2f") for x in self.output_axis()))
 
             print('Filepath set to: %s', self.args.outfile)
 
@@ -317,6 +700,72 @@ class Wasatch:
             print("Error initializing %s: %s", self.args.outfile, str(e))
             self.outfile = None
 
+        self.init_sidecar_files()
+
+    def sidecar_path(self, suffix, ext=None):
+        base, outfile_ext = os.path.splitext(self.args.outfile)
+        return f"{base}_{suffix}{ext if ext is not None else outfile_ext}"
+
+    def open_sidecar(self, previous, path, header):
+        """ Closes the previous sidecar file and opens path for appending,
+            writing header() first when the file is new or empty. """
+        if previous:
+            try:
+                previous.close()
+            except Exception as e:
+                print(f"Error closing previous {path}: {e}")
+
+        try:
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                return open(path, "a")
+            header_line = header()
+            sidecar = open(path, "w")
+            sidecar.write(header_line)
+            return sidecar
+        except Exception as e:
+            print(f"Error initializing {path}: {e}")
+            return None
+
+    def init_sidecar_files(self):
+        self.init_corrected_file()
+        if self.args.outfile:
+            self.metafile = self.open_sidecar(self.metafile, self.sidecar_path("meta"), lambda: ";".join(self.META_FIELDS) + "\n")
+        self.init_archive()
+        if self.inference:
+            self.inference.set_output(self.sidecar_path("predictions") if self.args.outfile else None)
+
+    def init_archive(self):
+        self.close_archive()
+        if not self.args.outfile or not self.args.archive or self.device is None:
+            return
+        path = self.sidecar_path("raw", ".nirz")
+        try:
+            self.archive = ArchiveWriter(path, self.device.settings.wavelengths, self.args.archive)
+        except Exception as e:
+            print(f"Error initializing {path}: {e}")
+            self.archive = None
+
+    def close_archive(self):
+        if self.archive:
+            stats = self.archive.stats()
+            self.archive.close()
+            self.archive = None
+            if stats["count"]:
+                print("Archive: %d spectra, %.1fx smaller than float64, %.1f MB/s encode" % (
+                    stats["count"], stats["ratio"], stats["encode_mb_s"]))
+
+    def init_corrected_file(self):
+        if not self.args.outfile or self.corrector.mode == "off":
+            if self.corrected_outfile:
+                self.corrected_outfile.close()
+            self.corrected_outfile = None
+            return
+
+        self.corrected_outfile = self.open_sidecar(
+            self.corrected_outfile,
+            self.sidecar_path(self.corrector.mode),
+            lambda: "type;x;y;z;temp;%s\n" % ";".join(format(x, ".2f") for x in self.output_axis()))
+
 
     def set_integration_time(self, integration_time_ms):
         self.args.integration_time_ms = integration_time_ms
@@ -334,12 +783,161 @@ class Wasatch:
         self.args.delay_ms = delay_ms
         print('Delay set to %i ms', delay_ms)
 
+    def set_auto_exposure(self, enabled, target_fraction):
+        self.args.auto_exposure = enabled
+        self.args.exposure_target = target_fraction
+        self.exposure.target_fraction = target_fraction
+        self.exposure.reset()
+        print(f'Auto-exposure {"enabled" if enabled else "disabled"} (target {target_fraction:.0%} of full scale)')
+
+    def set_adaptive_averaging(self, target_snr, max_point_ms):
+        self.args.target_snr = target_snr
+        self.args.max_point_ms = max_point_ms
+        print(f'Target SNR set to {target_snr} ({max_point_ms} ms per point)')
+
+    def set_archive(self, compressor):
+        self.args.archive = compressor
+        if self.outfile and not self.outfile.closed:
+            self.init_archive()
+        print(f'Raw archive {compressor or "disabled"}')
+
+    def set_model(self, model_path):
+        """ Loads a model for live inference, replacing the current one;
+            an empty path disables inference. """
+        listeners = self.inference.listeners if self.inference else []
+        if self.inference:
+            self.inference.stop()
+            self.inference = None
+        self.args.model = model_path or None
+        if not model_path:
+            print('Inference disabled')
+            return True
+        try:
+            self.inference = InferenceWorker(model_path, self.args.inference_batch)
+        except Exception as e:
+            print(f"Cannot load model {model_path}: {e}")
+            self.args.model = None
+            return False
+        self.inference.listeners = listeners
+        if self.outfile and not self.outfile.closed:
+            self.inference.set_output(self.sidecar_path("predictions"))
+        print(f'Model loaded from {model_path}')
+        return True
+
+    def set_resample(self, resample, mode, axis):
+        self.args.resample = resample or None
+        self.args.resample_mode = mode
+        self.args.resample_axis = axis
+        # an output file keeps the grid of its header (see latch_transform)
+        if self.transform_path is not None:
+            print(f'Resample set to {resample or "off"} ({mode}, {axis}); takes effect for the next output file')
+        else:
+            print(f'Resample set to {resample or "off"} ({mode}, {axis})')
+
     def set_max_spectra(self, max_spectra):
         self.args.max = max_spectra
         print('Max spectra set to %i', max_spectra)
 
+    def set_correction(self, mode, reference_average):
+        self.corrector.set_mode(mode)
+        self.corrector.set_average_count(reference_average)
+        self.args.correction = mode
+        self.args.reference_average = reference_average
+        if self.outfile and not self.outfile.closed:
+            self.init_corrected_file()
+        print(f'Correction set to {mode}, {reference_average} reading(s) per reference')
+
+    def reset_statistics(self):
+        self.stats.reset()
+
+    def save_statistics(self):
+        if self.args.outfile and self.stats.mean is not None:
+            path = self.sidecar_path("stats", ".npz")
+            self.stats.save(path)
+            print(f"Scan statistics saved to {path} ({len(self.stats.flagged)} flagged point(s))")
+
+    def last_reading_flagged(self):
+        """ True if the last reading is worth re-acquiring: an outlier, or
+            saturated when auto-exposure has since shortened the integration
+            time (at the same exposure it would saturate again). """
+        summary = self.last_summary
+        if summary is None or not summary["flagged"]:
+            return False
+        if summary["outlier"]:
+            return True
+        return self.args.integration_time_ms != self.reading_meta.get("integration_time_ms")
+
+    # settings saved with a scan journal and restored on resume
+    JOURNAL_SETTINGS = [
+        "integration_time_ms", "scans_to_average", "boxcar_half_width", "delay_ms",
+        "correction", "reference_average", "target_snr", "max_point_ms",
+        "max_adaptive_scans", "auto_exposure", "exposure_target",
+        "resample", "resample_mode", "resample_axis",
+    ]
+
+    def output_files(self):
+        """ Files written per reading, as named by the scan estimator. """
+        files = ["csv", "meta"]
+        if self.corrector.mode != "off":
+            files.append("corrected")
+        if self.args.archive:
+            files.append("archive")
+        return files
+
+    def blocked_pixels(self):
+        """ Slice of the --blocked-pixels raw detector pixels, or None. """
+        if not self.args.blocked_pixels:
+            return None
+        start, stop = (int(v) for v in self.args.blocked_pixels.split(":"))
+        return slice(start, stop)
+
+    def output_pixels(self):
+        if self.device is None:
+            return None
+        return len(self.output_axis())
+
+    def settings_snapshot(self):
+        return {key: getattr(self.args, key) for key in self.JOURNAL_SETTINGS}
+
+    def restore_settings(self, settings):
+        for key in self.JOURNAL_SETTINGS:
+            if key in settings:
+                setattr(self.args, key, settings[key])
+        self.corrector.set_mode(self.args.correction)
+        self.corrector.set_average_count(self.args.reference_average)
+        self.exposure.target_fraction = self.args.exposure_target
+        print(f'Settings restored: {settings}')
+
+    def restore_references(self, references):
+        """ Reloads the last dark/light spectra recorded in a scan journal. """
+        self.corrector.reset()
+        # darks are kept per integration time, so all of them are replayed
+        for entry in references.get("dark", []):
+            self.corrector.add_dark(entry["spectrum"], entry.get("integration_time_ms"))
+        for entry in references.get("light", [])[-self.corrector.average_count:]:
+            self.corrector.add_light(entry["spectrum"], entry.get("integration_time_ms"))
+
+    def resume_output_file(self, outfile_path):
+        # unlike set_output_file_path, keep the interrupted dataset; init_file appends to it
+        if self.outfile:
+            try:
+                self.outfile.close()
+            except Exception as e:
+                print(f"Error closing previous outfile: {e}")
+        self.args.outfile = outfile_path
+        self.latch_transform()
+        print(f'Resuming into {outfile_path}')
+
+    def run_reference(self, type, x=None, y=None, z=None):
+        # take enough readings to fully refresh the averaged reference
+        for _ in range(self.corrector.average_count):
+            if not self.run_with_position(type, x, y, z):
+                return False
+        return True
+
     def init_file(self):
         if self.args.outfile:
+            self.latch_transform()
             try:
                 file_exists = os.path.isfile(self.args.outfile)
                 file_has_data = file_exists and os.path.getsize(self.args.outfile) > 0
@@ -348,15 +946,38 @@ class Wasatch:
                     self.outfile = open(self.args.outfile, "a")  
                 else:
                     self.outfile = open(self.args.outfile, "w")
-                    self.outfile.write("type;x;y;z;temp;%s\n" % ";".join(format(x, ".2f") for x in self.device.settings.wavelengths))
+                    self.outfile.write("type;x;y;z;temp;%s\n" % ";".join(format(x, ".2f") for x in self.output_axis()))
 
             except Exception as e:
                 print(f"Error initializing {self.args.outfile}: {e}")
                 self.outfile = None
 
+            self.init_sidecar_files()
+
+    def latch_transform(self):
+        """ Fixes the transform for the current output file. References
+            taken on another grid no longer fit and are dropped. """
+        if self.transform_path == self.args.outfile:
+            return
+        transform = self.configured_transform()
+        if self.transform_path is not None and transform is not self.transform:
+            self.corrector.reset()
+            print("Spectral grid changed: dark/light references cleared")
+        self.transform = transform
+        self.transform_path = self.args.outfile
+
     def close_file(self):
         if self.args.outfile:
             self.outfile.close()
+        if self.corrected_outfile:
+            self.corrected_outfile.close()
+            self.corrected_outfile = None
+        if self.metafile:
+            self.metafile.close()
+            self.metafile = None
+        self.close_archive()
+        if self.inference:
+            self.inference.set_output(None)
 
 
     def init_file_without_header(self):
@@ -401,13 +1022,11 @@ class Wasatch:
                 if pt:
                     self.points_ax.scatter([pt['X']], [pt['Y']], [pt['Z']], color=colors[idx], marker='^', label=f'Point {key}')
 
-        if self.predicted_points:
-            xs, ys, zs = zip(*self.predicted_points)
+        if self.predicted_points is not None and len(self.predicted_points):
+            xs, ys, zs = self.predicted_points.T
             self.points_ax.scatter(xs, ys, zs, c='gray', alpha=0.3, s=10)
 
-        if self.points:
-            xs, ys, zs = zip(*self.points)
-            self.points_ax.scatter(xs, ys, zs, c='red', marker='o')
+        self.measured_scatter = self.points_ax.scatter(*self.points.columns(), c='red', marker='o')
 
         self.points_ax.set_xlabel('X')
         self.points_ax.set_ylabel('Y')
@@ -418,6 +1037,14 @@ class Wasatch:
 
         self.points_canvas.draw()
 
+    def update_measured_points(self):
+        """ Moves the measured points of the existing plot to the filled part
+            of the buffer instead of redrawing the whole plot. """
+        if self.measured_scatter is None or not self.points_window.winfo_ismapped():
+            return
+        self.measured_scatter._offsets3d = self.points.columns()
+        self.points_canvas.draw_idle()
+
     def toggle_plot(self):
         if self.graph_window.winfo_ismapped():
             self.graph_window.withdraw()  # Hide plot
@@ -453,6 +1080,19 @@ def clean_shutdown():
         if demo.outfile:
             print("closing outfile")
             demo.outfile.close()
+
+        if demo.corrected_outfile:
+            demo.corrected_outfile.close()
+
+        if demo.metafile:
+            demo.metafile.close()
+
+        demo.close_archive()
+
+        if demo.inference:
+            demo.inference.stop()
+
+        demo.thermal.stop()
     sys.exit()
 
 demo = None
@@ -0,0 +1,141 @@
+import json
+import math
+import numpy
+from scan.plan import ScanPlan
+
+INVERSE_PHI = (math.sqrt(5) - 1) / 2
+# plan positions interpolated at once by FocusSurface.z_at
+CHUNK_ROWS = 16384
+
+
+def peak_counts(spectrum):
+    """ Robust spectrum peak: the 99.5th percentile of the counts. """
+    return float(numpy.percentile(spectrum, 99.5))
+
+
+def band_snr(spectrum, mask):
+    """ Mean signal in a band over its pixel noise, estimated from the second
+        difference (std / sqrt(6) for white noise) so the spectral shape
+        itself doesn't count as noise. """
+    values = numpy.asarray(spectrum, dtype=numpy.float64)[mask]
+    noise = numpy.std(numpy.diff(values, 2)) / math.sqrt(6)
+    return float(values.mean() / noise) if noise > 0 else float("inf")
+
+
+def golden_section(measure, lo, hi, tolerance=0.05, max_evaluations=20):
+    """ Maximises measure(z) over [lo, hi], assuming one peak, by shrinking
+        the bracket by the golden ratio per evaluation until it is narrower
+        than tolerance. Returns (best z, best value, [(z, value), ...]) or
+        None if measure() returned None (measurement failed or stopped). """
+    a, b = min(lo, hi), max(lo, hi)
+    evaluations = []
+
+    def evaluate(z):
+        value = measure(z)
+        if value is not None:
+            evaluations.append((z, value))
+        return value
+
+    c = b - INVERSE_PHI * (b - a)
+    d = a + INVERSE_PHI * (b - a)
+    fc = evaluate(c)
+    fd = None if fc is None else evaluate(d)
+    if fd is None:
+        return None
+    while b - a > tolerance and len(evaluations) < max_evaluations:
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - INVERSE_PHI * (b - a)
+            fc = evaluate(c)
+            if fc is None:
+                return None
+        else:
+            a, c, fc = c, d, fd
+            d = a + INVERSE_PHI * (b - a)
+            fd = evaluate(d)
+            if fd is None:
+                return None
+    z, value = max(evaluations, key=lambda e: e[1])
+    return z, value, evaluations
+
+
+class FocusSurface:
+    """ Best-focus Z found at sample XY positions, at most one per
+        cell_size x cell_size region so a region is focused only once, and
+        the Z surface interpolated between them: a least-squares plane (a
+        tilted sample) plus inverse-distance weighted residuals (local
+        relief). """
+
+    def __init__(self, cell_size=5.0):
+        self.cell_size = cell_size
+        # (cell x, cell y) -> (x, y, z, metric value)
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def cached(self, x, y):
+        return self.points.get(self.cell(x, y))
+
+    def add(self, x, y, z, value=None):
+        self.points[self.cell(x, y)] = (float(x), float(y), float(z), value)
+
+    def clear(self):
+        self.points = {}
+
+    def z_at(self, xy, power=2):
+        """ Interpolated Z for (n, 2) XY positions. """
+        xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+        known = numpy.array([p[:3] for p in self.points.values()], dtype=numpy.float64).reshape(-1, 3)
+        if not len(known):
+            raise ValueError("no focus points")
+        design = numpy.column_stack([known[:, :2], numpy.ones(len(known))])
+        if len(known) >= 3 and numpy.linalg.matrix_rank(design) == 3:
+            coefficients = numpy.linalg.lstsq(design, known[:, 2], rcond=None)[0]
+        else:
+            coefficients = numpy.array([0.0, 0.0, known[:, 2].mean()])
+        residuals = known[:, 2] - design @ coefficients
+
+        z = numpy.column_stack([xy, numpy.ones(len(xy))]) @ coefficients
+        # positions x focus points distances, a chunk of positions at a time
+        for start in range(0, len(xy), CHUNK_ROWS):
+            chunk = slice(start, start + CHUNK_ROWS)
+            distances = numpy.hypot(xy[chunk, 0, None] - known[:, 0], xy[chunk, 1, None] - known[:, 1])
+            exact = distances < 1e-9
+            weights = numpy.power(numpy.where(exact, 1.0, distances), -power, out=distances)
+            # a position on a focus point takes that point's residual
+            on_point = exact.any(axis=1)
+            weights[on_point] = exact[on_point]
+            z[chunk] += (weights @ residuals) / weights.sum(axis=1)
+        return z
+
+    def apply(self, plan):
+        """ The plan with every point's Z taken from the surface. Extra Z
+            layers keep their offset from the first layer, so a stack becomes
+            depths below the sample surface. """
+        points = plan.points.astype(numpy.float64)
+        points[:, 2] = self.z_at(points[:, :2]) + (points[:, 2] - points[0, 2])
+        # Z changes alter the travel, so the settle times are recomputed
+        return ScanPlan(points, plan.actions, plan.settle_ms, plan.grid_index, plan.shape, plan.speed).retime()
+
+    def to_dict(self):
+        return {"cell_size": self.cell_size, "points": list(self.points.values())}
+
+    @classmethod
+    def from_dict(cls, data):
+        surface = cls(data["cell_size"])
+        for x, y, z, value in data["points"]:
+            surface.add(x, y, z, value)
+        return surface
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import numpy
+
+# rough sizes of one written value, for the data volume estimate
+CSV_COUNT_BYTES = 9          # '12345.67;'
+CSV_CORRECTED_BYTES = 8      # '0.12345;'
+CSV_ROW_PREFIX_BYTES = 40    # 'scan;x;y;z;temp;'
+META_ROW_BYTES = 60
+ARCHIVE_PIXEL_BYTES = 1.5    # int16 deltas after zlib, typical for NIR counts
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return "%dh %02dm" % (hours, minutes)
+    if minutes:
+        return "%dm %02ds" % (minutes, seconds)
+    return "%ds" % seconds
+
+
+def format_bytes(count):
+    for unit in ("B", "kB", "MB", "GB"):
+        if count < 1000 or unit == "GB":
+            return "%.0f %s" % (count, unit) if unit == "B" else "%.1f %s" % (count, unit)
+        count /= 1000.0
+
+
+class ScanEstimator:
+    """ Predicts scan duration and output size from a ScanPlan.
+
+        Time per point is the move (travel at the plan's feed rate), the
+        plan's settle time, and the acquisition: integration time times
+        scans to average (or the adaptive averaging budget), never less than
+        delay_ms, plus a per-point overhead (USB readout, G-code round
+        trips, file writes) learned from previous runs and kept in a small
+        JSON file. """
+
+    def __init__(self, path="scan_timing.json", default_overhead_ms=150.0):
+        self.path = path
+        self.overhead_ms = default_overhead_ms
+        self.runs = 0
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.overhead_ms = float(data["overhead_ms"])
+                self.runs = int(data.get("runs", 0))
+            except (ValueError, KeyError, OSError) as e:
+                print(f"Ignoring scan timing file {path}: {e}")
+
+    def acquisition_ms(self, settings):
+        if settings.get("target_snr", 0) > 0:
+            # worst case: averaging stops at the per-point budget
+            reading = settings["max_point_ms"]
+        else:
+            reading = settings["integration_time_ms"] * max(1, settings["scans_to_average"])
+        return max(float(reading), float(settings.get("delay_ms", 0)))
+
+    def point_times(self, plan, settings, start=None):
+        """ Predicted seconds per point, without the learned overhead. """
+        points = plan.points.astype(numpy.float64)
+        if not len(points):
+            return numpy.zeros(0)
+        previous = numpy.vstack([points[:1] if start is None else numpy.reshape(start, (1, 3)), points[:-1]])
+        travel = numpy.linalg.norm(points - previous, axis=1)
+        # feed rate is in mm/min
+        move_s = travel / (float(plan.speed) / 60.0)
+        return move_s + plan.settle_ms / 1000.0 + self.acquisition_ms(settings) / 1000.0
+
+    def estimate(self, plan, settings, pixels, files=("csv", "meta")):
+        """ Duration in seconds and bytes written for the plan; files lists
+            the outputs enabled ('csv', 'corrected', 'meta', 'archive'). """
+        count = len(plan)
+        seconds = float(self.point_times(plan, settings).sum()) + count * self.overhead_ms / 1000.0
+        row_bytes = {
+            "csv": CSV_ROW_PREFIX_BYTES + pixels * CSV_COUNT_BYTES,
+            "corrected": CSV_ROW_PREFIX_BYTES + pixels * CSV_CORRECTED_BYTES,
+            "meta": META_ROW_BYTES,
+            "archive": 30 + pixels * ARCHIVE_PIXEL_BYTES,
+        }
+        size = sum(row_bytes[name] for name in files) * count
+        return {"points": count, "seconds": seconds, "bytes": int(size)}
+
+    def record(self, progress):
+        """ Folds the overhead measured by a finished ScanProgress into the
+            stored value. """
+        overhead_ms = progress.measured_overhead_ms()
+        if overhead_ms is None:
+            return
+        # running mean over the first runs, then an exponential average
+        weight = max(1.0 / (self.runs + 1), 0.3)
+        self.overhead_ms += weight * (max(overhead_ms, 0.0) - self.overhead_ms)
+        self.runs += 1
+        if self.path:
+            try:
+                with open(self.path, "w") as f:
+                    json.dump({"overhead_ms": self.overhead_ms, "runs": self.runs}, f)
+            except OSError as e:
+                print(f"Cannot save scan timing to {self.path}: {e}")
+
+
+class ScanProgress:
+    """ Live ETA for a running plan. The predicted time of the remaining
+        points is scaled by how long the finished points actually took
+        against their prediction. """
+
+    def __init__(self, predicted_s, overhead_ms, clock=time.monotonic):
+        self.predicted_s = numpy.asarray(predicted_s, dtype=numpy.float64)
+        self.overhead_s = overhead_ms / 1000.0
+        self.clock = clock
+        self.done = numpy.zeros(len(self.predicted_s), dtype=bool)
+        self.timed = 0
+        self.actual_s = 0.0
+        self.predicted_done_s = 0.0
+        self.last = clock()
+
+    def skip(self, index):
+        """ Point already measured (resume); not timed. """
+        self.done[index] = True
+
+    def restart(self):
+        """ Drops the time spent outside the plan (pause, reference). """
+        self.last = self.clock()
+
+    def point_done(self, index):
+        now = self.clock()
+        self.actual_s += now - self.last
+        self.predicted_done_s += self.predicted_s[index]
+        self.done[index] = True
+        self.timed += 1
+        self.last = now
+
+    def remaining_s(self):
+        remaining = ~self.done
+        predicted = float(self.predicted_s[remaining].sum()) + int(remaining.sum()) * self.overhead_s
+        expected = self.predicted_done_s + self.timed * self.overhead_s
+        if self.timed and expected > 0:
+            return predicted * self.actual_s / expected
+        return predicted
+
+    def measured_overhead_ms(self):
+        if not self.timed:
+            return None
+        return 1000.0 * (self.actual_s - self.predicted_done_s) / self.timed
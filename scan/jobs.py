@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from scan.plan import ScanPlan
+from scan.region import PolygonRegion
+from scan.autofocus import FocusSurface
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class ScanJob:
+    """ One queued scan: the box (user positions 1-5), sample counts, speed,
+        spectrometer settings, output file, optional polygon region and the
+        reference policy. sample_change pauses the queue before the job so
+        the operator can swap samples, with the head parked at `park`.
+        `focus` is the FocusSurface (as to_dict) the scan follows, if any. """
+
+    def __init__(self, name, positions, counts, speed=1000, settings=None, outfile=None, region=None,
+                 references=None, sample_change=False, park=None, focus=None):
+        self.name = name
+        self.positions = positions
+        self.counts = [max(1, int(c)) for c in counts]
+        self.speed = speed
+        # only the keys given here are changed (see Wasatch.restore_settings)
+        self.settings = settings or {}
+        self.outfile = outfile
+        # list of (z, [(x, y), ...]) as in PolygonRegion
+        self.region = region or []
+        # {"auto": bool, "at_start": bool, "dark": pos, "light": pos, thresholds...}
+        self.references = references or {}
+        self.sample_change = sample_change
+        self.park = park
+        self.focus = focus
+        self.status = PENDING
+        self.result = {}
+
+    def plan(self, log=None):
+        p = self.positions
+        plan = ScanPlan.grid(
+            p['1']['X'], p['2']['X'],
+            p['1']['Y'], p['4']['Y'],
+            p['1']['Z'],
+            p['5']['Z'] if p.get('5') else p['1']['Z'],
+            *self.counts,
+            speed=self.speed,
+        )
+        region = PolygonRegion([(z, list(polygon)) for z, polygon in self.region])
+        if region:
+            inside = region.contains(plan.points)
+            if log:
+                log(f"Scan region keeps {int(inside.sum())} of {len(plan)} points")
+            plan = plan.subset(inside).retime()
+        surface = self.surface()
+        if surface is not None and len(plan):
+            plan = surface.apply(plan)
+        return plan
+
+    def surface(self):
+        return FocusSurface.from_dict(self.focus) if self.focus else None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "positions": self.positions,
+            "counts": self.counts,
+            "speed": self.speed,
+            "settings": self.settings,
+            "outfile": self.outfile,
+            "region": [{"z": z, "polygon": [list(v) for v in polygon]} for z, polygon in self.region],
+            "references": self.references,
+            "sample_change": self.sample_change,
+            "park": self.park,
+            "focus": self.focus,
+            "status": self.status,
+            "result": self.result,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(
+            data.get("name", "job"),
+            data["positions"],
+            data.get("counts", [1, 1, 1]),
+            data.get("speed", 1000),
+            data.get("settings"),
+            data.get("outfile"),
+            [(layer["z"], [tuple(v) for v in layer["polygon"]]) for layer in data.get("region", [])],
+            data.get("references"),
+            data.get("sample_change", False),
+            data.get("park"),
+            data.get("focus"),
+        )
+        job.status = data.get("status", PENDING)
+        job.result = data.get("result", {})
+        return job
+
+
+class JobQueue:
+    """ Scan jobs run one after another. The queue is saved after every
+        change, so jobs (and the results of finished ones) survive a
+        restart; a job left 'running' by a crash is run again. """
+
+    def __init__(self, path="scan_queue.json"):
+        self.path = path
+        self.jobs = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.jobs = [ScanJob.from_dict(data) for data in json.load(f)]
+            for job in self.jobs:
+                if job.status == RUNNING:
+                    job.status = PENDING
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump([job.to_dict() for job in self.jobs], f, indent=1)
+        os.replace(tmp, self.path)
+
+    def add(self, job):
+        self.jobs.append(job)
+        self.save()
+
+    def load_jobs(self, path):
+        """ Enqueues the jobs of a JSON file holding one job or a list. """
+        with open(path) as f:
+            data = json.load(f)
+        jobs = [ScanJob.from_dict(entry) for entry in (data if isinstance(data, list) else [data])]
+        for job in jobs:
+            job.status = PENDING
+            job.result = {}
+        self.jobs.extend(jobs)
+        self.save()
+        return jobs
+
+    def pending(self):
+        return [job for job in self.jobs if job.status == PENDING]
+
+    def next_job(self):
+        pending = self.pending()
+        return pending[0] if pending else None
+
+    def clear(self):
+        """ Drops every job that is not running. """
+        self.jobs = [job for job in self.jobs if job.status == RUNNING]
+        self.save()
+
+    def started(self, job, planned_s):
+        job.status = RUNNING
+        job.result = {"started": time.time(), "planned_s": round(planned_s, 1)}
+        self.save()
+
+    def finished(self, job, ok, points, waiting_s=0.0, faults=0):
+        job.status = DONE if ok else FAILED
+        job.result.update({
+            "finished": time.time(),
+            "seconds": round(time.time() - job.result.get("started", time.time()), 1),
+            "points": points,
+            "waiting_s": round(waiting_s, 1),
+            "faults": faults,
+            "outfile": job.outfile,
+        })
+        self.save()
+
+    @staticmethod
+    def report_line(job):
+        r = job.result
+        return "%-20s %-7s %6s points  %8.0f s (planned %.0f s, sample change %.0f s, %d fault(s))  %s" % (
+            job.name, job.status, r.get("points", "-"), r.get("seconds", 0), r.get("planned_s", 0),
+            r.get("waiting_s", 0), r.get("faults", 0), r.get("outfile") or "")
+
+    def report(self):
+        return [self.report_line(job) for job in self.jobs if job.status in (DONE, FAILED)]
@@ -0,0 +1,66 @@
+import json
+import os
+import time
+
+
+class ScanJournal:
+    """ Append-only JSON-lines record of a scan: the plan and settings it was
+        started with, every completed point and every reference acquisition.
+        Each entry is flushed and fsynced, so after a crash the journal holds
+        everything needed to resume. """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+
+    def write(self, event, **data):
+        data["event"] = event
+        data["time"] = time.time()
+        self.file.write(json.dumps(data) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def start(self, plan, settings, outfile, offsets=None):
+        self.write("start", plan=plan, settings=settings, outfile=outfile, offsets=offsets)
+
+    def resumed(self):
+        self.write("resume")
+
+    def point_done(self, index, x, y, z):
+        self.write("point", index=index, position=[x, y, z])
+
+    def reference(self, kind, position, spectrum, integration_time_ms=None):
+        self.write("reference", kind=kind, position=list(position), integration_time_ms=integration_time_ms,
+                   spectrum=[round(float(v), 2) for v in spectrum])
+
+    def finished(self):
+        self.write("finished")
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    @staticmethod
+    def load(path):
+        """ Replays a journal into a dict with the start entry, the set of
+            completed point indices, the reference entries by kind and
+            whether the scan finished. A torn last line is ignored. """
+        state = {"start": None, "completed": set(), "references": {}, "finished": False}
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                event = entry.get("event")
+                if event == "start":
+                    state["start"] = entry
+                elif event == "point":
+                    state["completed"].add(entry["index"])
+                elif event == "reference":
+                    state["references"].setdefault(entry["kind"], []).append(entry)
+                elif event == "finished":
+                    state["finished"] = True
+        if state["start"] is None:
+            raise ValueError("%s has no start entry" % path)
+        return state
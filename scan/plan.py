@@ -0,0 +1,238 @@
+import json
+import numpy
+
+# per-point action flags
+MOVE = 1
+SETTLE = 2
+ACQUIRE = 4
+REFERENCE = 8
+
+# measured time (ms) for the machine to settle after a move of the given step
+SETTLE_STEPS = numpy.array([1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 100, 120, 150])
+SETTLE_TIMES = numpy.array([500, 1150, 1560, 2000, 2700, 3300, 3800, 4400, 4900, 5500, 6600, 7800, 9700])
+SETTLE_MARGIN_MS = 100
+
+
+def settle_time_ms(step):
+    """ Settle time for a move of `step` (scalar or array); steps below 1 use
+        the 1 mm value, steps above 150 the 150 mm value. """
+    return numpy.interp(step, SETTLE_STEPS, SETTLE_TIMES)
+
+
+class ScanPlan:
+    """ Ordered scan points with per-point actions, settle times and grid
+        indices, shared by the executor, the estimator and the plots.
+
+        Points are float32 (x, y, z), actions uint8 flags, settle times
+        float32 ms and grid indices uint32 (i, j, k) - 29 bytes per point.
+        G-code is formatted per point when it is sent (gcode_line); the
+        whole-plan array (gcode) is only built on first use. """
+
+    def __init__(self, points, actions=None, settle_ms=None, grid_index=None, shape=None, speed=1000):
+        self.points = numpy.ascontiguousarray(points, dtype=numpy.float32).reshape(-1, 3)
+        n = len(self.points)
+        self.actions = numpy.full(n, MOVE | SETTLE | ACQUIRE, dtype=numpy.uint8) if actions is None else numpy.asarray(actions, dtype=numpy.uint8)
+        self.settle_ms = numpy.zeros(n, dtype=numpy.float32) if settle_ms is None else numpy.asarray(settle_ms, dtype=numpy.float32)
+        self.grid_index = None if grid_index is None else self.index_array(grid_index)
+        # (count_x, count_y, count_z) when the points lie on a regular grid
+        self.shape = tuple(int(c) for c in shape) if shape is not None else None
+        self.speed = speed
+        self._gcode = None
+        self._layer_grid = None
+
+    def __len__(self):
+        return len(self.points)
+
+    @staticmethod
+    def index_array(grid_index):
+        grid_index = numpy.asarray(grid_index).reshape(-1, 3)
+        if grid_index.size and (grid_index.min() < 0 or grid_index.max() > numpy.iinfo(numpy.uint32).max):
+            raise ValueError("grid index out of range for uint32")
+        return grid_index.astype(numpy.uint32)
+
+    @classmethod
+    def grid(cls, x1, x2, y1, y2, z1, z2, count_x=1, count_y=1, count_z=1, speed=1000):
+        """ Regular grid in the executor's order: Z layers, then X rows, with
+            Y varying fastest. A count of 1 places the single sample at the
+            first bound. """
+        count_x, count_y, count_z = max(1, int(count_x)), max(1, int(count_y)), max(1, int(count_z))
+        xs = numpy.linspace(x1, x2, count_x)
+        ys = numpy.linspace(y1, y2, count_y)
+        zs = numpy.linspace(z1, z2, count_z)
+
+        k, i, j = numpy.indices((count_z, count_x, count_y), dtype=numpy.uint32).reshape(3, -1)
+        points = numpy.empty((len(i), 3), dtype=numpy.float32)
+        points[:, 0] = xs[i]
+        points[:, 1] = ys[j]
+        points[:, 2] = zs[k]
+
+        step_x = xs[1] - xs[0] if count_x > 1 else 0
+        step_y = ys[1] - ys[0] if count_y > 1 else 0
+        step_z = zs[1] - zs[0] if count_z > 1 else 0
+        settle = numpy.full(len(points), settle_time_ms(max(abs(step_x), abs(step_y), abs(step_z))) + SETTLE_MARGIN_MS, dtype=numpy.float32)
+        # the first point of every X row follows the long return move along Y
+        settle[j == 0] += settle_time_ms(abs(step_x) * count_x) + SETTLE_MARGIN_MS
+
+        return cls(points, None, settle, numpy.column_stack((i, j, k)), (count_x, count_y, count_z), speed)
+
+    @property
+    def bounds(self):
+        if not len(self.points):
+            return None
+        lo = self.points.min(axis=0)
+        hi = self.points.max(axis=0)
+        return (float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1]), float(lo[2]), float(hi[2]))
+
+    @property
+    def layer_count(self):
+        if self.grid_index is None:
+            return len(numpy.unique(self.points[:, 2]))
+        return int(self.grid_index[:, 2].max()) + 1 if len(self.points) else 0
+
+    def grid_axis(self, axis):
+        """ (origin, step) of the grid along X (0) or Y (1); a region-masked
+            plan may lack the outer rows, so it comes from the indices. """
+        values = self.points[:, axis].astype(numpy.float64)
+        if self.grid_index is None:
+            return float(values.min()), 1.0
+        index = self.grid_index[:, axis].astype(numpy.int64)
+        lo = numpy.argmin(index)
+        hi = numpy.argmax(index)
+        if index[hi] == index[lo]:
+            return float(values[lo]), 1.0
+        step = (values[hi] - values[lo]) / (index[hi] - index[lo])
+        return float(values[lo] - index[lo] * step), float(step)
+
+    def layer_means(self):
+        """ Mean Z of every layer k, NaN for a layer without points. """
+        if self.grid_index is None:
+            return numpy.unique(self.points[:, 2]).astype(numpy.float64)
+        k = self.grid_index[:, 2].astype(numpy.int64)
+        count = numpy.bincount(k, minlength=self.layer_count)
+        total = numpy.bincount(k, weights=self.points[:, 2], minlength=self.layer_count)
+        return numpy.where(count > 0, total / numpy.maximum(count, 1), numpy.nan)
+
+    def layer_heights(self, xy):
+        """ Z of every layer at each XY: a (layers, len(xy)) array taken from
+            the nearest grid point, or the layer's mean Z where that point is
+            not in the plan. A plan that follows a focus surface has a
+            different Z per point, so layers are told apart by their index
+            k, not by their Z. """
+        xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+        means = self.layer_means()
+        if self.grid_index is None:
+            return numpy.repeat(means[:, None], len(xy), axis=1)
+        if self._layer_grid is None:
+            i, j, k = self.grid_index.T.astype(numpy.int64)
+            self._layer_grid = numpy.full((self.layer_count, j.max() + 1, i.max() + 1), numpy.nan, dtype=numpy.float32)
+            self._layer_grid[k, j, i] = self.points[:, 2]
+        cells = []
+        for axis in (0, 1):
+            origin, step = self.grid_axis(axis)
+            cell = numpy.rint((xy[:, axis] - origin) / step)
+            cells.append(numpy.clip(cell, 0, self._layer_grid.shape[2 - axis] - 1).astype(numpy.int64))
+        heights = self._layer_grid[:, cells[1], cells[0]].astype(numpy.float64)
+        return numpy.where(numpy.isnan(heights), means[:, None], heights)
+
+    def layer_of(self, points):
+        """ Layer index k of arbitrary (x, y, z) points, e.g. measured or
+            refinement positions: the layer whose Z at the point's XY is
+            nearest. Points without a finite position get -1. """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        layers = numpy.full(len(points), -1, dtype=numpy.int64)
+        finite = numpy.isfinite(points).all(axis=1)
+        if not len(self.points) or not finite.any():
+            return layers
+        distance = numpy.abs(self.layer_heights(points[finite, :2]) - points[finite, 2])
+        # an empty layer has no Z at all
+        layers[finite] = numpy.argmin(numpy.nan_to_num(distance, nan=numpy.inf), axis=0)
+        return layers
+
+    def build_gcode(self):
+        """ 'G1 X.. Y.. Z.. F..' for every point as one ASCII bytes array
+            (1 byte per character), formatted column by column. """
+        if not len(self.points):
+            return numpy.array([], dtype=numpy.bytes_)
+        # the machine's X and Y axes run opposite to the GUI coordinates
+        x = numpy.char.mod('%.3f', numpy.subtract(0.0, self.points[:, 0]))
+        y = numpy.char.mod('%.3f', numpy.subtract(0.0, self.points[:, 1]))
+        z = numpy.char.mod('%.3f', self.points[:, 2])
+        gcode = numpy.char.add('G1 X', x)
+        gcode = numpy.char.add(gcode, numpy.char.add(' Y', y))
+        gcode = numpy.char.add(gcode, numpy.char.add(' Z', z))
+        return numpy.char.add(gcode, ' F%s' % self.speed).astype(numpy.bytes_)
+
+    @property
+    def gcode(self):
+        if self._gcode is None:
+            self._gcode = self.build_gcode()
+        return self._gcode
+
+    def gcode_line(self, index):
+        x, y, z = self.points[index]
+        # the machine's X and Y axes run opposite to the GUI coordinates
+        return 'G1 X%.3f Y%.3f Z%.3f F%s' % (0.0 - x, 0.0 - y, z, self.speed)
+
+    def subset(self, mask):
+        """ New plan holding only the points selected by a boolean mask or
+            index array, in their original order. """
+        return ScanPlan(
+            self.points[mask],
+            self.actions[mask],
+            self.settle_ms[mask],
+            self.grid_index[mask] if self.grid_index is not None else None,
+            self.shape,
+            self.speed)
+
+    def retime(self, start=None):
+        """ Recomputes settle times from the actual travel to each point,
+            e.g. after points were removed from a grid. """
+        points = self.points.astype(numpy.float64)
+        previous = numpy.vstack([points[:1] if start is None else numpy.reshape(start, (1, 3)), points[:-1]])
+        travel = numpy.linalg.norm(points - previous, axis=1)
+        self.settle_ms = (settle_time_ms(travel) + SETTLE_MARGIN_MS).astype(numpy.float32)
+        return self
+
+    def to_dict(self):
+        data = {
+            "points": self.points.tolist(),
+            "actions": self.actions.tolist(),
+            "settle_ms": self.settle_ms.tolist(),
+            "shape": list(self.shape) if self.shape else None,
+            "speed": self.speed,
+        }
+        if self.grid_index is not None:
+            data["grid_index"] = self.grid_index.tolist()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["points"], data["actions"], data["settle_ms"], data.get("grid_index"), data.get("shape"), data.get("speed", 1000))
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load_json(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def save_npz(self, path):
+        arrays = {
+            "points": self.points,
+            "actions": self.actions,
+            "settle_ms": self.settle_ms,
+            "shape": numpy.array(self.shape if self.shape else [], dtype=numpy.int64),
+            "speed": numpy.array(str(self.speed)),
+        }
+        if self.grid_index is not None:
+            arrays["grid_index"] = self.grid_index
+        numpy.savez(path, **arrays)
+
+    @classmethod
+    def load_npz(cls, path):
+        with numpy.load(path) as data:
+            shape = data["shape"].tolist() or None
+            grid_index = data["grid_index"] if "grid_index" in data else None
+            return cls(data["points"], data["actions"], data["settle_ms"], grid_index, shape, str(data["speed"]))
@@ -0,0 +1,54 @@
+import time
+
+
+class FaultRecovery:
+    """ Retries an operation that failed on a transient fault (a USB or
+        serial link dropping out): recover, wait, try again, with the wait
+        doubling from base_delay_s up to max_delay_s. Gives up after
+        max_attempts recoveries for one operation or when the time spent
+        recovering during the scan exceeds budget_s. """
+
+    def __init__(self, max_attempts=5, base_delay_s=1.0, max_delay_s=60.0, budget_s=1800, clock=time.monotonic, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.budget_s = budget_s
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.spent_s = 0.0
+        self.faults = 0
+        self.recovered = 0
+
+    def delay(self, attempt):
+        return min(self.base_delay_s * 2 ** attempt, self.max_delay_s)
+
+    def run(self, operation, recover, log=print, keep_going=lambda: True):
+        """ Calls operation() until it returns True. After each failure
+            recover() is called (it returns False if the device could not be
+            reopened) and the operation retried. Returns False once the
+            attempts or the budget are used up or keep_going() turns False. """
+        if operation():
+            return True
+        self.faults += 1
+        start = self.clock()
+        try:
+            for attempt in range(self.max_attempts):
+                wait = self.delay(attempt)
+                if self.spent_s + self.clock() - start + wait > self.budget_s:
+                    log("Recovery budget exhausted")
+                    return False
+                log(f"Fault detected, retrying in {wait:.0f} s (attempt {attempt + 1} of {self.max_attempts})")
+                self.sleep(wait)
+                if not keep_going():
+                    return False
+                if recover() and operation():
+                    self.recovered += 1
+                    log("Recovered")
+                    return True
+            log("Giving up after %d recovery attempts" % self.max_attempts)
+            return False
+        finally:
+            self.spent_s += self.clock() - start
@@ -0,0 +1,117 @@
+import time
+import numpy
+
+
+class DriftMonitor:
+    """ Watches detector temperature, elapsed time and the dark level of scan
+        spectra since the last reference and reports how close any of them is
+        to its threshold (1.0 = threshold reached).
+
+        The dark level is read from blocked_pixels (a slice or index array of
+        detector pixels that never see light), which follow detector offset
+        and dark current whatever the sample. Without them the dark trigger
+        is off: the illuminated pixels change with the sample. """
+
+    def __init__(self, max_temperature_drift_degC=0.5, max_interval_s=1800, max_dark_drift=0.05, blocked_pixels=None,
+                 clock=time.monotonic):
+        self.max_temperature_drift_degC = max_temperature_drift_degC
+        self.max_interval_s = max_interval_s
+        self.max_dark_drift = max_dark_drift
+        self.blocked_pixels = blocked_pixels
+        self.clock = clock
+        self.reset()
+
+    def reset(self, temperature_degC=None):
+        self.reference_time = self.clock()
+        self.reference_temperature = temperature_degC
+        self.reference_dark_level = None
+        self.temperature_drift = 0.0
+        self.dark_drift = 0.0
+
+    def dark_level(self, spectrum):
+        """ Mean of the blocked pixels of a raw spectrum, or None. """
+        if self.blocked_pixels is None:
+            return None
+        values = numpy.asarray(spectrum)[self.blocked_pixels]
+        return float(values.mean()) if values.size else None
+
+    def update(self, temperature_degC, spectrum):
+        if temperature_degC is not None:
+            if self.reference_temperature is None:
+                self.reference_temperature = temperature_degC
+            self.temperature_drift = abs(temperature_degC - self.reference_temperature)
+
+        level = self.dark_level(spectrum) if spectrum is not None and len(spectrum) else None
+        if level is not None:
+            if self.reference_dark_level is None:
+                self.reference_dark_level = level
+            self.dark_drift = abs(level - self.reference_dark_level) / max(abs(self.reference_dark_level), 1.0)
+
+    def ratios(self):
+        ratios = {"interval": (self.clock() - self.reference_time) / self.max_interval_s if self.max_interval_s else 0.0}
+        ratios["temperature"] = self.temperature_drift / self.max_temperature_drift_degC if self.max_temperature_drift_degC else 0.0
+        ratios["dark"] = self.dark_drift / self.max_dark_drift if self.max_dark_drift else 0.0
+        return ratios
+
+    def pressure(self):
+        return max(self.ratios().values())
+
+    def reason(self):
+        ratios = self.ratios()
+        return max(ratios, key=ratios.get)
+
+
+class ReferenceScheduler:
+    """ Decides after which scan point a reference acquisition is inserted.
+
+        Once drift passes soft_fraction of a threshold, the reference is
+        planned after the upcoming point (within lookahead) where the detour
+        through the reference positions costs the least extra travel. If a
+        threshold is reached before that point, the reference is taken
+        immediately. """
+
+    def __init__(self, monitor, reference_positions=None, soft_fraction=0.75, lookahead=50):
+        self.monitor = monitor
+        self.reference_positions = reference_positions or []
+        self.soft_fraction = soft_fraction
+        self.lookahead = lookahead
+        self.planned_index = None
+
+    def enabled(self):
+        return len(self.reference_positions) > 0
+
+    def detour_costs(self, path, start):
+        """ Extra travel for inserting the reference route after each of
+            path[start:start + lookahead]. """
+        route = numpy.asarray(self.reference_positions, dtype=numpy.float64)
+        route_length = numpy.linalg.norm(numpy.diff(route, axis=0), axis=1).sum()
+        points = numpy.asarray(path[start:start + self.lookahead + 1], dtype=numpy.float64)
+
+        to_route = numpy.linalg.norm(points - route[0], axis=1)
+        from_route = numpy.linalg.norm(points - route[-1], axis=1)
+        direct = numpy.linalg.norm(numpy.diff(points, axis=0), axis=1)
+        # after the last point of the path there is no next move to save
+        costs = to_route[:-1] + route_length + from_route[1:] - direct
+        if len(points) <= self.lookahead:
+            costs = numpy.append(costs, to_route[-1] + route_length)
+        return costs
+
+    def reference_due(self, path, index):
+        """ Called after path[index] was measured. Returns True when the
+            reference should be acquired before moving on. """
+        if not self.enabled():
+            return False
+
+        pressure = self.monitor.pressure()
+        if pressure >= 1.0 or index == self.planned_index:
+            return True
+
+        if pressure >= self.soft_fraction and self.planned_index is None:
+            costs = self.detour_costs(path, index)
+            self.planned_index = index + int(numpy.argmin(costs))
+            return self.planned_index == index
+        return False
+
+    def reference_taken(self, temperature_degC=None):
+        self.planned_index = None
+        self.monitor.reset(temperature_degC)
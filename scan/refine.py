@@ -0,0 +1,134 @@
+import numpy
+from scan.plan import ScanPlan, settle_time_ms, SETTLE_MARGIN_MS
+
+
+def spectral_distance(a, b):
+    """ Euclidean distance between spectra relative to their mean norm;
+        works on stacked spectra along the last axis. """
+    norm = 0.5 * (numpy.linalg.norm(a, axis=-1) + numpy.linalg.norm(b, axis=-1))
+    return numpy.linalg.norm(a - b, axis=-1) / numpy.maximum(norm, 1e-12)
+
+
+def nearest_neighbour_order(points, start):
+    """ Greedy travel order through points beginning nearest to start. """
+    remaining = numpy.ones(len(points), dtype=bool)
+    order = numpy.empty(len(points), dtype=numpy.int64)
+    current = numpy.asarray(start, dtype=numpy.float64)
+    for n in range(len(points)):
+        distances = numpy.linalg.norm(points - current, axis=1)
+        distances[~remaining] = numpy.inf
+        nearest = int(numpy.argmin(distances))
+        order[n] = nearest
+        remaining[nearest] = False
+        current = points[nearest]
+    return order
+
+
+class AdaptiveRefiner:
+    """ Coarse-to-fine refinement of a grid plan, as a quadtree per Z layer.
+
+        Cells start as the squares between neighbouring coarse points. A cell
+        whose corner spectra differ by more than `threshold` (see
+        spectral_distance) is split in four, adding its edge midpoints and
+        centre, until `max_depth` splits. Positions are kept on an integer
+        lattice 2**max_depth finer than the coarse grid.
+
+        For a plan that follows a FocusSurface, pass the surface: new points
+        then get its Z at their own XY, with the layer's depth below it. """
+
+    def __init__(self, plan, threshold=0.05, max_depth=2, surface=None):
+        if plan.shape is None or plan.grid_index is None:
+            raise ValueError("adaptive refinement needs a grid plan")
+        count_x, count_y, count_z = plan.shape
+        if count_x < 2 or count_y < 2:
+            raise ValueError("adaptive refinement needs at least 2 points along X and Y")
+
+        self.threshold = threshold
+        self.scale = 2 ** max_depth
+        self.speed = plan.speed
+
+        i, j, k = plan.grid_index.T.astype(numpy.int64)
+        # a masked plan may lack whole rows, so recover the grid axes from the extremes
+        self.x0, self.step_x = self.axis(i, plan.points[:, 0])
+        self.y0, self.step_y = self.axis(j, plan.points[:, 1])
+        self.surface = surface
+        # layer Z, or the layer's offset from the surface when following one
+        self.zs = numpy.zeros(count_z)
+        if surface is None:
+            self.zs[k] = plan.points[:, 2]
+        else:
+            self.zs[k] = plan.points[:, 2] - surface.z_at(plan.points[:, :2])
+
+        # lattice key (u, v, k) of every coarse point, in plan order
+        self.coarse_keys = list(zip((i * self.scale).tolist(), (j * self.scale).tolist(), k.tolist()))
+        self.spectra = {}
+        self.cells = [
+            (u * self.scale, v * self.scale, layer, self.scale)
+            for layer in range(count_z) for u in range(count_x - 1) for v in range(count_y - 1)
+        ]
+
+    def axis(self, index, values):
+        lo = numpy.argmin(index)
+        hi = numpy.argmax(index)
+        if index[hi] == index[lo]:
+            raise ValueError("adaptive refinement needs at least 2 points along X and Y")
+        step = (values[hi] - values[lo]) / (index[hi] - index[lo])
+        return float(values[lo] - index[lo] * step), float(step) / self.scale
+
+    def record(self, key, spectrum):
+        self.spectra[key] = numpy.array(spectrum, dtype=numpy.float64)
+
+    def position(self, key):
+        u, v, k = key
+        return (self.x0 + u * self.step_x, self.y0 + v * self.step_y, self.zs[k])
+
+    def split_cells(self):
+        """ Returns the cells whose corners disagree, dropping every cell that
+            is settled or cannot be split further. """
+        measured = [
+            cell for cell in self.cells
+            if cell[3] > 1 and all(key in self.spectra for key in self.corners(cell))
+        ]
+        if not measured:
+            return []
+
+        corners = numpy.array([[self.spectra[key] for key in self.corners(cell)] for cell in measured])
+        pairs = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+        difference = numpy.max([spectral_distance(corners[:, a], corners[:, b]) for a, b in pairs], axis=0)
+        return [cell for cell, d in zip(measured, difference) if d > self.threshold]
+
+    @staticmethod
+    def corners(cell):
+        u, v, k, size = cell
+        return [(u, v, k), (u + size, v, k), (u, v + size, k), (u + size, v + size, k)]
+
+    def next_batch(self, start):
+        """ Plan for the next refinement level, ordered for short travel from
+            start, and the lattice keys of its points; (None, []) when done. """
+        children = []
+        keys = []
+        seen = set(self.spectra)
+        for u, v, k, size in self.split_cells():
+            half = size // 2
+            for du in (0, half):
+                for dv in (0, half):
+                    children.append((u + du, v + dv, k, half))
+            for du, dv in ((half, 0), (0, half), (half, half), (size, half), (half, size)):
+                key = (u + du, v + dv, k)
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        self.cells = children
+        if not keys:
+            return None, []
+
+        points = numpy.array([self.position(key) for key in keys])
+        if self.surface is not None:
+            points[:, 2] += self.surface.z_at(points[:, :2])
+        order = nearest_neighbour_order(points, start)
+        points = points[order]
+        keys = [keys[n] for n in order]
+
+        travel = numpy.linalg.norm(numpy.diff(numpy.vstack([start, points]), axis=0), axis=1)
+        settle = settle_time_ms(travel) + SETTLE_MARGIN_MS
+        return ScanPlan(points, settle_ms=settle, speed=self.speed), keys
@@ -0,0 +1,84 @@
+import json
+import numpy
+
+
+def points_in_polygon(xy, polygon):
+    """ Even-odd test of many points against one polygon, looping over the
+        polygon's edges and vectorized over the points. """
+    xy = numpy.asarray(xy, dtype=numpy.float64)
+    polygon = numpy.asarray(polygon, dtype=numpy.float64)
+    x = xy[:, 0]
+    y = xy[:, 1]
+    inside = numpy.zeros(len(xy), dtype=bool)
+    if len(polygon) < 3:
+        return inside
+
+    for (px, py), (qx, qy) in zip(polygon, numpy.roll(polygon, -1, axis=0)):
+        if py == qy:
+            continue
+        straddles = (py > y) != (qy > y)
+        crossing_x = px + (y - py) * (qx - px) / (qy - py)
+        inside ^= straddles & (x < crossing_x)
+    return inside
+
+
+class PolygonRegion:
+    """ Scan region given as one polygon per Z layer. A point uses the layer
+        with the nearest Z; a single layer applies to every Z. """
+
+    def __init__(self, layers=None):
+        # list of (z, [(x, y), ...])
+        self.layers = layers or []
+
+    def __bool__(self):
+        return any(len(polygon) >= 3 for _, polygon in self.layers)
+
+    def add_vertex(self, x, y, z):
+        for layer_z, polygon in self.layers:
+            if layer_z == z:
+                polygon.append((x, y))
+                return
+        self.layers.append((z, [(x, y)]))
+
+    def clear(self):
+        self.layers = []
+
+    def contains(self, points):
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        layers = [(z, polygon) for z, polygon in self.layers if len(polygon) >= 3]
+        if not layers:
+            return numpy.ones(len(points), dtype=bool)
+
+        layer_z = numpy.array([z for z, _ in layers])
+        nearest = numpy.argmin(numpy.abs(points[:, 2, None] - layer_z[None, :]), axis=1)
+        inside = numpy.zeros(len(points), dtype=bool)
+        for n, (_, polygon) in enumerate(layers):
+            selected = nearest == n
+            inside[selected] = points_in_polygon(points[selected, :2], polygon)
+        return inside
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"layers": [{"z": z, "polygon": [list(p) for p in polygon]} for z, polygon in self.layers]}, f)
+
+    @classmethod
+    def load(cls, path):
+        """ Reads a region saved by save(), or an outline text file with one
+            'x;y' or 'x;y;z' vertex per line (',' also accepted). """
+        if path.lower().endswith(".json"):
+            with open(path) as f:
+                data = json.load(f)
+            return cls([(layer["z"], [tuple(p) for p in layer["polygon"]]) for layer in data["layers"]])
+
+        region = cls()
+        with open(path) as f:
+            for line in f:
+                fields = line.replace(",", ";").strip().split(";")
+                try:
+                    values = [float(v) for v in fields if v.strip()]
+                except ValueError:
+                    # header or comment line
+                    continue
+                if len(values) >= 2:
+                    region.add_vertex(values[0], values[1], values[2] if len(values) > 2 else 0.0)
+        return region
@@ -0,0 +1,46 @@
+import warnings
+import numpy
+import pytest
+from analysis.pyramid import ImagePyramid
+
+
+def reference_levels(base, count):
+    """ Pyramid levels computed directly from the base with nanmean. """
+    levels = [base]
+    for _ in range(count - 1):
+        image = levels[-1]
+        height, width = (image.shape[0] + 1) // 2, (image.shape[1] + 1) // 2
+        padded = numpy.full((2 * height, 2 * width), numpy.nan)
+        padded[:image.shape[0], :image.shape[1]] = image
+        blocks = padded.reshape(height, 2, width, 2)
+        with warnings.catch_warnings():
+            # all-NaN blocks stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            levels.append(numpy.nanmean(blocks, axis=(1, 3)))
+    return levels
+
+
+@pytest.mark.parametrize("block", [(16, 20, 0, 4), (0, 4, 15, 19), (16, 17, 16, 17), (14, 40, 14, 40)])
+def test_update_clips_edge_blocks(block):
+    base = numpy.full((17, 17), numpy.nan)
+    pyramid = ImagePyramid(base)
+    y0, y1, x0, x1 = block
+    base[y0:y1, x0:x1] = 1.0
+    pyramid.update(y0, y1, x0, x1)
+    for level, expected in zip(pyramid.levels, reference_levels(base, len(pyramid.levels))):
+        numpy.testing.assert_allclose(level, expected)
+
+
+def test_update_matches_build():
+    rng = numpy.random.default_rng(0)
+    base = rng.random((23, 37))
+    base[rng.random(base.shape) < 0.2] = numpy.nan
+    built = ImagePyramid(base.copy(), min_size=2).build()
+
+    pyramid = ImagePyramid(numpy.full(base.shape, numpy.nan), min_size=2)
+    for y in range(0, base.shape[0], 4):
+        for x in range(0, base.shape[1], 4):
+            pyramid.levels[0][y:y + 4, x:x + 4] = base[y:y + 4, x:x + 4]
+            pyramid.update(y, y + 4, x, x + 4)
+    for level, expected in zip(pyramid.levels, built.levels):
+        numpy.testing.assert_allclose(level, expected)